@@ -0,0 +1,496 @@
+"""
+Caches for the rendering
+
+The rendered HTML of the pages is stored in a sqlite file (by default,
+``.neorg/rendercache.db``) separated from the main database, so that
+the cache can be removed at any time without losing anything.
+See `RenderCache`.
+
+`LRUCache` is an in-memory cache used for smaller objects, such as
+the nodes generated by the directives.
+
+"""
+
+import time
+import threading
+from hashlib import md5
+from contextlib import closing
+from sqlite3 import dbapi2 as sqlite3
+
+
+def cache_key(page_text, **settings):
+    """
+    Compute the cache key from the page text and the render settings
+
+    >>> cache_key(u'text') == cache_key(u'text')
+    True
+    >>> cache_key(u'text') == cache_key(u'text', debug=True)
+    False
+    >>> cache_key(u'text', a=1, b=2) == cache_key(u'text', b=2, a=1)
+    True
+    >>> cache_key(u'text', a='x') == cache_key(u'text', a=u'x')
+    True
+
+    """
+    from neorg import __version__
+    hasher = md5(__version__)
+    hasher.update(u'\n'.join(
+        u'%s=%s' % kv for kv in sorted(settings.iteritems())).encode('utf-8'))
+    hasher.update(page_text.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+_SCHEMA_VERSION = 5
+
+_SCHEMA = """
+drop table if exists render_cache;
+create table render_cache (
+  page_path string not null,
+  cache_key string not null,
+  page_html string not null,
+  size integer not null,
+  volatile integer not null default 0,
+  dependency string,
+  accessed real not null,
+  primary key (page_path, cache_key)
+);
+create index render_cache_accessed on render_cache (accessed);
+
+-- total size of render_cache, kept up to date by the triggers
+drop table if exists render_cache_size;
+create table render_cache_size (total integer not null);
+insert into render_cache_size (total) values (0);
+create trigger render_cache_insert after insert on render_cache
+begin
+  update render_cache_size set total = total + new.size;
+end;
+create trigger render_cache_delete after delete on render_cache
+begin
+  update render_cache_size set total = total - old.size;
+end;
+
+drop table if exists page_dependency;
+create table page_dependency (
+  page_path string not null,
+  part text not null default '',
+  dependency string not null,
+  volatile integer not null default 0,
+  primary key (page_path, part)
+);
+
+drop table if exists dependency_entry;
+create table dependency_entry (
+  page_path text not null,
+  part text not null default '',
+  entry text not null
+);
+create index dependency_entry_page_path on dependency_entry (page_path);
+create index dependency_entry_entry on dependency_entry (entry);
+
+drop table if exists page_access;
+create table page_access (
+  page_path string primary key,
+  count integer not null default 0
+);
+"""
+
+
+class RenderCache(object):
+    """
+    Disk-backed LRU cache of the rendered HTML
+
+    >>> import os, tempfile
+    >>> (fd, dbpath) = tempfile.mkstemp()
+    >>> rc = RenderCache(dbpath, max_size=20)
+    >>> rc.set('page', 'key', u'<p>html</p>')
+    >>> rc.get('page', 'key')
+    u'<p>html</p>'
+    >>> rc.get('page', 'another key') is None
+    True
+    >>> rc.invalidate('page')
+    >>> rc.get('page', 'key') is None
+    True
+    >>> rc.set('page', 'key', u'this is too large to store')
+    >>> rc.get('page', 'key') is None
+    True
+
+    Least recently accessed entries are removed to fit in `max_size`:
+
+    >>> for key in 'abc':
+    ...     rc.set('page', key, u'123456')
+    >>> rc.set('page', 'd', u'1234567890')
+    >>> [rc.get('page', key) is None for key in 'abcd']
+    [True, True, False, False]
+    >>> os.close(fd)
+    >>> os.remove(dbpath)
+
+    """
+
+    # the access counts and times are written at most every this
+    # number of seconds (see `count_access`)
+    flush_interval = 10.0
+
+    # when the cache exceeds `max_size`, entries are removed until it
+    # is below this fraction of `max_size` (see `_evict`)
+    evict_ratio = 0.9
+
+    def __init__(self, dbpath, max_size):
+        self.dbpath = dbpath
+        self.max_size = max_size
+        self._pending_lock = threading.Lock()
+        self._pending_counts = {}
+        self._pending_accessed = {}
+        self._flushed = time.time()
+        with closing(self._connect()) as db:
+            (version,) = db.execute('pragma user_version').fetchone()
+            if version != _SCHEMA_VERSION:
+                # this is just a cache; old one can be thrown away
+                db.executescript(_SCHEMA)
+                db.execute('pragma user_version = %d' % _SCHEMA_VERSION)
+                db.commit()
+
+    def _connect(self):
+        return sqlite3.connect(self.dbpath)
+
+    def get(self, page_path, key, validate=None):
+        """
+        Get the cached HTML or None if not found
+
+        If `validate` is given, it is called with the dependency
+        stored by `set`.  The entry is removed if it returns False.
+
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'select page_html, dependency from render_cache '
+                'where page_path = ? and cache_key = ?',
+                [page_path, key]).fetchone()
+            if row is None:
+                return None
+            (page_html, dependency) = row
+            if (validate is not None and dependency is not None and
+                not validate(dependency)):
+                db.execute(
+                    'delete from render_cache '
+                    'where page_path = ? and cache_key = ?',
+                    [page_path, key])
+                db.commit()
+                return None
+        with self._pending_lock:
+            self._pending_accessed[(page_path, key)] = time.time()
+        self._flush_if_due()
+        return page_html
+
+    def set(self, page_path, key, page_html, volatile=False,
+            dependency=None):
+        """
+        Store the rendered HTML
+
+        If `volatile` is True, the entry will be removed by
+        `invalidate_volatile`, i.e., when any page is saved or deleted.
+        `dependency` is a string (see `get`).
+
+        """
+        size = len(page_html.encode('utf-8'))
+        if size > self.max_size:
+            return
+        with closing(self._connect()) as db:
+            # not "insert or replace": it does not fire the delete
+            # trigger which maintains render_cache_size
+            db.execute(
+                'delete from render_cache '
+                'where page_path = ? and cache_key = ?',
+                [page_path, key])
+            db.execute(
+                'insert into render_cache '
+                '(page_path, cache_key, page_html, size, volatile, '
+                'dependency, accessed) values (?, ?, ?, ?, ?, ?, ?)',
+                [page_path, key, page_html, size, int(volatile),
+                 dependency, time.time()])
+            self._write_pending(db)  # the eviction needs the access times
+            self._evict(db)
+            db.commit()
+
+    def _evict(self, db):
+        """
+        Remove least recently accessed entries to fit in `max_size`
+
+        Once the cache is over `max_size`, it is shrunk down to
+        `evict_ratio` of `max_size` so that the next few writes do not
+        have to evict again.
+
+        """
+        (total,) = db.execute(
+            'select total from render_cache_size').fetchone()
+        if total <= self.max_size:
+            return
+        target = self.max_size * self.evict_ratio
+        victims = []
+        cursor = db.execute(
+            'select rowid, size from render_cache order by accessed')
+        try:
+            for (rowid, size) in cursor:
+                victims.append((rowid,))
+                total -= size
+                if total <= target:
+                    break
+        finally:
+            cursor.close()
+        db.executemany('delete from render_cache where rowid = ?', victims)
+
+    def invalidate(self, page_path):
+        """
+        Remove all cached HTML of the given page
+        """
+        with closing(self._connect()) as db:
+            db.execute('delete from render_cache where page_path = ?',
+                       [page_path])
+            db.commit()
+
+    def invalidate_volatile(self):
+        """
+        Remove cached HTML which depends on the other pages
+        """
+        with closing(self._connect()) as db:
+            db.execute('delete from render_cache where volatile = 1')
+            db.commit()
+
+    def clear(self):
+        with closing(self._connect()) as db:
+            db.execute('delete from render_cache')
+            db.commit()
+
+    def set_dependency(self, page_path, dependency, volatile=False,
+                       entries=(), part=''):
+        """
+        Record the dependency of the page
+
+        Unlike the cached HTML, this is not removed by the eviction.
+        The parts of a page rendered separately (e.g., the deferred
+        fragments) are recorded with their `part` name, so that they
+        do not overwrite the dependency of the whole page.  As the
+        whole page depends on everything its parts depend on, the
+        parts are removed when the whole page (`part` = '') is
+        recorded; otherwise their entries would never be refreshed.
+        `entries` is a list of strings, each of which stands for a
+        part of `dependency` (e.g., a file or a glob pattern).  The
+        pages sharing an entry can be found by `pages_with_entries`
+        without parsing the dependency of every page.  The pages
+        recorded with `volatile` are listed by `list_volatile`.
+
+        """
+        with closing(self._connect()) as db:
+            db.execute(
+                'insert or replace into page_dependency '
+                '(page_path, part, dependency, volatile) values (?, ?, ?, ?)',
+                [page_path, part, dependency, int(volatile)])
+            if part:
+                db.execute('delete from dependency_entry '
+                           'where page_path = ? and part = ?',
+                           [page_path, part])
+            else:
+                db.execute('delete from page_dependency '
+                           "where page_path = ? and part != ''", [page_path])
+                db.execute('delete from dependency_entry '
+                           'where page_path = ?', [page_path])
+            db.executemany(
+                'insert into dependency_entry (page_path, part, entry) '
+                'values (?, ?, ?)',
+                [(page_path, part, entry) for entry in set(entries)])
+            db.commit()
+
+    def remove_dependency(self, page_path):
+        with closing(self._connect()) as db:
+            db.execute('delete from page_dependency where page_path = ?',
+                       [page_path])
+            db.execute('delete from dependency_entry where page_path = ?',
+                       [page_path])
+            db.commit()
+
+    def list_volatile(self):
+        """
+        Get the sorted list of the pages recorded as volatile
+        """
+        with closing(self._connect()) as db:
+            return [row[0] for row in db.execute(
+                'select distinct page_path from page_dependency '
+                'where volatile = 1 order by page_path')]
+
+    def list_entries(self):
+        """
+        Get the list of the distinct entries given to `set_dependency`
+        """
+        with closing(self._connect()) as db:
+            return [row[0] for row in db.execute(
+                'select distinct entry from dependency_entry')]
+
+    def pages_with_entries(self, entries, chunk_size=500):
+        """
+        Get the sorted list of the pages which have any of `entries`
+        """
+        entries = list(entries)
+        page_paths = set()
+        with closing(self._connect()) as db:
+            for i in xrange(0, len(entries), chunk_size):
+                chunk = entries[i:i + chunk_size]
+                page_paths.update(row[0] for row in db.execute(
+                    'select page_path from dependency_entry '
+                    'where entry in ({0})'.format(', '.join('?' * len(chunk))),
+                    chunk))
+        return sorted(page_paths)
+
+    def list_dependencies(self):
+        """
+        Get list of (page_path, dependency) recorded by `set_dependency`
+
+        A page recorded with several parts appears once for each part.
+
+        """
+        with closing(self._connect()) as db:
+            return db.execute(
+                'select page_path, dependency from page_dependency'
+                ).fetchall()
+
+    def count_access(self, page_path):
+        """
+        Increment the access count of the page
+
+        The access counts are used to decide which page to render
+        first (see `neorg.web.PreRenderWorker`).  Like the access
+        times updated by `get`, they are kept in memory and written
+        together every `flush_interval` seconds (or by `flush`).
+
+        """
+        with self._pending_lock:
+            self._pending_counts[page_path] = \
+                self._pending_counts.get(page_path, 0) + 1
+        self._flush_if_due()
+
+    def access_counts(self):
+        """
+        Get a dict which maps page_path to its access count
+        """
+        self.flush()
+        with closing(self._connect()) as db:
+            return dict(db.execute(
+                'select page_path, count from page_access').fetchall())
+
+    def _flush_if_due(self):
+        if time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the access counts and times kept in memory
+        """
+        with closing(self._connect()) as db:
+            self._write_pending(db)
+            db.commit()
+
+    def _write_pending(self, db):
+        with self._pending_lock:
+            counts = self._pending_counts
+            accessed = self._pending_accessed
+            self._pending_counts = {}
+            self._pending_accessed = {}
+            self._flushed = time.time()
+        db.executemany(
+            'insert or ignore into page_access (page_path) values (?)',
+            [(page_path,) for page_path in counts])
+        db.executemany(
+            'update page_access set count = count + ? where page_path = ?',
+            [(n, page_path) for (page_path, n) in counts.iteritems()])
+        db.executemany(
+            'update render_cache set accessed = ? '
+            'where page_path = ? and cache_key = ?',
+            [(t, page_path, key)
+             for ((page_path, key), t) in accessed.iteritems()])
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory LRU cache bounded by the total size of entries
+
+    The size of each entry is given by the caller (default is 1, i.e.,
+    the cache is bounded by the number of entries).
+
+    >>> lru = LRUCache(max_size=3)
+    >>> lru.set('a', 'A', size=2)
+    >>> lru.set('b', 'B')
+    >>> lru.get('a')
+    'A'
+    >>> lru.set('c', 'C')  # 'b' is the least recently used
+    >>> lru.get('b') is None
+    True
+    >>> sorted(lru.stats().items())
+    [('entries', 2), ('evictions', 1), ('hits', 1), ('misses', 1), ('size', 3)]
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # doubly linked list: link = [prev, next, key, value, size]
+            self._root = root = []
+            root[:] = [root, root, None, None, 0]
+            self._map = {}
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value, size=1):
+        with self._lock:
+            if key in self._map:
+                self._remove(self._map[key])
+            if size > self.max_size:
+                return
+            link = [None, None, key, value, size]
+            self._append(link)
+            self._map[key] = link
+            self._size += size
+            while self._size > self.max_size:
+                self._remove(self._root[1])  # least recently used
+                self.evictions += 1
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def _unlink(self, link):
+        (prev, next) = link[:2]
+        prev[1] = next
+        next[0] = prev
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self._map[link[2]]
+        self._size -= link[4]
+
+    def __len__(self):
+        return len(self._map)
+
+    def stats(self):
+        """
+        Get hit/miss/eviction counts and the current size
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, size=self._size,
+                        entries=len(self._map))
@@ -1,21 +1,104 @@
 def serve(port, root=None, debug=None, browser=None):
-    from neorg.web import app, update_system_info, update_search_index
+    from neorg.web import (app, update_system_info, start_search_writer,
+                           start_search_indexer, mark_search_index_synced,
+                           start_prerender_worker, flush_render_cache,
+                           close_pooled_db)
     from neorg.config import load_config
     from neorg.wiki import setup_wiki
+    from neorg.cache import LRUCache
+    from multiprocessing.pool import ThreadPool
+    import atexit
     load_config(app, dirpath=root)
     if debug is not None:
         app.config['DEBUG'] = debug
-    update_search_index()
     update_system_info()
+    start_search_writer()
+    start_search_indexer()
+    atexit.register(mark_search_index_synced)
+    atexit.register(flush_render_cache)
+    # the requests are processed in this thread (see `app.run` below)
+    atexit.register(close_pooled_db)
     if browser:
         from threading import Timer
         from webbrowser import open_new_tab
         Timer(1, open_new_tab,
               args=['http://localhost:%d' % port]).start()
-    setup_wiki()
+    fragment_cache_size = app.config['FRAGMENTCACHE_SIZE']
+    dataload_threads = app.config['DATALOAD_THREADS']
+    setup_wiki(fragment_cache=(LRUCache(fragment_cache_size)
+                               if fragment_cache_size else None),
+               thread_pool=(ThreadPool(dataload_threads)
+                            if dataload_threads > 1 else None))
+    if app.config['PRERENDER']:
+        start_prerender_worker()
     app.run(port=port)
 
 
+def affected(datapath, root=None, scan=False):
+    import os
+    from neorg.web import app, find_affected_pages, render_all_pages
+    from neorg.config import load_config
+    from neorg.wiki import setup_wiki
+    load_config(app, dirpath=root)
+    setup_wiki()
+    if scan:
+        render_all_pages()
+    for page_path in find_affected_pages(os.path.abspath(datapath)):
+        print '/' + page_path
+
+
+def compress_history(root=None, interval=None):
+    from contextlib import closing
+    from neorg.web import app, connect_db
+    from neorg.config import load_config
+    from neorg.migration import migrate
+    from neorg.revisions import compress_history
+    load_config(app, dirpath=root)
+    if interval is None:
+        interval = app.config['HISTORY_SNAPSHOT_INTERVAL'] or 20
+    with closing(connect_db()) as db:
+        migrate(db, dict(app.config, HISTORY_SNAPSHOT_INTERVAL=interval),
+                offline=True)
+        converted = compress_history(db, interval)
+        db.execute('vacuum')
+    print 'Compressed {0} revisions.'.format(converted)
+
+
+def migrate(root=None, dry_run=False):
+    from contextlib import closing
+    from neorg.web import app, connect_db, system_info, update_system_info
+    from neorg.config import load_config
+    from neorg.migration import pending_steps
+    from neorg.verutils import NEOrgVersion
+    load_config(app, dirpath=root)
+    if dry_run:
+        oldver = NEOrgVersion(system_info()['version'])
+        with closing(connect_db()) as db:
+            for step in pending_steps(db, oldver):
+                print '{0}: {1}'.format(step.version, step.description)
+    else:
+        update_system_info(offline=True)
+
+
+def reindex(root=None, procs=None, batch_size=500):
+    import time
+    from multiprocessing import cpu_count
+    from neorg.web import app, rebuild_search_index, update_system_info
+    from neorg.config import load_config
+    from neorg.migration import Progress
+    load_config(app, dirpath=root)
+    update_system_info()  # the marker needs the migrated database
+    progress = Progress('Reading pages')
+    start = time.time()
+    num_indexed = rebuild_search_index(procs=procs or cpu_count(),
+                                       batch_size=batch_size,
+                                       progress=progress)
+    progress.finish()
+    elapsed = time.time() - start
+    print 'Indexed {0} pages in {1:.1f} seconds ({2:.1f} pages/s).'.format(
+        num_indexed, elapsed, num_indexed / max(elapsed, 1e-9))
+
+
 def init(dest):
     from neorg.web import app, init_db
     from neorg.config import init_config_file, load_config
@@ -63,6 +146,65 @@ def main():
         help='set DEBUG=True to run in debug mode')
     parser_serve.set_defaults(func=serve)
 
+    # affected
+    parser_affected = subparsers.add_parser(
+        'affected', help='list pages depending on a data file')
+    parser_affected.add_argument(
+        'datapath', help='path to the data file')
+    parser_affected.add_argument(
+        '-R', '--root',
+        help='root directory (where `.neorg/` exists)',
+        )
+    parser_affected.add_argument(
+        '--scan', action='store_true',
+        help='render all pages before listing. '
+        'without this option, only the pages viewed at least once '
+        'are listed')
+    parser_affected.set_defaults(func=affected)
+
+    # compress-history
+    parser_compress_history = subparsers.add_parser(
+        'compress-history',
+        help='compress the page history stored in old format')
+    parser_compress_history.add_argument(
+        '-R', '--root',
+        help='root directory (where `.neorg/` exists)',
+        )
+    parser_compress_history.add_argument(
+        '--interval', type=int,
+        help='number of revisions between full snapshots '
+        '(default: HISTORY_SNAPSHOT_INTERVAL)')
+    parser_compress_history.set_defaults(func=compress_history)
+
+    # migrate
+    parser_migrate = subparsers.add_parser(
+        'migrate', help='migrate the database to the current version')
+    parser_migrate.add_argument(
+        '-R', '--root',
+        help='root directory (where `.neorg/` exists)',
+        )
+    parser_migrate.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='list the steps to run without running them')
+    parser_migrate.set_defaults(func=migrate)
+
+    # reindex
+    parser_reindex = subparsers.add_parser(
+        'reindex', help='rebuild the search index from scratch')
+    parser_reindex.add_argument(
+        '-R', '--root',
+        help='root directory (where `.neorg/` exists)',
+        )
+    parser_reindex.add_argument(
+        '-j', '--procs', type=int,
+        help='number of processes to write the whoosh index '
+        '(default: number of CPUs)')
+    parser_reindex.add_argument(
+        '--batch-size', type=int, default=500,
+        help='number of pages read from the database at once '
+        '(default: %(default)s)')
+    parser_reindex.set_defaults(func=reindex)
+
     args = parser.parse_args()
     return applyargs(**vars(args))
 
@@ -8,6 +8,80 @@ class DefaultConfig(object):
     DATADIRPATH = '%(root)s'
     SEARCHINDEX = '%(neorg)s/searchindex'
 
+    # 'whoosh' stores the search index in SEARCHINDEX.  'fts5' stores
+    # it in DATABASE (needs SQLite with FTS5) and updates it in the
+    # same transaction as the page.
+    SEARCH_BACKEND = 'whoosh'
+
+    # number of the search results shown in one page
+    SEARCH_PAGELEN = 20
+
+    # write the changes of the 'whoosh' search index in background,
+    # in batches collected for SEARCH_WRITE_LATENCY seconds (set 0 to
+    # write in the request), and merge the index segments every
+    # SEARCH_OPTIMIZE_INTERVAL seconds (set 0 to disable).
+    SEARCH_WRITE_LATENCY = 1.0
+    SEARCH_OPTIMIZE_INTERVAL = 3600
+
+    # max number of pages of the search results cached in memory.
+    # set 0 to disable.
+    SEARCHCACHE_SIZE = 1000
+
+    # use write-ahead logging for DATABASE so that reading pages is
+    # not blocked by saving.  wait DATABASE_TIMEOUT seconds when the
+    # database is locked.
+    DATABASE_WAL = True
+    DATABASE_TIMEOUT = 10
+
+    # sqlite file to store rendered HTML.  set None to disable.
+    RENDERCACHE = '%(neorg)s/rendercache.db'
+    RENDERCACHE_SIZE = 64 * 1024 * 1024  # in bytes
+
+    # the data files of a cached page are checked again only after
+    # RENDERCACHE_CHECK_TTL seconds from the last check.  set 0 to
+    # check them on every view.
+    RENDERCACHE_CHECK_TTL = 5
+
+    # max number of docutils nodes cached for data directives.
+    # set 0 to disable.
+    FRAGMENTCACHE_SIZE = 200000
+
+    # max number of rendered reST blocks cached for the preview.
+    # unchanged blocks are not parsed again.  set 0 to disable.
+    BLOCKCACHE_SIZE = 10000
+
+    # max number of compiled template pages (``_temp_``) cached.
+    # set 0 to disable.
+    TEMPLATECACHE_SIZE = 100
+
+    # store each revision of the page history as a compressed delta
+    # from the previous one, with a compressed full text every
+    # HISTORY_SNAPSHOT_INTERVAL revisions.  set 0 to store plain text.
+    HISTORY_SNAPSHOT_INTERVAL = 20
+
+    # render pages into RENDERCACHE in background while serving.
+    # after each page, sleep PRERENDER_THROTTLE times as long as the
+    # rendering took.  pages whose data files are changed are checked
+    # every PRERENDER_INTERVAL seconds.
+    PRERENDER = True
+    PRERENDER_THROTTLE = 1.0
+    PRERENDER_INTERVAL = 60
+
+    # limit of the resources used by the data directives to render a
+    # page: wall time in seconds, number of files matched by the glob
+    # patterns and number of data files loaded.  set None for no limit.
+    RENDER_MAX_TIME = 30
+    RENDER_MAX_GLOBBED = 10000
+    RENDER_MAX_LOADED = 2000
+
+    # show pages before rendering the data directives.  they are
+    # rendered separately and loaded by JavaScript.
+    DEFERRED_RENDERING = False
+
+    # number of threads to load the data files of the data directives
+    # in a page concurrently.  set 1 to load them serially.
+    DATALOAD_THREADS = 4
+
     # HELPDIRPATH = '%(neorg)s/help'
     # nerog reads help page from `static/help` if HELPDIRPATH is not
     # defined
@@ -35,8 +109,9 @@ def expand_magic_words(config):
         'neorg': config['NEORG_DIR'],
         'root': config['NEORG_ROOT'],
         }
-    for key in ['DATABASE', 'DATADIRPATH', 'HELPDIRPATH', 'SEARCHINDEX']:
-        if key in config:
+    for key in ['DATABASE', 'DATADIRPATH', 'HELPDIRPATH', 'SEARCHINDEX',
+                'RENDERCACHE']:
+        if config.get(key):
             config[key] = expandall(config[key] % magic)
 
 
@@ -450,10 +450,20 @@ class DictTable(object):
         print table.draw()
 
     @classmethod
-    def from_path_list(cls, path_list, name_list=None, ftypes={}):
+    def from_path_list(cls, path_list, name_list=None, ftypes={},
+                       budget=None):
+        """
+        Load data files in `path_list`
+
+        If `budget` (see `neorg.wiki.RenderBudget`) is given, stop
+        loading when it runs out.
+
+        """
         name_list = path_list if name_list is None else name_list
         dt = cls()
         for (path, name) in zip(path_list, name_list):
+            if budget is not None and not budget.spend_load():
+                break
             ft = ftypes_match(path, ftypes)
             try:
                 dt.append(name, cls.load_any(path, ft))
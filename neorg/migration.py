@@ -0,0 +1,213 @@
+"""
+Versioned migration of the database
+
+A migration step is a function decorated by `step` with the NEOrg
+version which introduced it.  `migrate` runs the steps not recorded in
+the ``migration`` table yet, in the order of the versions, and records
+them.  Steps of versions older than the version stored in
+``system_info`` are skipped since such databases were created with
+the schema including the changes.
+
+Each step must be idempotent (it can be interrupted and run again)
+and should process large tables in batches (see `backfill`), so that
+a big database can be migrated in place.
+
+Steps registered with ``offline=True`` rewrite large parts of the
+database.  They are run only when `migrate` is called with
+``offline=True`` (i.e., by ``neorg migrate``), not at the startup of
+the server.
+
+"""
+
+import sys
+from neorg.verutils import NEOrgVersion
+
+BATCH_SIZE = 1000
+
+STEPS = []
+
+
+class Step(object):
+
+    def __init__(self, version, func, offline=False):
+        self.version = NEOrgVersion(version)
+        self.func = func
+        self.offline = offline
+        self.name = func.__name__
+        self.description = func.__doc__.strip().splitlines()[0]
+
+
+def step(version, offline=False):
+    """
+    Decorator to register a migration step
+
+    The decorated function is called with the connection, the config
+    dict and a progress callback (see `Progress`).  The first line of
+    its docstring is shown while running.
+
+    """
+    def decorator(func):
+        STEPS.append(Step(version, func, offline))
+        return func
+    return decorator
+
+
+class Progress(object):
+    """
+    Print the progress of a step as ``description: done/total``
+    """
+
+    def __init__(self, description, stream=sys.stdout):
+        self.description = description
+        self.stream = stream
+        self._width = 0
+
+    def __call__(self, done, total):
+        self._write('{0}/{1}'.format(done, total))
+
+    def finish(self):
+        self._write('done')
+        self.stream.write('\n')
+
+    def _write(self, status):
+        # overwrite the current line; pad to erase the longer status
+        line = '\r  {0}: {1}'.format(self.description, status)
+        self.stream.write(line.ljust(self._width))
+        self.stream.flush()
+        self._width = len(line)
+
+
+def _ensure_table(db):
+    db.execute(
+        'create table if not exists migration ('
+        'name string primary key, '
+        'applied timestamp default current_timestamp)')
+
+
+def pending_steps(db, oldver=None, offline=True):
+    """
+    Get the list of the steps to run
+
+    If `oldver` is given, the steps of the older versions are not
+    included.  The steps of `oldver` itself are included because the
+    database may be created by a development version.  The offline
+    steps are not included if `offline` is false.
+
+    """
+    _ensure_table(db)
+    applied = set(row[0] for row in db.execute('select name from migration'))
+    steps = [s for s in STEPS if s.name not in applied and
+             (oldver is None or not s.version < oldver) and
+             (offline or not s.offline)]
+    return sorted(steps, key=lambda s: s.version.parts)
+
+
+def mark_applied(db, steps=None):
+    """
+    Record the steps (default: all) as applied, e.g., for a new database
+    """
+    _ensure_table(db)
+    db.executemany('insert or ignore into migration (name) values (?)',
+                   [(s.name,) for s in (STEPS if steps is None else steps)])
+    db.commit()
+
+
+def migrate(db, config, oldver=None, stream=sys.stdout, offline=False):
+    """
+    Run the pending steps (see `pending_steps`) and record them
+
+    Returns the list of the steps run.
+
+    """
+    steps = pending_steps(db, oldver, offline)
+    for s in steps:
+        progress = Progress(s.description, stream)
+        progress(0, '?')
+        s.func(db, config, progress)
+        mark_applied(db, [s])
+        progress.finish()
+    return steps
+
+
+def columns(db, table):
+    return [row[1] for row in db.execute('pragma table_info(%s)' % table)]
+
+
+def backfill(db, table, assignment, condition, progress,
+             batch_size=BATCH_SIZE):
+    """
+    Run ``update table set assignment where condition`` in batches
+
+    The rows are processed by the ranges of rowid and each batch is
+    committed.  `condition` should be false for the updated rows so
+    that an interrupted backfill can be continued.
+
+    """
+    (maxid,) = db.execute(
+        'select coalesce(max(rowid), 0) from %s' % table).fetchone()
+    for start in xrange(0, maxid + 1, batch_size):
+        db.execute(
+            'update {0} set {1} where rowid >= ? and rowid < ? and ({2})'
+            .format(table, assignment, condition),
+            [start, start + batch_size])
+        db.commit()
+        progress(min(start + batch_size, maxid), maxid)
+
+
+@step('0.0.4.dev0')
+def pages_updated(db, config, progress):
+    """
+    Add the last update time to pages
+    """
+    if 'updated' not in columns(db, 'pages'):
+        db.execute('alter table pages add column updated timestamp')
+    db.execute('create index if not exists pages_updated on pages (updated)')
+    # the backfill below looks up the history of each page
+    db.execute('create index if not exists page_history_page_path '
+               'on page_history (page_path, history_id)')
+    db.commit()
+    backfill(db, 'pages',
+             'updated = (select max(updated) from page_history '
+             'where page_history.page_path = pages.page_path)',
+             'updated is null', progress)
+
+
+@step('0.0.4.dev0')
+def history_metadata(db, config, progress):
+    """
+    Add the size and the summary of the revisions
+    """
+    existing = columns(db, 'page_history')
+    if 'text_size' not in existing:
+        db.execute('alter table page_history add column text_size integer')
+    if 'summary' not in existing:
+        db.execute('alter table page_history add column summary string')
+    db.execute('create index if not exists page_history_page_path '
+               'on page_history (page_path, history_id)')
+    db.commit()
+    backfill(db, 'page_history', 'text_size = length(page_text)',
+             'text_size is null', progress)
+
+
+@step('0.0.4.dev0')
+def history_encoding(db, config, progress):
+    """
+    Add the columns for the compressed history
+    """
+    existing = columns(db, 'page_history')
+    for column in ['page_data blob', 'encoding string',
+                   'base_id integer', 'chain integer']:
+        if column.split()[0] not in existing:
+            db.execute('alter table page_history add column ' + column)
+    db.commit()
+
+
+@step('0.0.4.dev0', offline=True)
+def compress_history(db, config, progress):
+    """
+    Compress the page history
+    """
+    from neorg.revisions import compress_history
+    interval = config.get('HISTORY_SNAPSHOT_INTERVAL')
+    if interval:
+        compress_history(db, interval, progress)
@@ -0,0 +1,224 @@
+"""
+Compressed storage of the page history
+
+Each row of the ``page_history`` table stores its text in one of the
+following ways, given by the ``encoding`` column:
+
+``NULL``
+    Plain text in ``page_text`` (databases made by old NEOrg).
+``'zlib'``
+    zlib-compressed UTF-8 text in ``page_data`` (a snapshot).
+``'delta'``
+    zlib-compressed line delta in ``page_data`` from the revision
+    ``base_id`` (the previous revision of the same page).
+
+``chain`` is the number of deltas to apply from the last snapshot.
+A snapshot is stored every `snapshot_interval` revisions so that
+`load_revision` needs to apply at most ``snapshot_interval - 1``
+deltas.
+
+"""
+
+import json
+import zlib
+from difflib import SequenceMatcher
+from sqlite3 import Binary
+
+
+class LineDiff(object):
+    """
+    Line-by-line difference from `base` to `text`
+
+    The lines are compared without the line endings, so that adding a
+    line after the last line without newline changes only one line.
+    One instance can be used for both `make_delta` and `counts`.
+
+    >>> LineDiff(u'a\\nb\\nc', u'a\\nB\\nc\\nd').counts()
+    (2, 1)
+
+    """
+
+    def __init__(self, base, text):
+        self.base_lines = base.splitlines(True)
+        self.lines = text.splitlines(True)
+        self.opcodes = SequenceMatcher(
+            None, base.splitlines(), text.splitlines()).get_opcodes()
+
+    def counts(self):
+        """
+        Get the numbers of the added and the removed lines
+        """
+        added = removed = 0
+        for (tag, i1, i2, j1, j2) in self.opcodes:
+            if tag != 'equal':
+                added += j2 - j1
+                removed += i2 - i1
+        return (added, removed)
+
+
+def make_delta(base, text, diff=None):
+    """
+    Make compressed line delta to get `text` from `base`
+
+    `diff` is the `LineDiff` of `base` and `text` if already computed.
+
+    >>> base = u'a\\nb\\nc'
+    >>> text = u'a\\nB\\nc\\nd\\n'
+    >>> apply_delta(base, make_delta(base, text)) == text
+    True
+
+    """
+    if diff is None:
+        diff = LineDiff(base, text)
+    (base_lines, lines) = (diff.base_lines, diff.lines)
+    ops = []
+    for (tag, i1, i2, j1, j2) in diff.opcodes:
+        if tag == 'equal':
+            # lines can still differ in the line endings
+            k = 0
+            while k < i2 - i1 and base_lines[i1 + k] == lines[j1 + k]:
+                k += 1
+            if k:
+                ops.append([i1, i1 + k])  # copy lines of `base`
+            if k < i2 - i1:
+                ops.append(u''.join(lines[j1 + k:j2]))
+        elif j2 > j1:
+            ops.append(u''.join(lines[j1:j2]))  # insert text
+    return zlib.compress(json.dumps(ops))
+
+
+def apply_delta(base, delta):
+    """
+    Apply the delta made by `make_delta` to `base`
+    """
+    base_lines = base.splitlines(True)
+    chunks = []
+    for op in json.loads(zlib.decompress(delta)):
+        if isinstance(op, list):
+            chunks.extend(base_lines[op[0]:op[1]])
+        else:
+            chunks.append(op)
+    return u''.join(chunks)
+
+
+def _encode(db, page_path, page_text, snapshot_interval, before=None,
+            base_text=None, diff=None):
+    """
+    Encode `page_text` as a revision following the newest revision of
+    `page_path` (older than `before` if given)
+
+    `base_text` is the text of that revision if known, and `diff` is
+    its `LineDiff` to `page_text`.  Returns the values of the columns
+    (page_text, page_data, encoding, base_id, chain).
+
+    """
+    if not snapshot_interval:
+        return (page_text, None, None, None, None)
+    if before is None:
+        prev = db.execute(
+            'select history_id, page_exists, chain from page_history '
+            'where page_path = ? order by history_id desc limit 1',
+            [page_path]).fetchone()
+    else:
+        prev = db.execute(
+            'select history_id, page_exists, chain from page_history '
+            'where page_path = ? and history_id < ? '
+            'order by history_id desc limit 1',
+            [page_path, before]).fetchone()
+    if prev and prev[1] and prev[2] is not None and \
+       prev[2] + 1 < snapshot_interval:
+        if base_text is None:
+            base_text = load_revision(db, prev[0])
+        return (u'', Binary(make_delta(base_text, page_text, diff)),
+                'delta', prev[0], prev[2] + 1)
+    return (u'', Binary(zlib.compress(page_text.encode('utf-8'))), 'zlib',
+            None, 0)
+
+
+def add_revision(db, page_path, page_text, snapshot_interval=0,
+                 base_text=None, diff=None, **columns):
+    """
+    Insert a revision of the page and return its history_id
+
+    If `snapshot_interval` is 0, the text is stored as is.  If the
+    caller knows the text of the current revision, it should be given
+    as `base_text` (and its `LineDiff` to `page_text` as `diff`) so
+    that it is not loaded from the history again.  Other columns of
+    ``page_history`` can be given as keyword arguments.  This function
+    does not commit.
+
+    """
+    values = dict(zip(
+        ('page_text', 'page_data', 'encoding', 'base_id', 'chain'),
+        _encode(db, page_path, page_text, snapshot_interval,
+                base_text=base_text, diff=diff)))
+    values.update(columns, page_path=page_path)
+    keys = sorted(values)
+    return db.execute(
+        'insert into page_history ({0}) values ({1})'.format(
+            ', '.join(keys), ', '.join('?' * len(keys))),
+        [values[k] for k in keys]).lastrowid
+
+
+def load_revision(db, history_id):
+    """
+    Get the text of the revision or None if it does not exist
+    """
+    deltas = []
+    while True:
+        row = db.execute(
+            'select page_text, page_data, encoding, base_id '
+            'from page_history where history_id = ?',
+            [history_id]).fetchone()
+        if row is None:
+            return None
+        (page_text, page_data, encoding, base_id) = row
+        if encoding == 'delta':
+            deltas.append(str(page_data))
+            history_id = base_id
+        elif encoding == 'zlib':
+            page_text = zlib.decompress(str(page_data)).decode('utf-8')
+            break
+        else:
+            break
+    for delta in reversed(deltas):
+        page_text = apply_delta(page_text, delta)
+    return page_text
+
+
+def compress_history(db, snapshot_interval, progress=None):
+    """
+    Convert the plain text revisions to the compressed ones
+
+    Returns the number of the converted revisions.  Each page is
+    committed separately, so this can be interrupted and run again.
+    If given, ``progress(done, total)`` is called with the number of
+    the converted pages after each page.
+
+    """
+    converted = 0
+    page_paths = [row[0] for row in db.execute(
+        'select distinct page_path from page_history '
+        'where encoding is null')]
+    for (i, page_path) in enumerate(page_paths):
+        base_text = None
+        rows = db.execute(
+            'select history_id, page_text, encoding from page_history '
+            'where page_path = ? order by history_id',
+            [page_path]).fetchall()
+        for (history_id, page_text, encoding) in rows:
+            if encoding is not None:
+                base_text = None  # load it when needed
+                continue
+            values = _encode(db, page_path, page_text, snapshot_interval,
+                             before=history_id, base_text=base_text)
+            db.execute(
+                'update page_history set page_text = ?, page_data = ?, '
+                'encoding = ?, base_id = ?, chain = ? where history_id = ?',
+                list(values) + [history_id])
+            base_text = page_text
+            converted += 1
+        db.commit()
+        if progress:
+            progress(i + 1, len(page_paths))
+    return converted
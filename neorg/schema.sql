@@ -1,8 +1,10 @@
 drop table if exists pages;
 create table pages (
   page_path string primary key,
-  page_text string not null
+  page_text string not null,
+  updated timestamp  -- copy of the newest page_history.updated
 );
+create index pages_updated on pages (updated);
 
 drop table if exists page_history;
 create table page_history (
@@ -10,11 +12,25 @@ create table page_history (
   page_path string not null,
   page_text string not null,
   page_exists integer not null default 1,
-  updated timestamp default current_timestamp
+  updated timestamp default current_timestamp,
+  text_size integer,  -- length of page_text
+  summary string,     -- see `neorg.web.summarize_change`
+  -- compressed text (see `neorg.revisions`)
+  page_data blob,
+  encoding string,
+  base_id integer,
+  chain integer
 );
+create index page_history_page_path on page_history (page_path, history_id);
 
 drop table if exists system_info;
 create table system_info (
   version string primary key,
   updated timestamp default current_timestamp
 );
+
+drop table if exists migration;
+create table migration (  -- applied steps (see `neorg.migration`)
+  name string primary key,
+  applied timestamp default current_timestamp
+);
@@ -1,4 +1,28 @@
+"""
+Full text search of the pages
+
+The search index is accessed through the functions `get_index`,
+`update`, `update_all`, `delete` and `search`, which delegate to one
+of the backends in `BACKENDS`:
+
+``'whoosh'`` (`WhooshIndex`)
+    Whoosh index stored in a separate directory.
+``'fts5'`` (`FTSIndex`)
+    SQLite FTS5 tables stored in the main database.  The changes are
+    not committed by this module, so that they are committed in the
+    same transaction as the page.
+
+`QueuedIndex` wraps an index to write the changes in background.
+
+"""
+
 import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from cgi import escape
 from hashlib import md5
 from whoosh import index
 
@@ -11,8 +35,9 @@ def get_schema():
     --------------
     page_path : ID(stored=True, unique=True)
         This is as same as the `page_path` column in the `pages` table.
-    page_text : TEXT
+    page_text : TEXT(stored=True)
         This is as same as the `page_text` column in the `pages` table.
+        This is stored to make the highlighted fragments.
     hash : STORED
         This is the md5 hash of `page_text`.
         This is used for the comparison of the indexed `page_text`
@@ -23,51 +48,27 @@ def get_schema():
     from whoosh.fields import Schema, TEXT, ID, STORED
 
     return Schema(page_path=ID(stored=True, unique=True),
-                  page_text=TEXT,
+                  page_text=TEXT(stored=True),
                   hash=STORED)
 
 
-def get_index(indexdir):
+def get_index(indexdir=None, backend='whoosh', db=None):
     """
-    Get Whoosh index object. Create the index if it does not exist.
-    """
-    if not os.path.isdir(indexdir):
-        os.mkdir(indexdir)
-    if not index.exists_in(indexdir):
-        ix = index.create_in(indexdir, get_schema())
-    else:
-        ix = index.open_dir(indexdir)
-    return ix
+    Get the search index object of the `backend`.
 
+    `indexdir` is the directory used by the 'whoosh' backend and `db`
+    is the connection used by the 'fts5' backend.  The index is
+    created if it does not exist.
 
-def _update_doc(writer, searcher, page_path, page_text):
-    """
-    Helper function for `update` and `update_all`.
     """
-    old_document = searcher.document(page_path=page_path)
-    if old_document:
-        old_hash = old_document['hash']
-    else:
-        old_hash = None
-
-    new_hash = md5(page_text.encode('utf-8')).hexdigest()
-    if old_hash != new_hash:
-        writer.update_document(
-            page_path=unicode(page_path),
-            page_text=page_text,
-            hash=new_hash)
-        return True
-    else:
-        return False
+    return BACKENDS[backend].open(indexdir=indexdir, db=db)
 
 
 def update(ix, page_path, page_text):
     """
     Update or create new index.
     """
-    with ix.writer() as writer:
-        with writer.searcher() as searcher:
-            return _update_doc(writer, searcher, page_path, page_text)
+    return ix.update(page_path, page_text)
 
 
 def update_all(ix, doc_list):
@@ -82,41 +83,705 @@ def update_all(ix, doc_list):
     search index), because there is no possibility for that to happen.
 
     """
-    num_updated = 0
-    with ix.writer() as writer:
-        with writer.searcher() as searcher:
-            for doc in doc_list:
-                if _update_doc(writer, searcher, **doc):
-                    num_updated += 1
-    return num_updated
+    return ix.update_all(doc_list)
 
 
 def delete(ix, page_path):
     """
     Delete the given `page_path` from the search index.
     """
-    with ix.writer() as writer:
-        writer.delete_by_term('page_path', page_path)
+    ix.delete(page_path)
 
 
-def search(ix, querystr, get_page_text):
+def search(ix, querystr, page=1, pagelen=10):
     """
     Search thought the index by given query string.
 
-    `get_page_text` is `neorg.web.get_page_text` or its equivalent,
-    i.e., it returns `page_text` given `page_path`.
+    Returns the `page`-th (1-origin) `ResultPage` of the results.
+    `page` is clipped to the existing pages.
+
+    """
+    return ix.search(unicode(querystr), max(page, 1), pagelen)
+
+
+def rebuild(ix, docs, procs=1):
+    """
+    Clear the index and index the documents
+
+    `docs` is an iterable of dictionaries with keys 'page_path' and
+    'page_text'.  It is consumed once, so it can be a generator.
+    The 'whoosh' backend uses `procs` processes to write segments in
+    parallel and merges them at the end.  Returns the number of the
+    indexed documents.
+
+    """
+    return ix.rebuild(docs, procs)
+
+
+def is_transactional(ix):
+    """
+    Check if `ix` must be updated before committing the pages
+
+    The 'fts5' backend is written in the transaction of the database
+    connection.  The other backends should be updated after the pages
+    are committed, so that the database is not locked while writing
+    the index.
+
+    """
+    return ix.transactional
+
+
+def get_marker(ix):
+    """
+    Get the marker stored by `set_marker` or None
+    """
+    return ix.get_marker()
+
+
+def set_marker(ix, marker):
+    """
+    Store a string to tell the state of the pages the index has
+    """
+    ix.set_marker(marker)
+
+
+def get_generation(ix):
+    """
+    Get a value which changes whenever the index is changed
+    """
+    return ix.generation
+
+
+def normalize_query(querystr):
+    """
+    Normalize the white spaces in the query string
+
+    >>> print normalize_query(u' foo   bar\tbaz ')
+    foo bar baz
+
+    """
+    return u' '.join(querystr.split())
+
+
+def text_hash(page_text):
+    return md5(page_text.encode('utf-8')).hexdigest()
+
+
+class ResultPage(object):
+    """
+    A page of the search results
+
+    Iterating over it yields pairs of `page_path` and the highlighted
+    fragments (HTML) of the matched pages.
+
+    """
+
+    def __init__(self, hits, total, page, pagelen):
+        self.hits = hits
+        self.total = total
+        self.page = page
+        self.pagelen = pagelen
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+    @property
+    def pagecount(self):
+        return max((self.total + self.pagelen - 1) // self.pagelen, 1)
+
+    @staticmethod
+    def clip(page, total, pagelen):
+        return min(page, max((total + pagelen - 1) // pagelen, 1))
+
+
+class BaseIndex(object):
+    """
+    Interface of the search backends
+    """
+
+    # true if the index is written in the transaction of the database
+    # connection, i.e., the changes are committed (or rolled back)
+    # together with the pages
+    transactional = False
+
+    @classmethod
+    def open(cls, indexdir=None, db=None):
+        """Open or create the index"""
+        raise NotImplementedError
+
+    def update(self, page_path, page_text):
+        """Index the page and return True if it is changed"""
+        raise NotImplementedError
+
+    def update_all(self, doc_list):
+        """Index the pages and return the number of changed pages"""
+        return sum(self.update(**doc) for doc in doc_list)
+
+    def delete(self, page_path):
+        raise NotImplementedError
+
+    def apply(self, changes):
+        """
+        Apply the dict of changes ``{page_path: page_text}``
+
+        ``None`` as `page_text` means deletion.  Returns the number of
+        the changed pages.
+
+        """
+        num_changed = 0
+        for (page_path, page_text) in sorted(changes.items()):
+            if page_text is None:
+                self.delete(page_path)
+                num_changed += 1
+            elif self.update(page_path, page_text):
+                num_changed += 1
+        return num_changed
+
+    def optimize(self):
+        """Merge the segments of the index"""
+
+    def rebuild(self, docs, procs=1):
+        raise NotImplementedError
+
+    def search(self, querystr, page, pagelen):
+        """Return `ResultPage`"""
+        raise NotImplementedError
+
+    def get_marker(self):
+        raise NotImplementedError
+
+    def set_marker(self, marker):
+        raise NotImplementedError
+
+    @property
+    def generation(self):
+        raise NotImplementedError
+
+
+class WhooshIndex(BaseIndex):
+
+    """
+    Whoosh index in `indexdir`
+
+    Writers of the same `indexdir` in this process wait for each other
+    instead of failing with whoosh's LockError.
+
+    One searcher is kept and shared by the threads.  It is refreshed
+    when the generation of the index is changed, so that the unchanged
+    segments are not opened again.
 
     """
 
-    from cgi import escape
-    from whoosh.qparser import QueryParser
+    _write_locks = {}
+
+    def __init__(self, ix, indexdir):
+        from whoosh.qparser import QueryParser
+        self.ix = ix
+        self.indexdir = indexdir
+        self._parser = QueryParser("page_text", ix.schema)
+        self._write_lock = self._write_locks.setdefault(
+            os.path.abspath(indexdir), threading.Lock())
+        self._searcher = None
+        self._searcher_lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self.ix.latest_generation()
+
+    def close(self):
+        with self._searcher_lock:
+            if self._searcher is not None:
+                self._searcher.close()
+                self._searcher = None
+
+    @classmethod
+    def open(cls, indexdir=None, db=None):
+        if not os.path.isdir(indexdir):
+            os.mkdir(indexdir)
+        if index.exists_in(indexdir):
+            ix = index.open_dir(indexdir)
+            if ix.schema['page_text'].stored:
+                return cls(ix, indexdir)
+            ix.close()  # made by old NEOrg; rebuild with the new schema
+        self = cls(index.create_in(indexdir, get_schema()), indexdir)
+        if os.path.exists(self._marker_path):
+            os.remove(self._marker_path)
+        return self
+
+    @staticmethod
+    def _update_doc(writer, searcher, page_path, page_text):
+        old_document = searcher.document(page_path=page_path)
+        if old_document:
+            old_hash = old_document['hash']
+        else:
+            old_hash = None
+
+        new_hash = text_hash(page_text)
+        if old_hash != new_hash:
+            writer.update_document(
+                page_path=unicode(page_path),
+                page_text=page_text,
+                hash=new_hash)
+            return True
+        else:
+            return False
+
+    def _write(self, func):
+        """
+        Call ``func(writer, searcher)`` and commit if it returns nonzero
+
+        Nothing is committed (the generation is not changed) if `func`
+        did not change anything.
+
+        """
+        with self._write_lock:
+            writer = self.ix.writer()
+            try:
+                with writer.searcher() as searcher:
+                    changed = func(writer, searcher)
+            except:
+                writer.cancel()
+                raise
+            if changed:
+                writer.commit()
+            else:
+                writer.cancel()
+            return changed
+
+    def update(self, page_path, page_text):
+        return self._write(lambda writer, searcher: self._update_doc(
+            writer, searcher, page_path, page_text))
+
+    def update_all(self, doc_list):
+        return self.apply(dict(
+            (doc['page_path'], doc['page_text']) for doc in doc_list))
+
+    def delete(self, page_path):
+        self._write(lambda writer, searcher: writer.delete_by_term(
+            'page_path', page_path, searcher=searcher))
+
+    def apply(self, changes):
+        def apply(writer, searcher):
+            num_changed = 0
+            for (page_path, page_text) in sorted(changes.items()):
+                if page_text is None:
+                    num_changed += writer.delete_by_term(
+                        'page_path', page_path, searcher=searcher)
+                elif self._update_doc(writer, searcher,
+                                      page_path, page_text):
+                    num_changed += 1
+            return num_changed
+        return self._write(apply)
+
+    def optimize(self):
+        with self._write_lock:
+            self.ix.optimize()
+
+    def rebuild(self, docs, procs=1, batchsize=100):
+        from whoosh.filedb.multiproc import MultiSegmentWriter
+        with self._write_lock:
+            if os.path.exists(self._marker_path):
+                os.remove(self._marker_path)
+            if procs > 1:
+                writer = MultiSegmentWriter(self.ix, procs=procs,
+                                            batchsize=batchsize)
+                writer.segments = []  # drop the old segments at commit
+                commit_kwds = {}
+            else:
+                writer = self.ix.writer()
+                commit_kwds = dict(mergetype=lambda writer, segments: [])
+            num_indexed = 0
+            try:
+                for doc in docs:
+                    writer.add_document(
+                        page_path=unicode(doc['page_path']),
+                        page_text=doc['page_text'],
+                        hash=text_hash(doc['page_text']))
+                    num_indexed += 1
+            except:
+                writer.cancel()
+                raise
+            writer.commit(**commit_kwds)
+            if procs > 1:
+                self.ix.optimize()  # merge the segments of the processes
+        return num_indexed
+
+    @property
+    def _marker_path(self):
+        return os.path.join(self.indexdir, 'neorg-marker')
+
+    def get_marker(self):
+        if os.path.exists(self._marker_path):
+            with open(self._marker_path) as f:
+                return f.read()
+
+    def set_marker(self, marker):
+        with open(self._marker_path, 'w') as f:
+            f.write(marker)
+
+    def _refreshed_searcher(self):
+        if self._searcher is None:
+            self._searcher = self.ix.searcher()
+        else:
+            self._searcher = self._searcher.refresh()  # closes the old one
+        return self._searcher
+
+    def search(self, querystr, page, pagelen):
+        query = self._parser.parse(querystr)
+        with self._searcher_lock:
+            searcher = self._refreshed_searcher()
+            results = searcher.search(query, limit=page * pagelen)
+            total = len(results)
+            page = ResultPage.clip(page, total, pagelen)
+            hits = [(hit['page_path'], hit.highlights('page_text'))
+                    for hit in results[(page - 1) * pagelen:]]
+        return ResultPage(hits, total, page, pagelen)
+
+
+_RE_QUERY_TOKEN = re.compile(r'"[^"]*"?|[^\s"]+')
+_FTS_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+def fts_query(querystr):
+    """
+    Convert the query string to the FTS5 query syntax
+
+    Each word or double-quoted phrase is quoted so that the symbols in
+    it are not interpreted by FTS5.  Operators AND, OR and NOT between
+    the terms and a trailing `*` (prefix query) are kept.
+
+    >>> print fts_query(u'neorg.web OR "search index" AND sav*')
+    "neorg.web" OR "search index" AND "sav"*
+    >>> print fts_query(u'AND a NOT')
+    "AND" "a" "NOT"
+
+    """
+    tokens = [t for t in _RE_QUERY_TOKEN.findall(querystr) if t.strip('"*')]
+    terms = []
+    for (i, token) in enumerate(tokens):
+        if (token in _FTS_OPERATORS and terms and
+            terms[-1] not in _FTS_OPERATORS and i + 1 < len(tokens)):
+            terms.append(token)
+            continue
+        prefix = token.endswith('*') and not token.startswith('"')
+        token = token.rstrip('*') if prefix else token.strip('"')
+        terms.append(u'"{0}"{1}'.format(token.replace('"', '""'),
+                                        '*' if prefix else ''))
+    return u' '.join(terms)
+
+
+class FTSIndex(BaseIndex):
+
+    """
+    Search index in the FTS5 table ``search_index`` of the main DB
+
+    ``search_docs`` maps the rowid of ``search_index`` to the page
+    path and stores the hash of the indexed text.  ``search_info``
+    stores the marker (see `set_marker`) and the generation, which is
+    incremented by each change.
+
+    """
+
+    transactional = True
+    _mark = (u'\ue000', u'\ue001')  # replaced by the highlighting tags
+    highlight = ('<b class="match">', '</b>')  # as whoosh
+    ellipsis = u'...'
+    snippet_tokens = 32
+
+    def __init__(self, db):
+        self.db = db
+
+    @classmethod
+    def open(cls, indexdir=None, db=None):
+        if not db.execute("select 1 from sqlite_master where "
+                          "type = 'table' and name = 'search_info'"
+                          ).fetchone():
+            try:
+                db.execute('create virtual table if not exists '
+                           'search_index using fts5(page_text)')
+            except sqlite3.OperationalError as e:
+                raise RuntimeError(
+                    'SQLite {0} does not support FTS5: {1}'
+                    .format(sqlite3.sqlite_version, e))
+            db.execute('create table if not exists search_docs ('
+                       'docid integer primary key, '
+                       'page_path text unique not null, '
+                       'hash text)')
+            db.execute('create table if not exists search_info ('
+                       'key text primary key, value text)')
+        return cls(db)
+
+    def update(self, page_path, page_text):
+        new_hash = text_hash(page_text)
+        row = self.db.execute(
+            'select docid, hash from search_docs where page_path = ?',
+            [page_path]).fetchone()
+        if row and row[1] == new_hash:
+            return False
+        if row:
+            self.db.execute(
+                'update search_index set page_text = ? where rowid = ?',
+                [page_text, row[0]])
+            self.db.execute('update search_docs set hash = ? '
+                            'where docid = ?', [new_hash, row[0]])
+        else:
+            docid = self.db.execute(
+                'insert into search_docs (page_path, hash) values (?, ?)',
+                [page_path, new_hash]).lastrowid
+            self.db.execute(
+                'insert into search_index (rowid, page_text) values (?, ?)',
+                [docid, page_text])
+        self._increment_generation()
+        return True
+
+    def delete(self, page_path):
+        self.db.execute(
+            'delete from search_index where rowid in '
+            '(select docid from search_docs where page_path = ?)',
+            [page_path])
+        self.db.execute('delete from search_docs where page_path = ?',
+                        [page_path])
+        self._increment_generation()
+
+    def rebuild(self, docs, procs=1):
+        """
+        Rebuild the index in the current transaction (`procs` is ignored)
+        """
+        self.db.execute('delete from search_index')
+        self.db.execute('delete from search_docs')
+        self.db.execute("delete from search_info where key = 'marker'")
+        num_indexed = 0
+        for doc in docs:
+            docid = self.db.execute(
+                'insert into search_docs (page_path, hash) values (?, ?)',
+                [doc['page_path'], text_hash(doc['page_text'])]).lastrowid
+            self.db.execute(
+                'insert into search_index (rowid, page_text) values (?, ?)',
+                [docid, doc['page_text']])
+            num_indexed += 1
+        self._increment_generation()
+        return num_indexed
+
+    def _increment_generation(self):
+        self.db.execute(
+            "insert or replace into search_info (key, value) values "
+            "('generation', coalesce((select value from search_info "
+            "where key = 'generation'), 0) + 1)")
+
+    @property
+    def generation(self):
+        row = self.db.execute(
+            "select value from search_info "
+            "where key = 'generation'").fetchone()
+        return row and int(row[0])
+
+    def search(self, querystr, page, pagelen):
+        """
+        Get the pages in the order of relevance (bm25)
+
+        The highlighted fragments are made from the indexed text by
+        FTS5 `snippet`.
+
+        """
+        query = fts_query(querystr)
+        if not query:
+            return ResultPage([], 0, 1, pagelen)
+        (total,) = self.db.execute(
+            'select count(*) from search_index where search_index match ?',
+            [query]).fetchone()
+        page = ResultPage.clip(page, total, pagelen)
+        rows = self.db.execute(
+            'select search_docs.page_path, '
+            'snippet(search_index, 0, ?, ?, ?, ?) '
+            'from search_index join search_docs '
+            'on search_docs.docid = search_index.rowid '
+            'where search_index match ? order by rank limit ? offset ?',
+            list(self._mark) + [self.ellipsis, self.snippet_tokens, query,
+                                pagelen, (page - 1) * pagelen]).fetchall()
+        return ResultPage(
+            [(page_path, self._highlight(snippet))
+             for (page_path, snippet) in rows],
+            total, page, pagelen)
+
+    def get_marker(self):
+        row = self.db.execute(
+            "select value from search_info where key = 'marker'").fetchone()
+        return row and row[0]
+
+    def set_marker(self, marker):
+        self.db.execute('insert or replace into search_info (key, value) '
+                        "values ('marker', ?)", [marker])
+
+    def optimize(self):
+        self.db.execute("insert into search_index (search_index) "
+                        "values ('optimize')")
+
+    def _highlight(self, snippet):
+        html = escape(snippet, True)
+        for (mark, tag) in zip(self._mark, self.highlight):
+            html = html.replace(mark, tag)
+        return html
+
+
+BACKENDS = {
+    'whoosh': WhooshIndex,
+    'fts5': FTSIndex,
+    }
+
+
+class QueuedIndex(BaseIndex):
+    """
+    Index which writes `update` and `delete` in a background thread
+
+    The changes are coalesced by the page path and applied to `ix` by
+    `BaseIndex.apply` in one batch, `latency` seconds after the first
+    change of the batch.  Failed batches are retried.  The segments are
+    merged (`BaseIndex.optimize`) every `optimize_interval` seconds if
+    any change has been applied.  `update_all`, `search` and the
+    marker are passed to `ix` as is.
+
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, ix, latency=1.0, optimize_interval=3600.0):
+        self.ix = ix
+        self.latency = latency
+        self.optimize_interval = optimize_interval
+        self.batches = 0
+        self._pending = {}
+        self._busy = False
+        self._hurry = False
+        self._stopped = False
+        self._last_optimized = time.time()
+        self._optimize_needed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='neorg-search-writer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the thread after applying the pending changes
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self.flush()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the pending changes are applied.  Return False if
+        timed out.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._hurry = bool(self._pending)  # do not wait for latency
+            self._cond.notify_all()
+            while self._pending or self._busy:
+                if deadline is None:
+                    self._cond.wait(1)
+                elif time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                else:
+                    return False
+            return True
+
+    def flush(self):
+        """
+        Apply the pending changes in the current thread
+        """
+        with self._cond:
+            changes = self._pending
+            self._pending = {}
+        if changes:
+            self.ix.apply(changes)
+
+    def update(self, page_path, page_text):
+        with self._cond:
+            self._pending[page_path] = page_text
+            self._cond.notify_all()
+        return True
+
+    def delete(self, page_path):
+        with self._cond:
+            self._pending[page_path] = None
+            self._cond.notify_all()
+
+    def update_all(self, doc_list):
+        return self.ix.update_all(doc_list)
+
+    @property
+    def generation(self):
+        return self.ix.generation
+
+    def search(self, querystr, page, pagelen):
+        return self.ix.search(querystr, page, pagelen)
+
+    def get_marker(self):
+        return self.ix.get_marker()
+
+    def set_marker(self, marker):
+        self.ix.set_marker(marker)
+
+    def _take(self):
+        """
+        Wait for a batch and return it (None if stopped)
+
+        An empty dict is returned when it is time to optimize.
+
+        """
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+            if not (self._pending or self._stopped):
+                self._cond.wait(self._optimize_timeout())
+            deadline = time.time() + self.latency
+            while (self._pending and not (self._stopped or self._hurry) and
+                   time.time() < deadline):
+                self._cond.wait(deadline - time.time())  # coalesce
+            if self._stopped:
+                return None
+            (changes, self._pending) = (self._pending, {})
+            self._busy = bool(changes)
+            self._hurry = False
+            return changes
 
-    querystr = unicode(querystr)
-    with ix.searcher() as searcher:
-        query = QueryParser("page_text", ix.schema).parse(querystr)
-        results = searcher.search(query)
+    def _optimize_timeout(self):
+        if not (self.optimize_interval and self._optimize_needed):
+            return None
+        return max(self._last_optimized + self.optimize_interval -
+                   time.time(), 0)
 
-        for hit in results:
-            page_path = hit['page_path']
-            page_text = escape(get_page_text(page_path), True)
-            yield (page_path, hit.highlights("page_text", page_text))
+    def _run(self):
+        while True:
+            changes = self._take()
+            if changes is None:
+                break
+            if changes:
+                try:
+                    self.ix.apply(changes)
+                    self.batches += 1
+                    self._optimize_needed = True
+                except Exception:
+                    self.logger.exception(
+                        'Failed to update the search index')
+                    with self._cond:
+                        for (page_path, page_text) in changes.items():
+                            self._pending.setdefault(page_path, page_text)
+                        self._cond.wait(self.latency)
+            if self._optimize_timeout() == 0:
+                try:
+                    self.ix.optimize()
+                except Exception:
+                    self.logger.exception(
+                        'Failed to optimize the search index')
+                self._last_optimized = time.time()
+                self._optimize_needed = False
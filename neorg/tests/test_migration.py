@@ -0,0 +1,145 @@
+import os
+from contextlib import closing
+from sqlite3 import dbapi2 as sqlite3
+from StringIO import StringIO
+
+from nose.tools import eq_
+
+from neorg import migration
+from neorg.migration import (STEPS, step, pending_steps, mark_applied,
+                             migrate, backfill)
+from neorg.verutils import NEOrgVersion
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                      'schema.sql')
+
+
+def connect():
+    db = sqlite3.connect(':memory:')
+    with open(SCHEMA) as f:
+        db.executescript(f.read())
+    return db
+
+
+class RegisteredSteps(object):
+    """
+    Temporary replace the registered steps
+    """
+
+    def __enter__(self):
+        self._steps = STEPS[:]
+        del STEPS[:]
+        return STEPS
+
+    def __exit__(self, *args):
+        STEPS[:] = self._steps
+
+
+def test_steps_order():
+    with RegisteredSteps():
+        called = []
+
+        @step('0.0.4')
+        def new(db, config, progress):
+            """New step"""
+            called.append('new')
+
+        @step('0.0.2')
+        def old(db, config, progress):
+            """Old step"""
+            called.append('old')
+
+        @step('0.0.3.dev1')
+        def dev(db, config, progress):
+            """Dev step"""
+            called.append('dev')
+
+        with closing(connect()) as db:
+            eq_([s.name for s in pending_steps(db)], ['old', 'dev', 'new'])
+            eq_([s.name for s in pending_steps(db, NEOrgVersion('0.0.3'))],
+                ['new'])
+            # steps of the stored version are checked
+            eq_([s.name for s in pending_steps(db,
+                                               NEOrgVersion('0.0.3.dev1'))],
+                ['dev', 'new'])
+
+            stream = StringIO()
+            migrate(db, {}, NEOrgVersion('0.0.3.dev0'), stream)
+            eq_(called, ['dev', 'new'])
+            assert 'Dev step: done' in stream.getvalue()
+            eq_(pending_steps(db, NEOrgVersion('0.0.3.dev0')), [])
+            eq_([s.name for s in pending_steps(db)], ['old'])
+            mark_applied(db)
+            eq_(pending_steps(db), [])
+
+
+def test_interrupted_step():
+    with RegisteredSteps():
+
+        @step('0.0.4')
+        def fails(db, config, progress):
+            """Fails"""
+            raise ValueError
+
+        with closing(connect()) as db:
+            try:
+                migrate(db, {}, stream=StringIO())
+            except ValueError:
+                pass
+            eq_([s.name for s in pending_steps(db)], ['fails'])
+
+
+def test_backfill():
+    progress = []
+    with closing(connect()) as db:
+        db.executemany(
+            'insert into page_history (page_path, page_text) values (?, ?)',
+            [('page%d' % i, 'x' * i) for i in range(25)])
+        db.execute('update page_history set text_size = -1 '
+                   "where page_path = 'page3'")
+        backfill(db, 'page_history', 'text_size = length(page_text)',
+                 'text_size is null',
+                 lambda *args: progress.append(args), batch_size=10)
+        eq_(progress, [(10, 25), (20, 25), (25, 25)])
+        eq_([row[0] for row in db.execute(
+            'select text_size from page_history order by history_id')],
+            [-1 if i == 3 else i for i in range(25)])
+
+
+def test_registered_steps():
+    eq_(len(set(s.name for s in STEPS)), len(STEPS))
+    for s in STEPS:
+        assert s.description
+        assert getattr(migration, s.name) is s.func
+
+
+def test_offline_steps():
+    with RegisteredSteps():
+
+        @step('0.0.4')
+        def online(db, config, progress):
+            """Online step"""
+
+        @step('0.0.4', offline=True)
+        def offline(db, config, progress):
+            """Offline step"""
+
+        with closing(connect()) as db:
+            eq_([s.name for s in pending_steps(db, offline=False)],
+                ['online'])
+            eq_([s.name for s in migrate(db, {}, stream=StringIO())],
+                ['online'])
+            eq_([s.name for s in pending_steps(db)], ['offline'])
+            eq_([s.name for s in migrate(db, {}, stream=StringIO(),
+                                         offline=True)], ['offline'])
+            eq_(pending_steps(db), [])
+
+
+def test_pages_updated_uses_index():
+    with closing(connect()) as db:
+        db.execute('drop index page_history_page_path')
+        migration.pages_updated(db, {}, lambda *args: None)
+        plan = ' '.join(str(row) for row in db.execute(
+            'explain query plan select max(updated) from page_history '
+            "where page_path = 'Page'"))
+        assert 'page_history_page_path' in plan
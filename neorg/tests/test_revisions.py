@@ -0,0 +1,101 @@
+import os
+from contextlib import closing
+from sqlite3 import dbapi2 as sqlite3
+
+from mock import patch
+from nose.tools import eq_
+
+from neorg import revisions
+from neorg.revisions import (make_delta, apply_delta, add_revision,
+                             load_revision, compress_history, LineDiff)
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                      'schema.sql')
+
+
+def connect():
+    db = sqlite3.connect(':memory:')
+    with open(SCHEMA) as f:
+        db.executescript(f.read())
+    return db
+
+
+def gene_texts(num):
+    text = u''
+    for i in range(num):
+        text += u'line %d\r\n' % i
+        if i % 3 == 0:
+            text = text.replace(u'line %d' % (i // 2), u'\xfcpdated')
+        yield text
+
+
+def test_delta():
+    texts = [u'', u'a', u'a\n', u'a\nb', u'b\na\n', u'x\ry\u2028z\n'] + \
+        list(gene_texts(10))
+    for base in texts:
+        for text in texts:
+            eq_(apply_delta(base, make_delta(base, text)), text)
+
+
+def test_delta_with_diff():
+    texts = [u'', u'a', u'a\n', u'a\r\nb', u'b\na\n'] + list(gene_texts(5))
+    for base in texts:
+        for text in texts:
+            delta = make_delta(base, text, LineDiff(base, text))
+            eq_(apply_delta(base, delta), text)
+
+
+def test_add_revision_with_base_text():
+    texts = list(gene_texts(5))
+    with closing(connect()) as db:
+        history_ids = [add_revision(db, 'page', texts[0], 20)]
+        with patch.object(revisions, 'load_revision') as load:
+            for (base, text) in zip(texts, texts[1:]):
+                history_ids.append(add_revision(
+                    db, 'page', text, 20, base_text=base,
+                    diff=LineDiff(base, text)))
+        eq_(load.call_count, 0)  # the previous text is not loaded
+        for (history_id, text) in zip(history_ids, texts):
+            eq_(load_revision(db, history_id), text)
+
+
+def check_revisions(snapshot_interval, num=10):
+    texts = list(gene_texts(num))
+    with closing(connect()) as db:
+        history_ids = []
+        for (i, text) in enumerate(texts):
+            page_exists = int(i != 4)  # 4th revision is deletion
+            history_ids.append(add_revision(
+                db, 'page', text if page_exists else u'', snapshot_interval,
+                page_exists=page_exists))
+            add_revision(db, 'another', u'another %d' % i, snapshot_interval)
+        for (i, (history_id, text)) in enumerate(zip(history_ids, texts)):
+            eq_(load_revision(db, history_id), text if i != 4 else u'')
+        chains = [row[0] for row in db.execute(
+            'select chain from page_history where page_path = ? '
+            'order by history_id', ['page'])]
+        if snapshot_interval:
+            assert max(chains) < snapshot_interval
+        else:
+            assert set(chains) == set([None])
+        assert load_revision(db, max(history_ids) + 100) is None
+
+
+def test_revisions():
+    for snapshot_interval in [0, 1, 3, 20]:
+        yield (check_revisions, snapshot_interval)
+
+
+def test_compress_history():
+    texts = list(gene_texts(10))
+    with closing(connect()) as db:
+        history_ids = [add_revision(db, 'page', text) for text in texts]
+        eq_(compress_history(db, 3), len(texts))
+        eq_(compress_history(db, 3), 0)  # nothing to do
+        for (history_id, text) in zip(history_ids, texts):
+            eq_(load_revision(db, history_id), text)
+        eq_(db.execute('select count(*) from page_history '
+                       "where page_text != ''").fetchone()[0], 0)
+        # new revisions follow the converted ones
+        history_id = add_revision(db, 'page', u'new', 3)
+        eq_(load_revision(db, history_id), u'new')
@@ -0,0 +1,244 @@
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+from sqlite3 import dbapi2 as sqlite3
+
+from mock import patch
+from nose.tools import eq_
+
+from neorg import search
+
+PAGES = {
+    'Apple': u'apple is a fruit',
+    'Banana': u'banana is a fruit too',
+    'Car': u'car is not a fruit but <a vehicle>',
+    }
+
+
+def check_backend(backend):
+    tmpdir = tempfile.mkdtemp(prefix='neorg-test-')
+    try:
+        with closing(sqlite3.connect(':memory:')) as db:
+            ix = search.get_index(tmpdir, backend, db)
+
+            def page_paths(query):
+                return sorted(page_path for (page_path, _) in
+                              search.search(ix, query))
+
+            doc_list = [dict(page_path=page_path, page_text=page_text)
+                        for (page_path, page_text) in sorted(PAGES.items())]
+            eq_(search.update_all(ix, doc_list), 3)
+            eq_(search.update_all(ix, doc_list), 0)  # not changed
+            eq_(page_paths(u'fruit'), ['Apple', 'Banana', 'Car'])
+            eq_(page_paths(u'fruit AND too'), ['Banana'])
+            eq_(page_paths(u'fruit NOT too'), ['Apple', 'Car'])
+            eq_(page_paths(u'ban*'), ['Banana'])
+            eq_(page_paths(u'vehicle'), ['Car'])
+            eq_(page_paths(u'nothing'), [])
+
+            [(_, highlights)] = search.search(ix, u'vehicle')
+            assert '&lt;a' in highlights
+            assert '&amp;' not in highlights  # escaped only once
+            assert 'vehicle</b>' in highlights
+
+            assert not search.update(ix, 'Apple', PAGES['Apple'])
+            assert search.update(ix, 'Apple', u'apple is red')
+            eq_(page_paths(u'red'), ['Apple'])
+            eq_(page_paths(u'apple fruit'), [])
+
+            generation = search.get_generation(ix)
+            search.delete(ix, 'Banana')
+            eq_(page_paths(u'fruit'), ['Car'])
+            assert search.get_generation(ix) != generation
+            generation = search.get_generation(ix)
+            assert not search.update(ix, 'Car', PAGES['Car'])
+            eq_(search.get_generation(ix), generation)  # not changed
+
+            assert search.get_marker(ix) is None
+            search.set_marker(ix, '10')
+            eq_(search.get_marker(ix), '10')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def check_pagination(backend):
+    tmpdir = tempfile.mkdtemp(prefix='neorg-test-')
+    try:
+        with closing(sqlite3.connect(':memory:')) as db:
+            ix = search.get_index(tmpdir, backend, db)
+            search.update_all(ix, [
+                dict(page_path='Page%02d' % i, page_text=u'common %d' % i)
+                for i in range(25)])
+            pages = [search.search(ix, u'common', page, pagelen=10)
+                     for page in [1, 2, 3]]
+            eq_([len(r) for r in pages], [10, 10, 5])
+            eq_([(r.total, r.page, r.pagecount) for r in pages],
+                [(25, 1, 3), (25, 2, 3), (25, 3, 3)])
+            eq_(sorted(p for r in pages for (p, _) in r),
+                ['Page%02d' % i for i in range(25)])
+            # out of range pages are clipped
+            eq_(search.search(ix, u'common', 9, pagelen=10).page, 3)
+            eq_(search.search(ix, u'common', 0, pagelen=10).page, 1)
+            r = search.search(ix, u'nothing', 2, pagelen=10)
+            eq_((len(r), r.total, r.page, r.pagecount), (0, 0, 1, 1))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def check_rebuild(backend, procs):
+    tmpdir = tempfile.mkdtemp(prefix='neorg-test-')
+    try:
+        with closing(sqlite3.connect(':memory:')) as db:
+            ix = search.get_index(tmpdir, backend, db)
+            search.update(ix, 'Removed', u'removed fruit')
+            search.set_marker(ix, '10')
+            generation = search.get_generation(ix)
+            docs = (dict(page_path='Page%02d' % i, page_text=u'fruit %d' % i)
+                    for i in range(25))
+            eq_(search.rebuild(ix, docs, procs), 25)
+            assert search.get_generation(ix) != generation
+            assert search.get_marker(ix) is None
+            r = search.search(ix, u'fruit', pagelen=30)
+            eq_(sorted(p for (p, _) in r),
+                ['Page%02d' % i for i in range(25)])
+            eq_(search.update(ix, 'Page00', u'fruit 0'), False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_backends():
+    for backend in sorted(search.BACKENDS):
+        yield (check_backend, backend)
+        yield (check_pagination, backend)
+        yield (check_rebuild, backend, 1)
+    yield (check_rebuild, 'whoosh', 2)
+
+
+def test_fts_query_symbols():
+    with closing(sqlite3.connect(':memory:')) as db:
+        ix = search.get_index(backend='fts5', db=db)
+        search.update(ix, 'Page', u'see neorg.web (and "quoted")')
+        for query in [u'neorg.web', u'"and "quoted', u'(and', u'AND',
+                      u'see OR', u'NOT see', u'"', u'*']:
+            list(search.search(ix, query))  # no syntax error
+        eq_([p for (p, _) in search.search(ix, u'neorg.web')],
+            ['Page'])
+
+
+def test_rebuild_old_whoosh_index():
+    from whoosh import index
+    from whoosh.fields import Schema, TEXT, ID, STORED
+    tmpdir = tempfile.mkdtemp(prefix='neorg-test-')
+    try:
+        ix = index.create_in(tmpdir, Schema(
+            page_path=ID(stored=True, unique=True), page_text=TEXT,
+            hash=STORED))
+        with ix.writer() as writer:
+            writer.add_document(page_path=u'Old', page_text=u'old')
+        ix.close()
+        search.set_marker(search.WhooshIndex(ix, tmpdir), '1')
+        ix = search.get_index(tmpdir)
+        assert search.get_marker(ix) is None  # to be rebuilt
+        eq_(list(search.search(ix, u'old')), [])
+        search.update(ix, 'New', u'new')
+        eq_([p for (p, _) in search.search(ix, u'new')], ['New'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class RecordingIndex(search.BaseIndex):
+
+    def __init__(self, failures=0):
+        self.applied = []
+        self.failures = failures
+        self.optimized = threading.Event()
+
+    def apply(self, changes):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('index is locked')
+        self.applied.append(changes)
+        return len(changes)
+
+    def optimize(self):
+        self.optimized.set()
+
+
+def test_queued_index():
+    ix = RecordingIndex()
+    qix = search.QueuedIndex(ix, latency=10, optimize_interval=0)
+    qix.start()
+    search.update(qix, 'A', u'1')
+    search.delete(qix, 'B')
+    search.update(qix, 'A', u'2')
+    assert qix.wait(5)
+    eq_(ix.applied, [{'A': u'2', 'B': None}])  # coalesced
+    search.update(qix, 'C', u'3')
+    qix.stop(5)  # pending changes are written
+    eq_(ix.applied[1:], [{'C': u'3'}])
+    eq_(qix.batches, 1)
+
+
+def test_queued_index_retry_and_optimize():
+    ix = RecordingIndex(failures=2)
+    qix = search.QueuedIndex(ix, latency=0.01, optimize_interval=0.01)
+    with patch.object(qix, 'logger') as logger:
+        qix.start()
+        search.update(qix, 'A', u'1')
+        assert qix.wait(5)
+        eq_(ix.applied, [{'A': u'1'}])
+        eq_(logger.exception.call_count, 2)
+        assert ix.optimized.wait(5)
+        qix.stop(5)
+
+
+def test_queued_whoosh_index():
+    tmpdir = tempfile.mkdtemp(prefix='neorg-test-')
+    try:
+        qix = search.QueuedIndex(search.get_index(tmpdir), latency=10)
+        qix.start()
+        search.update(qix, 'Apple', u'apple')
+        search.update(qix, 'Banana', u'banana')
+        assert qix.wait(5)
+        search.delete(qix, 'Banana')
+        qix.stop(5)
+        eq_([p for (p, _) in search.search(qix, u'apple OR banana')],
+            ['Apple'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_shared_whoosh_searcher():
+    tmpdir = tempfile.mkdtemp(prefix='neorg-test-')
+    try:
+        ix = search.get_index(tmpdir)
+        search.update(ix, 'Apple', u'apple')
+        eq_(len(search.search(ix, u'apple')), 1)
+        searcher = ix._searcher
+        generation = ix.generation
+        eq_(len(search.search(ix, u'apple')), 1)
+        assert ix._searcher is searcher  # reused
+        search.update(ix, 'Apple2', u'apple')
+        assert ix.generation != generation
+        eq_(len(search.search(ix, u'apple')), 2)  # refreshed
+        assert ix._searcher is not searcher
+
+        errors = []
+
+        def run():
+            try:
+                for i in range(20):
+                    eq_(len(search.search(ix, u'apple')), 2)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        search.update(ix, 'Banana', u'banana')  # refresh while searching
+        for t in threads:
+            t.join()
+        eq_(errors, [])
+        ix.close()
+    finally:
+        shutil.rmtree(tmpdir)
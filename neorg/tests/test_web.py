@@ -14,8 +14,11 @@ import os
 import re
 import tempfile
 import shutil
+from contextlib import closing
 import urllib
-from nose.tools import raises, assert_raises
+from StringIO import StringIO
+from mock import patch
+from nose.tools import raises, assert_raises, eq_
 
 from neorg import web
 from neorg.config import DefaultConfig, set_config
@@ -43,11 +46,12 @@ def urljoin(a, *p):
     return path
 
 
-def setup_app():
+def setup_app(config={}):
     web.app.config.from_object(DefaultConfig)
     (db_fd, web.app.config['DATABASE']) = tempfile.mkstemp(prefix=TMP_PREFIX)
     dirpath = tempfile.mkdtemp(prefix=TMP_PREFIX)  # = NEORG_ROOT
     set_config(web.app.config, dirpath)
+    web.app.config.update(config)
     os.mkdir(web.app.config['NEORG_DIR'])
     web.app.config['SECRET_KEY'] = 'key for testing'
     app = web.app.test_client()
@@ -64,26 +68,33 @@ def setup_app():
 
 
 def teardown_app():
-    os.remove(web.app.config['DATABASE'])
+    web.close_pooled_db()
+    web.close_whoosh_index()
+    web._search_cache.clear()  # cached results of the other index
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(web.app.config['DATABASE'] + suffix):
+            os.remove(web.app.config['DATABASE'] + suffix)
     shutil.rmtree(web.app.config['NEORG_ROOT'])
 
 
 class TestNEOrgWebSlow(object):
+    config = {}
 
     def setUp(self):
         """Before each test, set up a blank database"""
-        (self.app, self.db_fd, self.gene_html) = setup_app()
+        (self.app, self.db_fd, self.gene_html) = setup_app(self.config)
 
     def tearDown(self):
         teardown_app()
 
 
 class TestNEOrgWebFast(object):
+    config = {}
 
     @classmethod
     def setUpClass(cls):
         """Set up a blank database for all test"""
-        (cls.app, cls.db_fd, gene_html) = setup_app()
+        (cls.app, cls.db_fd, gene_html) = setup_app(cls.config)
         cls.gene_html = staticmethod(gene_html)
 
     @classmethod
@@ -255,6 +266,44 @@ class TestNEOrgWeb(TestNEOrgWebBase):
             page_path = urljoin(page_root, page_relpath)
             yield (self.check_history, page_path, page_text)
 
+    def test_history_pagination(self):
+        page_path = 'TestHistPagination'
+        for i in range(5):
+            self.check_save(page_path, '\n'.join(['line'] * (i + 1)))
+        response = self.app.get(page_path + '/_history?num=2')
+        eq_(len(re.findall('_old/[0-9]*">', response.data)), 2)
+        assert '+1 -0 lines' in response.data
+        older = re.findall('before=([0-9]+)', response.data)
+        eq_(len(older), 1)
+        response = self.app.get(
+            page_path + '/_history?num=2&before=' + older[0])
+        eq_(len(re.findall('_old/[0-9]*">', response.data)), 2)
+        response = self.app.get(
+            page_path + '/_history?num=3&before=' + older[0])
+        assert 'created' in response.data
+        assert 'before=' not in response.data
+
+    def test_history_num_clipped(self):
+        page_path = 'TestHistNum'
+        for i in range(3):
+            self.check_save(page_path, 'text %d' % i)
+        for num in ['0', '-1']:
+            response = self.app.get(page_path + '/_history?num=' + num)
+            eq_(response.status_code, 200)
+            eq_(len(re.findall('_old/[0-9]*">', response.data)), 1)
+        response = self.app.get(page_path + '/_history?num=100000')
+        eq_(len(re.findall('_old/[0-9]*">', response.data)), 3)
+
+    def test_history_size_without_summary(self):
+        page_path = 'TestHistSize'
+        self.check_save(page_path, 'migrated text')
+        with closing(web.connect_db()) as db:
+            db.execute('update page_history set summary = null '
+                       'where page_path = ?', [page_path])
+            db.commit()
+        response = self.app.get(page_path + '/_history')
+        assert '(13 characters)' in response.data
+
     def check_old(self, page_path, page_text, num_update=5):
         (hist_response, page_text_history,
          ) = self.check_history(page_path, page_text, num_update)
@@ -318,6 +367,79 @@ class TestNEOrgWeb(TestNEOrgWebBase):
             for num in range(1, num_max + 1):
                 yield (self.check_temp, page_path, page_text, num)
 
+    def test_temp_index(self):
+        temp_path = 'TestTempIndex/_temp_'
+        self.check_save(temp_path, 'generated from {{ args[0] }}')
+        response = self.app.get('/TestTempIndex/abc/')
+        assert 'generated from abc' in response.data
+        self.check_save('TestTempIndex/_temp_/_temp_', 'deeper')
+        response = self.app.get('/TestTempIndex/abc/')
+        assert 'generated from abc' in response.data
+        response = self.app.post(urljoin('/', temp_path, '_delete'),
+                                 data={'yes': 'Yes'})
+        response = self.app.get('/TestTempIndex/abc/')
+        assert 'generated from abc' not in response.data
+
+    def test_temp_cache(self):
+        self.check_save('TestTempCache/_temp_', 'generated from {{ args[0] }}')
+        with patch.object(web, 'gene_html', side_effect=web.gene_html) as gh:
+            for dummy in range(2):
+                response = self.app.get('/TestTempCache/abc/')
+                assert 'generated from abc' in response.data
+            eq_(gh.call_count, 1)  # second one is from the render cache
+            response = self.app.get('/TestTempCache/xyz/')
+            assert 'generated from xyz' in response.data
+            eq_(gh.call_count, 2)
+        self.check_save('TestTempCache/_temp_', 'changed {{ args[0] }}')
+        response = self.app.get('/TestTempCache/abc/')
+        assert 'changed abc' in response.data
+
+    def test_temp_dependency(self):
+        import json
+        dirpath = os.path.join(web.app.config['DATADIRPATH'], 'TestTempDep')
+        os.mkdir(dirpath)
+        datapath = os.path.join(dirpath, 'data.json')
+        with open(datapath, 'w') as f:
+            json.dump({'value': 'temp-value'}, f)
+        self.check_save('TestTempDep/_temp_', trim("""
+        .. table-data:: TestTempDep/{{ args[0] }}.json
+           :data: value
+        """))
+        eq_(web.find_affected_pages(datapath), [])
+        response = self.app.get('/TestTempDep/data/')
+        assert 'temp-value' in response.data
+        eq_(web.find_affected_pages(datapath), ['TestTempDep/data'])
+
+        # generated pages can be pre-rendered
+        web.get_render_cache().clear()
+        with web.app.test_request_context():
+            web.g.db = web.connect_db()
+            try:
+                web.prerender_page(u'TestTempDep/data')
+            finally:
+                web.g.db.close()
+        with patch.object(web, 'gene_html') as gh:
+            response = self.app.get('/TestTempDep/data/')
+        eq_(gh.call_count, 0)
+        assert 'temp-value' in response.data
+
+    def test_pooled_db(self):
+        web.close_pooled_db()
+        with patch.object(web, 'connect_db',
+                          side_effect=web.connect_db) as connect:
+            self.app.get('/static/style.css')
+            eq_(connect.call_count, 0)  # static files do not use DB
+            for dummy in range(2):
+                response = self.app.get('/_recent_changes')
+                assert 'Recent Changes' in response.data
+            eq_(connect.call_count, 1)  # connection is reused
+            web.close_pooled_db()
+            self.app.get('/_recent_changes')
+            eq_(connect.call_count, 2)  # closed connection is not reused
+        (journal_mode,) = web.get_pooled_db().execute(
+            'pragma journal_mode').fetchone()
+        eq_(journal_mode, 'wal')
+
     def test_no_fail_page(self):
 
         def gene_page_with_error(debug):
@@ -399,6 +521,434 @@ class TestNEOrgWeb(TestNEOrgWebBase):
                       self.assert_page_path_in_search_result,
                       page_path, response)  # no match
 
+    def test_search_indexer(self):
+        self.check_save('TestSearchIndexer', 'indexed_by_request')
+        # pages saved by the request are already indexed
+        eq_(web.update_search_index(), 0)
+        assert web.update_search_index() is None  # nothing changed
+        eq_(web.update_search_index(force=True), 0)
+
+        # a page changed while the server is not running
+        with closing(web.connect_db()) as db:
+            db.execute("update pages set page_text = 'indexed_by_indexer' "
+                       "where page_path = 'TestSearchIndexer'")
+            db.execute("insert into page_history (page_path, page_text) "
+                       "values ('TestSearchIndexer', 'indexed_by_indexer')")
+            db.commit()
+        with patch.object(web, '_search_indexer', None):
+            indexer = web.start_search_indexer()
+            indexer.join()
+            assert not web.search_index_catching_up()
+            assert indexer.finished
+            eq_(indexer.updated, 1)
+            self.assert_page_path_in_search_result(
+                'TestSearchIndexer',
+                self.get_search_response('indexed_by_indexer'))
+
+            self.check_save('TestSearchIndexer', 'saved_after_indexer')
+            web.mark_search_index_synced()  # at shutdown
+            assert web.update_search_index() is None
+
+    def test_rebuild_search_index(self):
+        self.check_save('TestRebuildSearchIndex', 'rebuilt_keyword')
+        with closing(web.connect_db()) as db:
+            (total,) = db.execute('select count(*) from pages').fetchone()
+        calls = []
+        eq_(web.rebuild_search_index(
+            batch_size=1, progress=lambda *args: calls.append(args)), total)
+        eq_(calls, [(i, total) for i in range(1, total + 1)])
+        assert web.update_search_index() is None  # marker is set
+        self.assert_page_path_in_search_result(
+            'TestRebuildSearchIndex',
+            self.get_search_response('rebuilt_keyword'))
+
+    def test_search_indexer_race(self):
+        saved_path = 'TestSearchIndexerRace/Saved'
+        deleted_path = 'TestSearchIndexerRace/Deleted'
+        self.check_save(saved_path, 'old_race_keyword')
+        self.check_save(deleted_path, 'deleted_race_keyword')
+        update_all = web.search.update_all
+        changed = []
+
+        def change_and_update_all(ix, doc_list):
+            # the pages are changed after the pass read the old text
+            if not changed:
+                changed.append(True)
+                self.check_save(saved_path, 'new_race_keyword')
+                self.app.post(urljoin('/', deleted_path, '_delete'),
+                              data={'yes': 'Yes'})
+            return update_all(ix, doc_list)
+
+        with patch.object(web.search, 'update_all', change_and_update_all):
+            web.update_search_index(force=True)
+        assert changed
+        self.assert_page_path_in_search_result(
+            saved_path, self.get_search_response('new_race_keyword'))
+        for (page_path, query) in [(saved_path, 'old_race_keyword'),
+                                   (deleted_path, 'deleted_race_keyword')]:
+            assert_raises(AssertionError,
+                          self.assert_page_path_in_search_result,
+                          page_path, self.get_search_response(query))
+
+    def test_search_catching_up(self):
+        with patch.object(web, 'search_index_catching_up',
+                          return_value=True):
+            response = self.get_search_response('query')
+        assert 'Search index is catching up.' in response.data
+        response = self.get_search_response('query')
+        assert 'Search index is catching up.' not in response.data
+
+    def test_search_cache(self):
+        import json
+        self.check_save('TestSearchCache', 'cached_keyword')
+        with patch.dict(web.app.config, SEARCHCACHE_SIZE=1):
+            cache = web.get_search_cache()
+            cache.clear()
+            for query in ['cached_keyword', ' cached_keyword ']:
+                self.assert_page_path_in_search_result(
+                    'TestSearchCache', self.get_search_response(query))
+            eq_((cache.hits, cache.misses), (1, 1))
+            # saving a page changes the index generation
+            self.check_save('TestSearchCache/Sub', 'cached_keyword')
+            response = self.get_search_response('cached_keyword')
+            self.assert_page_path_in_search_result(
+                'TestSearchCache/Sub', response)
+            eq_((cache.hits, cache.misses), (1, 2))
+            stats = json.loads(self.app.get('/_cache_stats').data)
+            eq_(stats['search']['hits'], 1)
+            eq_(stats['search']['misses'], 2)
+            eq_(stats['search']['evictions'], 1)
+
+    def test_shared_search_index(self):
+        assert web.get_search_index() is web.get_search_index()
+
+    def test_search_writer(self):
+        with patch.object(web, '_search_writer', None):
+            writer = web.start_search_writer()
+            assert web.get_search_index() is writer
+            self.check_save('TestSearchWriter', 'queued_keyword')
+            assert writer.wait(5)
+            self.assert_page_path_in_search_result(
+                'TestSearchWriter', self.get_search_response('queued_keyword'))
+            web.stop_search_writer()
+            assert web._search_writer is None
+
+    def test_search_pagination(self):
+        for i in range(3):
+            self.check_save('TestSearchPagination/%d' % i,
+                            'paginated_keyword %d' % i)
+        with patch.dict(web.app.config, SEARCH_PAGELEN=2):
+            response = self.get_search_response('paginated_keyword')
+            assert '3 pages found.' in response.data
+            assert 'Page 1 of 2' in response.data
+            assert response.data.count('<h2>') == 2
+            assert re.search('<a href="[^"]*page=2[^"]*">Next</a>',
+                             response.data)
+            assert 'Previous' not in response.data
+            response = self.app.get('/_search?q=paginated_keyword&page=2')
+            assert 'Page 2 of 2' in response.data
+            assert response.data.count('<h2>') == 1
+            assert 'Previous' in response.data
+            assert 'Next' not in response.data
+
+    def test_render_cache(self):
+        page_path = 'TestRenderCache'
+        page_text = 'this page should be cached'
+        (response, page_html) = self.check_save(page_path, page_text)
+        rcache = web.get_render_cache()
+        key = web.page_cache_key(page_text, page_path)
+        assert rcache.get(page_path, key) == page_html.decode('utf-8')
+
+        # saving the page removes the cache
+        self.check_save(page_path, 'new page text')
+        assert rcache.get(page_path, key) is None
+
+    def test_render_cache_list_pages(self):
+        page_path = 'TestRenderCacheListPages'
+        self.app.post(urljoin('/', page_path, '_save'), data={
+            'save': 'Save',
+            'page_text': '.. list-pages::',
+            })
+        self.check_save(page_path + '/SubPage1', 'sub-page 1')
+        response = self.app.get(page_path + '/')
+        assert './SubPage1' in response.data
+        # saving another page must update the list
+        self.check_save(page_path + '/SubPage2', 'sub-page 2')
+        response = self.app.get(page_path + '/')
+        assert './SubPage2' in response.data
+
+    def test_render_cache_data_files(self):
+        import json
+        page_path = 'TestRenderCacheDataFiles'
+        datadir = web.app.config['DATADIRPATH']
+        dirpath = os.path.join(datadir, page_path)
+        os.mkdir(dirpath)
+
+        def write_data(name, data):
+            with open(os.path.join(dirpath, name), 'w') as f:
+                json.dump(data, f)
+        write_data('data_1.json', {'value': 'first-value'})
+
+        self.app.post(urljoin('/', page_path, '_save'), data={
+            'save': 'Save',
+            'page_text': trim("""
+            .. table-data:: {0}/data_*.json
+               :data: value
+            """.format(page_path)),
+            })
+        response = self.app.get(page_path + '/')
+        assert 'first-value' in response.data
+
+        # modified file
+        write_data('data_1.json', {'value': 'modified-value'})
+        response = self.app.get(page_path + '/')
+        assert 'first-value' not in response.data
+        assert 'modified-value' in response.data
+
+        # new file
+        write_data('data_2.json', {'value': 'new-value'})
+        response = self.app.get(page_path + '/')
+        assert 'new-value' in response.data
+
+        eq_(web.find_affected_pages(os.path.join(dirpath, 'data_1.json')),
+            [page_path])
+        eq_(web.find_affected_pages(os.path.join(dirpath, 'data_3.json')),
+            [page_path])  # matches to the glob pattern
+        eq_(web.find_affected_pages(os.path.join(dirpath, 'other.txt')),
+            [])
+        eq_(web.find_affected_pages(
+            os.path.join(dirpath, 'sub', 'data_1.json')),
+            [])  # `*` does not match to the directory separator
+
+    def test_render_cache_check_ttl(self):
+        import json
+        page_path = 'TestRenderCacheCheckTTL'
+        dirpath = os.path.join(web.app.config['DATADIRPATH'], page_path)
+        os.mkdir(dirpath)
+
+        def write_data(value):
+            with open(os.path.join(dirpath, 'data.json'), 'w') as f:
+                json.dump({'value': value}, f)
+        write_data('first-value')
+        self.check_save(page_path, trim("""
+        .. table-data:: {0}/data.json
+           :data: value
+        """.format(page_path)))
+        response = self.app.get(page_path + '/')  # checked and fresh
+        assert 'first-value' in response.data
+
+        write_data('modified-value-with-another-size')
+        with patch.dict(web.app.config, RENDERCACHE_CHECK_TTL=3600):
+            response = self.app.get(page_path + '/')
+            assert 'first-value' in response.data  # not checked yet
+        with patch.dict(web.app.config, RENDERCACHE_CHECK_TTL=0):
+            response = self.app.get(page_path + '/')
+            assert 'modified-value-with-another-size' in response.data
+
+    def test_render_budget(self):
+        import json
+        page_path = 'TestRenderBudget'
+        datadir = web.app.config['DATADIRPATH']
+        for i in range(3):
+            dirpath = os.path.join(datadir, page_path, str(i))
+            os.makedirs(dirpath)
+            with open(os.path.join(dirpath, 'data.json'), 'w') as f:
+                json.dump({'value': 'value-%d' % i}, f)
+        page_text = trim("""
+        .. table-data:: {0}/*/data.json
+           :data: value
+        """.format(page_path))
+        web.app.config['RENDER_MAX_LOADED'] = 2
+        try:
+            self.app.post(urljoin('/', page_path, '_save'), data={
+                'save': 'Save',
+                'page_text': page_text,
+                })
+            response = self.app.get(page_path + '/')
+        finally:
+            web.app.config['RENDER_MAX_LOADED'] = \
+                DefaultConfig.RENDER_MAX_LOADED
+        assert 'value-1' in response.data
+        assert 'value-2' not in response.data
+        assert 'Render budget ran out' in response.data
+        # truncated page is not cached
+        key = web.page_cache_key(page_text, page_path)
+        assert web.get_render_cache().get(page_path, key) is None
+        response = self.app.get(page_path + '/')
+        assert 'value-2' in response.data
+
+    def test_deferred_rendering(self):
+        import json
+        page_path = 'TestDeferredRendering'
+        datadir = web.app.config['DATADIRPATH']
+        dirpath = os.path.join(datadir, page_path)
+        os.mkdir(dirpath)
+        with open(os.path.join(dirpath, 'data.json'), 'w') as f:
+            json.dump({'value': 'deferred-value'}, f)
+        page_text = trim("""
+        Text of the page.
+
+        .. table-data:: {0}/data.json
+           :data: value
+        """.format(page_path))
+        web.app.config['DEFERRED_RENDERING'] = True
+        try:
+            self.app.post(urljoin('/', page_path, '_save'), data={
+                'save': 'Save',
+                'page_text': page_text,
+                })
+            response = self.app.get(page_path + '/')
+            assert 'Text of the page.' in response.data
+            assert 'deferred-value' not in response.data
+            assert 'data-neorg-fragment="_fragment/0"' in response.data
+            datapath = os.path.join(dirpath, 'data.json')
+            eq_(web.find_affected_pages(datapath), [])
+
+            response = self.app.get(urljoin(page_path, '_fragment/0'))
+            assert 'deferred-value' in response.data
+            # dependency of the fragment is recorded
+            eq_(web.find_affected_pages(datapath), [page_path])
+            assert 'Text of the page.' not in response.data
+            response = self.app.get(urljoin(page_path, '_fragment/1'))
+            eq_(response.status_code, 404)
+
+            # fully rendered HTML is used if it is cached
+            web.gene_html_cached(page_text, page_path)
+            response = self.app.get(page_path + '/')
+            assert 'deferred-value' in response.data
+
+            # pre-rendering the page refreshes the dependency of the
+            # fragment as well
+            web.app.config['RENDERCACHE_CHECK_TTL'] = 0
+            with open(datapath, 'w') as f:
+                json.dump({'value': 'modified-deferred-value'}, f)
+            assert page_path in web.stale_pages()
+            with web.app.test_request_context():
+                web.g.db = web.connect_db()
+                web.prerender_page(page_path)
+                web.g.db.close()
+            assert page_path not in web.stale_pages()
+            eq_(web.find_affected_pages(datapath), [page_path])
+        finally:
+            web.app.config['DEFERRED_RENDERING'] = False
+            web.app.config['RENDERCACHE_CHECK_TTL'] = \
+                DefaultConfig.RENDERCACHE_CHECK_TTL
+
+    def test_prerender_order(self):
+        for page_path in ['PreRenderA', 'PreRenderB', 'PreRenderC']:
+            self.check_save(page_path, 'text of ' + page_path)
+        with web.app.test_request_context():
+            web.g.db = web.connect_db()
+            for (page_path, updated) in [('PreRenderA', '2000-01-01'),
+                                         ('PreRenderB', '2000-01-02'),
+                                         ('PreRenderC', '2000-01-03')]:
+                web.g.db.execute(
+                    'update pages set updated = ? '
+                    'where page_path = ?', [updated, page_path])
+            web.g.db.commit()
+            self.app.get('PreRenderA/')
+            page_path_list = [p for p in web.prerender_order()
+                              if p.startswith('PreRender')]
+            web.g.db.close()
+        eq_(page_path_list, ['PreRenderA', 'PreRenderC', 'PreRenderB'])
+
+    def test_prerender_schedule(self):
+        worker = web.PreRenderWorker()
+        worker.schedule(['B', 'A', 'B'])
+        worker.schedule(['C', 'A'])
+        worker._busy = False
+        eq_([worker._pop() for _ in range(3)], ['B', 'A', 'C'])
+
+    def test_render_cache_access_counts(self):
+        rcache = web.get_render_cache()
+        self.check_save('TestAccessCounts', 'text')
+        before = rcache.access_counts()['TestAccessCounts']
+        for _ in range(3):
+            self.app.get('TestAccessCounts/')
+        # counted in memory and written at once
+        assert rcache._pending_counts
+        eq_(rcache.access_counts()['TestAccessCounts'], before + 3)
+        eq_(rcache._pending_counts, {})
+
+    def test_prerender_worker(self):
+        import json
+        import time
+        page_path = 'TestPreRenderWorker'
+        datadir = web.app.config['DATADIRPATH']
+        dirpath = os.path.join(datadir, page_path)
+        os.mkdir(dirpath)
+
+        def write_data(data):
+            with open(os.path.join(dirpath, 'data.json'), 'w') as f:
+                json.dump(data, f)
+        write_data({'value': 'first-value'})
+        page_text = trim("""
+        .. table-data:: {0}/data.json
+           :data: value
+        """.format(page_path))
+        self.app.post(urljoin('/', page_path, '_save'), data={
+            'save': 'Save',
+            'page_text': page_text,
+            })
+        rcache = web.get_render_cache()
+        rcache.clear()
+        key = web.page_cache_key(page_text, page_path)
+
+        def cached_html():
+            return rcache.get(page_path, key) or ''
+
+        worker = web.PreRenderWorker(throttle=0, interval=0.05)
+        web._prerender_worker = worker
+        try:
+            worker.start()
+            assert worker.wait(timeout=10)
+            assert 'first-value' in cached_html()
+
+            # saved page is rendered again
+            self.check_save(page_path, page_text + '\nnew paragraph')
+            assert worker.wait(timeout=10)
+            key = web.page_cache_key(page_text + '\nnew paragraph',
+                                     page_path)
+            assert 'new paragraph' in cached_html()
+
+            # modified data file is detected
+            write_data({'value': 'modified-value'})
+            deadline = time.time() + 10
+            while ('modified-value' not in cached_html() and
+                   time.time() < deadline):
+                time.sleep(0.05)
+            assert 'modified-value' in cached_html()
+        finally:
+            web.stop_prerender_worker()
+        assert web._live_requests.count == 0
+
+    def test_recent_pages(self):
+        for page_path in ['TestRecent/A', 'TestRecent/B', 'TestOther']:
+            self.check_save(page_path, 'text of ' + page_path)
+        with web.app.test_request_context():
+            web.g.db = web.connect_db()
+            for (page_path, updated) in [('TestRecent/A', '2000-01-03'),
+                                         ('TestRecent/B', '2000-01-02')]:
+                web.g.db.execute(
+                    'update pages set updated = ? where page_path = ?',
+                    [updated, page_path])
+            web.g.db.commit()
+            eq_(web.recent_pages('TestRecent', 10),
+                [('2000-01-03', 'A'), ('2000-01-02', 'B')])
+            eq_(web.recent_pages('TestRecent', 1), [('2000-01-03', 'A')])
+            eq_(web.recent_pages('', 1)[0][1], 'TestOther')
+        self.check_save('TestRecent', '.. recent-pages::',
+                        'Recently Updated Pages')
+        response = self.app.get('/TestRecent/')
+        assert response.data.index('./A') < response.data.index('./B')
+        response = self.app.get('/_recent_changes')
+        assert (response.data.index('TestOther') <
+                response.data.index('TestRecent/B'))
+        response = self.app.get('/_recent_changes?num=-1')
+        eq_(len(re.findall('_old/[0-9]+', response.data)), 1)  # clipped
+        response = self.app.get('/_recent_changes?num=100000')
+        eq_(response.status_code, 200)
+
     def test_jump_to_descendants(self):
         page_path = 'TestJumpToDesc/SubPage'
         self.check_save(page_path, 'subpage exists')
@@ -413,6 +963,79 @@ class TestNEOrgWeb(TestNEOrgWebBase):
         assert (response.location ==
                 "http://localhost/TestJumpToDesc/NoSubPage/_edit")
 
+        # the page path index is updated when the sub-page is deleted
+        self.app.post('TestJumpToDesc/SubPage/_delete', data={'yes': 'Yes'})
+        response = self.app.get('TestJumpToDesc/')
+        assert (response.location ==
+                "http://localhost/TestJumpToDesc/_edit")
+
+
+class TestNEOrgWebFTS(TestNEOrgWebBase):
+    """
+    Run the search tests of `TestNEOrgWeb` with the FTS5 backend
+    """
+    config = {'SEARCH_BACKEND': 'fts5'}
+    num_test = TestNEOrgWeb.num_test
+    gene_page_paths = TestNEOrgWeb.__dict__['gene_page_paths']
+    gene_page_texts = TestNEOrgWeb.__dict__['gene_page_texts']
+    gene_pages = TestNEOrgWeb.__dict__['gene_pages']
+    check_save = TestNEOrgWeb.__dict__['check_save']
+    check_delete_yes = TestNEOrgWeb.__dict__['check_delete_yes']
+    get_search_response = TestNEOrgWeb.__dict__['get_search_response']
+    assert_page_path_in_search_result = \
+        TestNEOrgWeb.__dict__['assert_page_path_in_search_result']
+    check_search_match = TestNEOrgWeb.__dict__['check_search_match']
+    check_search_no_match = TestNEOrgWeb.__dict__['check_search_no_match']
+    test_search = TestNEOrgWeb.__dict__['test_search']
+    test_search_deleted = TestNEOrgWeb.__dict__['test_search_deleted']
+    test_search_indexer_race = \
+        TestNEOrgWeb.__dict__['test_search_indexer_race']
+
+    def test_search_highlight(self):
+        self.check_save('TestSearchHighlight',
+                        'escape <this> & highlight the keyword')
+        response = self.get_search_response('keyword')
+        assert ('escape &lt;this&gt; &amp; highlight the '
+                '<b class="match">keyword</b>' in response.data)
+
+    def test_search_rollback(self):
+        from neorg.search import get_index, search, update
+
+        def update_and_fail(*args):
+            update(*args)
+            raise RuntimeError
+
+        # the index is updated in the same transaction as the page
+        with patch.object(web.search, 'update', update_and_fail):
+            with CaptureStdIO():
+                self.app.post('/TestSearchRollback/_save', data={
+                    'save': 'Save', 'page_text': 'rollback_keyword'})
+        with closing(web.connect_db()) as db:
+            eq_(db.execute('select count(*) from pages').fetchone(), (0,))
+            eq_(list(search(get_index(backend='fts5', db=db),
+                            'rollback_keyword')), [])
+
+
+class TestNEOrgWebSearchAfterCommit(TestNEOrgWebSlow):
+
+    def test_search_after_commit(self):
+        from neorg.search import update
+
+        def update_and_check(ix, page_path, page_text):
+            # the page is already committed when the index is written
+            with closing(web.connect_db()) as db:
+                eq_(db.execute('select page_text from pages '
+                               'where page_path = ?', [page_path]).fetchall(),
+                    [(page_text,)])
+            called.append(page_path)
+            return update(ix, page_path, page_text)
+
+        called = []
+        with patch.object(web.search, 'update', update_and_check):
+            self.app.post('/TestSearchAfterCommit/_save', data={
+                'save': 'Save', 'page_text': 'committed_keyword'})
+        eq_(called, ['TestSearchAfterCommit'])
+
 
 class TestNEOrgWebWithEmptyDB(TestNEOrgWebSlow):
 
@@ -459,6 +1082,45 @@ class TestNEOrgWebWithEmptyDB(TestNEOrgWebSlow):
         # DB has not been changed
         self.test_system_info()
 
+    def test_upgrade_db(self):
+        from neorg.web import connect_db, upgrade_db
+        with closing(connect_db()) as db:
+            db.executescript("""
+            drop table pages;
+            create table pages (
+              page_path string primary key,
+              page_text string not null
+            );
+            drop table page_history;
+            create table page_history (
+              history_id integer primary key autoincrement,
+              page_path string not null,
+              page_text string not null,
+              page_exists integer not null default 1,
+              updated timestamp default current_timestamp
+            );
+            insert into pages values ('Old', 'old page');
+            insert into page_history (page_path, page_text, updated)
+            values ('Old', 'old page', '2000-01-01');
+            delete from migration;
+            """)
+            stream = StringIO()
+            assert upgrade_db(db, stream)
+            # the history is not rewritten at the startup of the server
+            assert 'Compress the page history' not in stream.getvalue()
+            eq_(db.execute('select encoding from page_history').fetchall(),
+                [(None,)])
+            assert upgrade_db(db, stream, offline=True)
+            assert 'Compress the page history: done' in stream.getvalue()
+            assert not upgrade_db(db, stream, offline=True)  # nothing happens
+            eq_(db.execute('select updated from pages').fetchall(),
+                [('2000-01-01',)])
+            eq_(db.execute('select text_size from page_history').fetchall(),
+                [(8,)])
+            eq_(db.execute('select encoding from page_history').fetchall(),
+                [('zlib',)])
+            eq_(web.revisions.load_revision(db, 1), 'old page')
+
     def test_empty_db(self):
         response = self.app.get('/')
         assert response.location == "http://localhost/_edit"
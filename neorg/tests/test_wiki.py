@@ -1,12 +1,21 @@
 import os
+import json
+import shutil
+import tempfile
+import threading
 from glob import glob
 from itertools import product
+from multiprocessing.pool import ThreadPool
 from docutils import nodes, utils
 from cgi import escape
 from mock import Mock
 from nose.tools import eq_, assert_raises
 
-from neorg.wiki import setup_wiki, gene_html
+from neorg.wiki import (setup_wiki, gene_html, glob_list, DataDependency,
+                        RenderBudget, RenderEngine, Reader, Writer,
+                        SAFE_DOCUTILS)
+from neorg.data import DictTable
+from neorg.cache import LRUCache
 from neorg.tests.utils import (MockWeb, MockDictTable, CheckData, trim,
                                CaptureStdIO)
 
@@ -159,6 +168,34 @@ class TestPagePathInlineMarkup(CheckData):
                    "link '%s' should NOT be in `page_html`" % l
 
 
+def test_page_path_many_links():
+    # this used to hit the recursion limit
+    setup_wiki(web=object(), DictTable=object())
+    links = ['/page/%d/' % i for i in range(3000)]
+    page_html = gene_html(' '.join(links), _debug=True)
+    for l in links:
+        assert 'href="%(link)s">%(link)s</a>' % {'link': l} in page_html
+
+
+def test_adhoc_inline_markup_rules():
+    from neorg.wiki import AdHocInlineMarkup
+
+    def convert_todo(text):
+        (pre, todo, post) = text.partition('TODO')
+        return [nodes.Text(pre), nodes.strong(todo, todo), nodes.Text(post)]
+
+    setup_wiki(web=object(), DictTable=object())
+    rules = AdHocInlineMarkup.cond_conv_list
+    AdHocInlineMarkup.cond_conv_list = rules + [
+        (lambda nd: 'TODO' in nd, convert_todo)]
+    try:
+        page_html = gene_html('TODO: see /a/page/ TODO', _debug=True)
+    finally:
+        AdHocInlineMarkup.cond_conv_list = rules
+    assert '<strong>TODO</strong>: see ' in page_html
+    assert 'href="/a/page/">/a/page/</a>' in page_html
+
+
 class TestTableData(CheckData):
     data_file_tree_1 = {
         'ex/data_1/file.pickle': {'a': 1, 'b': 0},
@@ -504,6 +541,294 @@ class TestConvTexts(CheckData):
                       })
 
 
+class TestRenderEngine(CheckData):
+
+    # RenderEngine must be equivalent to publish_parts
+    data = TestConvTexts.data
+
+    def check(self, path):
+        from docutils.core import publish_parts
+        text = file(os.path.join(TestConvTexts.textdir, path)).read()
+
+        def overrides():
+            return dict(SAFE_DOCUTILS,
+                        report_level=4,
+                        neorg_page_path=None,
+                        neorg_dependency=DataDependency())
+        desired = publish_parts(text, writer=Writer(), reader=Reader(),
+                                settings_overrides=overrides())['html_body']
+        engine = RenderEngine()
+        for dummy in range(2):  # reused reader/writer gives same result
+            eq_(engine.publish(text, overrides()), desired)
+
+
+class TestIncrementalRenderer(CheckData):
+
+    # incremental rendering must be equivalent to gene_html
+    data = TestConvTexts.data
+
+    def check(self, path):
+        from neorg.wiki import gene_html_incremental, split_blocks
+        from neorg.cache import LRUCache
+        text = file(os.path.join(TestConvTexts.textdir, path)).read()
+        eq_(''.join(split_blocks(text)), text)
+        setup_wiki(web=MockWeb(), DictTable=object())
+        desired = gene_html(text, 'page', _debug=True)
+        cache = LRUCache(10000)
+        for dummy in range(2):  # second time uses the cached blocks
+            eq_(gene_html_incremental(text, 'page', cache=cache,
+                                      _debug=True),
+                desired)
+
+
+def test_incremental_rendering():
+    from neorg.wiki import gene_html_incremental
+    from neorg.cache import LRUCache
+    page_text = trim("""
+    Section
+    =======
+
+    Paragraph with a /link/.
+
+    * list
+    * items
+
+    .. list-pages::
+
+    Another section
+    ===============
+
+    Last paragraph.
+    """)
+    web = MockWeb(list_descendants=['sub1', 'sub2'])
+    setup_wiki(web=web, DictTable=object())
+    cache = LRUCache(100)
+    eq_(gene_html_incremental(page_text, 'page', cache=cache, _debug=True),
+        gene_html(page_text, 'page', _debug=True))
+    misses = cache.misses
+    # only the edited block is rendered again
+    page_text = page_text.replace('Last paragraph.', 'Edited paragraph.')
+    web.list_descendants.return_value = ['sub1', 'sub3']
+    page_html = gene_html_incremental(page_text, 'page', cache=cache,
+                                      _debug=True)
+    eq_(page_html, gene_html(page_text, 'page', _debug=True))
+    eq_(cache.misses, misses + 1)
+    assert 'sub3' in page_html
+
+
+def test_render_engine_threads():
+    from threading import Thread
+    setup_wiki(web=object(), DictTable=object())
+    engine = RenderEngine()
+    texts = ['Page {0}\n{1}\n\n* item {0}\n* /link/{0}/\n'.format(
+        i, '=' * 10) for i in range(20)]
+    desired = [engine.publish(t, SAFE_DOCUTILS) for t in texts]
+    results = {}
+
+    def run(i):
+        results[i] = [engine.publish(t, SAFE_DOCUTILS) for t in texts]
+    threads = [Thread(target=run, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i in range(4):
+        eq_(results[i], desired)
+
+
+def test_data_dependency():
+    page_text = trim("""
+    .. table-data:: data*/file.pickle
+       :data: a
+    """)
+    page_path = 'it does not depend on the page_path'
+    file_tree = TestTableData.data_file_tree_1
+    web = MockWeb()
+    DictTable = MockDictTable.new_mock(file_tree)
+    glob_list = Mock(return_value=sorted(file_tree))
+    setup_wiki(web=web, DictTable=DictTable, glob_list=glob_list)
+    dependency = DataDependency()
+    gene_html(page_text, page_path, dependency=dependency, _debug=True)
+
+    datadir = web.app.config['DATADIRPATH']
+    eq_(dependency.globs,
+        [([os.path.join(datadir, 'data*/file.pickle')], sorted(file_tree))])
+    eq_(sorted(dependency.files), sorted(file_tree))
+    assert not dependency.pages
+    assert dependency.depends_on(
+        os.path.join(datadir, 'data_new/file.pickle'))
+    assert not dependency.depends_on(
+        os.path.join(datadir, 'data_new/another.pickle'))
+
+
+def test_data_dependency_pages():
+    web = MockWeb()
+    setup_wiki(web=web, DictTable=None, glob_list=None)
+    dependency = DataDependency()
+    gene_html('.. list-pages::', 'page', dependency=dependency, _debug=True)
+    assert dependency.pages
+    eq_(dependency.globs, [])
+
+
+class WithDataDir(object):
+    """
+    Base class of the tests using data files in a temporary directory
+    """
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp(prefix='neorg-tmp')
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+        setup_wiki(web=MockWeb())  # do not leave fragment_cache etc.
+
+    def write_data(self, relpath, data):
+        dirpath = os.path.join(self.datadir, os.path.dirname(relpath))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(self.datadir, relpath), 'w') as f:
+            json.dump(data, f)
+
+    def setup_wiki(self, **kwds):
+        kwds.setdefault('glob_list', glob_list)
+        setup_wiki(web=MockWeb(datadirpath=self.datadir), DictTable=DictTable,
+                   **kwds)
+
+
+class TestFragmentCache(WithDataDir):
+
+    def test(self):
+        self.write_data('a/data.json', {'x': 'value-a'})
+        self.write_data('b/data.json', {'x': 'value-b'})
+        page_text = '\n\n'.join([
+            dirtext('table-data', '', 'a/*.json', data='x'),
+            dirtext('table-data', '', 'b/*.json', data='x'),
+            ])
+        cache = LRUCache(1000)
+        self.setup_wiki(fragment_cache=cache)
+        page_html_1 = gene_html(page_text, 'page', _debug=True)
+        eq_((cache.hits, cache.misses), (0, 2))
+        page_html_2 = gene_html(page_text, 'page', _debug=True)
+        eq_((cache.hits, cache.misses), (2, 2))
+        eq_(page_html_1, page_html_2)
+
+        # only the modified one is re-computed
+        self.write_data('b/data.json', {'x': 'modified-value-b'})
+        page_html_3 = gene_html(page_text, 'page', _debug=True)
+        eq_((cache.hits, cache.misses), (3, 3))
+        assert 'value-a' in page_html_3
+        assert 'modified-value-b' in page_html_3
+
+
+class TestThreadPool(WithDataDir):
+
+    page_text = '\n\n'.join([
+        '/link/in/the/text/',
+        dirtext('table-data', '', 'd0/*/data.json', data='i x',
+                link='/%(path)s/'),
+        dirtext('table-data', '', 'd1/*/data.json', widths='1 2'),
+        dirtext('dictdiff', '', 'd2/*/data.json'),
+        dirtext('table-data-and-image', '', 'd*/x0/data.json',
+                data='i', image='image.png'),
+        dirtext('grid-images', '', 'd*/*/data.json',
+                param='i x', image='image.png'),
+        dirtext('find-images', '', 'd0/*/data.json'),
+        ])
+
+    def setUp(self):
+        super(TestThreadPool, self).setUp()
+        self.thread_names = set()
+        for (i, x) in product(range(3), range(2)):
+            self.write_data('d%d/x%d/data.json' % (i, x), {'i': i, 'x': x})
+
+    def recording_glob_list(self, *args):
+        self.thread_names.add(threading.current_thread().name)
+        return glob_list(*args)
+
+    def render(self, thread_pool):
+        self.setup_wiki(glob_list=self.recording_glob_list,
+                        thread_pool=thread_pool)
+        dependency = DataDependency()
+        with CaptureStdIO() as stdio:
+            page_html = gene_html(self.page_text, 'page',
+                                  dependency=dependency, _debug=True)
+        return (page_html, stdio.read_stderr(), dependency.to_json())
+
+    def test(self):
+        serial = self.render(None)
+        assert 'Too many widths' in serial[1]
+        assert self.thread_names == set([threading.current_thread().name])
+
+        self.thread_names.clear()
+        parallel = self.render(ThreadPool(3))
+        eq_(serial, parallel)
+        assert threading.current_thread().name not in self.thread_names
+
+
+class TestRenderBudget(WithDataDir):
+
+    page_text = '\n\n'.join([
+        dirtext('table-data', '', 'd*/data.json', data='value'),
+        dirtext('dictdiff', '', 'd*/data.json'),
+        ])
+
+    def setUp(self):
+        super(TestRenderBudget, self).setUp()
+        for i in range(5):
+            self.write_data('d%d/data.json' % i, {'value': 'value-%d' % i})
+        self.setup_wiki()
+
+    def render(self, **kwds):
+        budget = RenderBudget(**kwds)
+        with CaptureStdIO() as stdio:
+            page_html = gene_html(self.page_text, 'page', budget=budget,
+                                  _debug=True)
+        return (page_html, stdio.read_stderr(), budget)
+
+    def test(self):
+        (page_html, stderr, budget) = self.render()
+        eq_(page_html.count('value-'), 5 + 5)
+        eq_(stderr, '')
+        eq_(budget.exhausted, [])
+
+        # table-data is truncated and dictdiff is skipped
+        (page_html, stderr, budget) = self.render(max_globbed=3)
+        eq_(page_html.count('value-'), 3)
+        eq_(budget.exhausted, ['files globbed'])
+        assert 'Data is truncated' in stderr
+        assert 'Data is not loaded' in stderr
+
+        (page_html, stderr, budget) = self.render(max_loaded=7)
+        eq_(page_html.count('value-'), 5 + 2)
+        eq_((budget.globbed, budget.loaded), (10, 7))
+        assert 'Render budget ran out (files loaded)' in stderr
+
+        (page_html, stderr, budget) = self.render(max_time=-1)
+        eq_(page_html.count('value-'), 0)
+        eq_(budget.exhausted, ['wall time'])
+
+
+def test_deferred():
+    from neorg.wiki import find_deferred_fragments
+    page_text = trim("""
+    Some text.
+
+    .. table-data:: *.json
+       :data: a
+
+    * .. dictdiff:: *.json
+    """)
+    DictTable = Mock()  # data must not be loaded
+    setup_wiki(web=MockWeb(), DictTable=DictTable, glob_list=Mock())
+    page_html = gene_html(page_text, 'page', deferred=True, _debug=True)
+    assert 'Some text.' in page_html
+    assert 'data-neorg-fragment="_fragment/0"' in page_html
+    assert 'data-neorg-fragment="_fragment/1"' in page_html
+    assert not DictTable.from_path_list.called
+    eq_(find_deferred_fragments(page_text, 'page'),
+        ['.. table-data:: *.json\n   :data: a\n', '.. dictdiff:: *.json'])
+
+
 class CheckException(Exception):
     pass
 
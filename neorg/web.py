@@ -2,14 +2,22 @@
 from __future__ import with_statement
 import os
 import re
+import sys
+import time
+import threading
+from hashlib import md5
+from bisect import bisect_left
+from collections import OrderedDict
 from sqlite3 import dbapi2 as sqlite3
 from contextlib import closing
-from flask import (Flask, request, g, redirect, url_for,
-                   render_template, flash, send_from_directory)
+from flask import (Flask, request, g, redirect, url_for, abort,
+                   render_template, flash, send_from_directory, jsonify)
 import jinja2
 from neorg.config import DefaultConfig
-from neorg.wiki import gene_html, safecall
-from neorg import search
+from neorg.wiki import (gene_html, gene_html_incremental, safecall,
+                        DataDependency, RenderBudget, find_deferred_fragments)
+from neorg.cache import RenderCache, LRUCache, cache_key
+from neorg import search, revisions
 
 
 def regex_from_temp_path(path):
@@ -54,13 +62,127 @@ def match_temp_path(path, temp_path_list):
     return (None, None)
 
 
+class TempPathIndex(object):
+    """
+    Index of the template pages to find the one matches to a path
+
+    The template paths are stored in a trie of the path segments.
+    A segment containing ``_temp_`` matches to any segment and the
+    candidates found are checked by the precompiled regex.  Therefore,
+    the lookup does not depend on the number of the pages.
+    The result is the same as `match_temp_path`.
+
+    >>> index = TempPathIndex(['some/url', 'my/_temp_', '_temp_/_temp_'])
+    >>> (temp_path, match) = index.match('my/url')
+    >>> temp_path
+    'my/_temp_'
+    >>> match.groups()
+    ('url',)
+    >>> index.remove('my/_temp_')
+    >>> index.match('my/url')[0]
+    '_temp_/_temp_'
+    >>> index.match('too/deep/url')
+    (None, None)
+
+    """
+
+    def __init__(self, page_path_list=()):
+        self._lock = threading.Lock()
+        # node = [{segment: node}, wildcard node or None, set of paths]
+        self._root = self._new_node()
+        self._regex = {}
+        for page_path in page_path_list:
+            self.add(page_path)
+
+    @staticmethod
+    def _new_node():
+        return [{}, None, set()]
+
+    @staticmethod
+    def is_temp_path(page_path):
+        return '_temp_' in page_path
+
+    def add(self, page_path):
+        """
+        Add `page_path` if it is a template page
+        """
+        if not self.is_temp_path(page_path):
+            return
+        with self._lock:
+            node = self._root
+            for segment in page_path.split('/'):
+                if self.is_temp_path(segment):
+                    if node[1] is None:
+                        node[1] = self._new_node()
+                    node = node[1]
+                else:
+                    node = node[0].setdefault(segment, self._new_node())
+            node[2].add(page_path)
+            self._regex[page_path] = re.compile(
+                regex_from_temp_path(page_path))
+
+    def remove(self, page_path):
+        """
+        Remove `page_path` (nothing happens if it is not in the index)
+        """
+        with self._lock:
+            if self._regex.pop(page_path, None) is None:
+                return
+            node = self._root
+            for segment in page_path.split('/'):
+                node = node[1] if self.is_temp_path(segment) else \
+                    node[0][segment]
+            node[2].discard(page_path)
+            # empty nodes are left; they are harmless and reused
+
+    def match(self, path):
+        """
+        Returns matched template path and the matched object
+        """
+        with self._lock:
+            nodes = [self._root]
+            for segment in path.split('/'):
+                nodes = [child for node in nodes for child in
+                         (node[0].get(segment), node[1]) if child]
+                if not nodes:
+                    return (None, None)
+            candidates = sorted(
+                (temp_path for node in nodes for temp_path in node[2]),
+                reverse=True)
+            for temp_path in candidates:
+                match = self._regex[temp_path].match(path)
+                if match:
+                    return (temp_path, match)
+        return (None, None)
+
+
+_temp_path_index = {}
+_temp_path_index_lock = threading.Lock()
+
+
+def get_temp_path_index():
+    """
+    Get `TempPathIndex` of the current database
+
+    It is built from the database at the first call and then updated
+    by `save` and `delete`.
+
+    """
+    dbpath = app.config['DATABASE']
+    with _temp_path_index_lock:
+        if dbpath not in _temp_path_index:
+            _temp_path_index[dbpath] = TempPathIndex(
+                row[0] for row in g.db.execute(
+                    "select page_path from pages "
+                    "where page_path like '%\\_temp\\_%' escape '\\'"))
+        return _temp_path_index[dbpath]
+
+
 def find_temp_path(path):
     """
     Find the template path matches the given path
     """
-    temp_path_list = g.db.execute(
-        "select page_path from pages").fetchall()
-    return match_temp_path(path, [row[0] for row in temp_path_list])
+    return get_temp_path_index().match(path)
 
 
 def temp_parent_path(temp_path):
@@ -120,32 +242,130 @@ def filter_descendants(path, path_list):
         for p in path_list if p.startswith(path)]
 
 
+class PagePathIndex(object):
+    """
+    Sorted array of the page paths for prefix queries
+
+    >>> index = PagePathIndex(['a/b', 'a', 'c', 'a/b/c'])
+    >>> index.descendants('a/b')
+    ['a/b', 'a/b/c']
+    >>> index.has_descendants('b')
+    False
+    >>> index.add('b/a')
+    >>> index.has_descendants('b')
+    True
+    >>> index.remove('a/b')
+    >>> index.descendants('a')
+    ['a', 'a/b/c']
+
+    """
+
+    def __init__(self, page_path_list=()):
+        self._lock = threading.Lock()
+        self._paths = sorted(set(page_path_list))
+
+    def add(self, page_path):
+        with self._lock:
+            i = bisect_left(self._paths, page_path)
+            if i == len(self._paths) or self._paths[i] != page_path:
+                self._paths.insert(i, page_path)
+
+    def remove(self, page_path):
+        with self._lock:
+            i = bisect_left(self._paths, page_path)
+            if i < len(self._paths) and self._paths[i] == page_path:
+                del self._paths[i]
+
+    def descendants(self, path):
+        """
+        Get the sorted list of the page paths starting with `path`
+
+        It takes O(log N + M) time where N is the number of all pages
+        and M is the number of the pages found.
+
+        """
+        with self._lock:
+            paths = self._paths
+            found = []
+            for i in xrange(bisect_left(paths, path), len(paths)):
+                if not paths[i].startswith(path):
+                    break
+                found.append(paths[i])
+            return found
+
+    def has_descendants(self, path):
+        with self._lock:
+            i = bisect_left(self._paths, path)
+            return i < len(self._paths) and self._paths[i].startswith(path)
+
+
+_page_path_index = {}
+_page_path_index_lock = threading.Lock()
+
+
+def get_page_path_index():
+    """
+    Get `PagePathIndex` of the current database
+
+    It is built from the database at the first call and then updated
+    by `save` and `delete`.
+
+    """
+    dbpath = app.config['DATABASE']
+    with _page_path_index_lock:
+        if dbpath not in _page_path_index:
+            _page_path_index[dbpath] = PagePathIndex(
+                unicode(row[0]) for row in
+                g.db.execute("select page_path from pages"))
+        return _page_path_index[dbpath]
+
+
 def find_descendants(path):
     """
     Find the pages which has `path` as its heading path.
     """
-    path_list = [
-        row[0] for row in
-        g.db.execute("select page_path from pages").fetchall()]
-    return filter_descendants(path, path_list)
+    return filter_descendants(
+        path, get_page_path_index().descendants(path))
 
 
 def recent_pages(path, num):
     """
     Find the `num` most recently updated sub-pages of `path`
+
+    Returns a list of (updated, relative path) pairs.
+
     """
-    path_list = find_descendants(path)
-    date_list = [
-        g.db.execute(
-            "select max(updated) from page_history where page_path = ?",
-            [os.path.join(path, subpath).rstrip('/')]).fetchone()[0]
-        for subpath in path_list]
-    date_path_list = sorted(zip(date_list, path_list), reverse=True)[:num]
-    return date_path_list
+    if path:
+        rows = g.db.execute(
+            'select updated, page_path from pages '
+            'where substr(page_path, 1, ?) = ? '
+            'order by updated desc, page_path desc limit ?',
+            [len(path), path, num])
+    else:
+        rows = g.db.execute(
+            'select updated, page_path from pages '
+            'order by updated desc, page_path desc limit ?', [num])
+    lenpath = len(path)
+    return [(updated, remove_leading_slash(unicode(page_path)[lenpath:]))
+            for (updated, page_path) in rows]
+
+
+def recent_changes(num):
+    """
+    Get the `num` most recent changes of all pages
+
+    Returns a list of dicts with keys 'history_id', 'page_path',
+    'page_exists' and 'updated', newest first.
+
+    """
+    keys = ('history_id', 'page_path', 'page_exists', 'updated')
+    return [dict(zip(keys, row)) for row in g.db.execute(
+        'select history_id, page_path, page_exists, updated '
+        'from page_history order by history_id desc limit ?', [num])]
 
 
 def has_descendants(path):
-    return bool(find_descendants(path))
+    return get_page_path_index().has_descendants(path)
 
 
 def path_as_title(path):
@@ -161,16 +381,95 @@ app.config.from_object(DefaultConfig)
 
 def connect_db():
     """Returns a new connection to the database."""
-    return sqlite3.connect(app.config['DATABASE'])
+    db = sqlite3.connect(app.config['DATABASE'],
+                         timeout=app.config['DATABASE_TIMEOUT'],
+                         cached_statements=200)
+    if app.config['DATABASE_WAL']:
+        db.execute('pragma journal_mode = wal')
+    return db
+
+
+_db_local = threading.local()
+
+
+def get_pooled_db():
+    """
+    Get the connection of the current thread to the database
+
+    The connection is kept open and reused by the next requests
+    processed in the same thread, so that the connection setup and
+    the compiled statements (see `connect_db`) are not thrown away.
+
+    """
+    pool = _db_local.__dict__.setdefault('pool', {})
+    dbpath = app.config['DATABASE']
+    db = pool.get(dbpath)
+    if db is None:
+        db = pool[dbpath] = connect_db()
+    return db
+
+
+def close_pooled_db():
+    """
+    Close the connections of the current thread made by `get_pooled_db`
+
+    `neorg serve` calls this at exit so that SQLite can checkpoint the
+    write-ahead log and remove it.
+
+    """
+    pool = _db_local.__dict__.pop('pool', {})
+    for db in pool.itervalues():
+        db.close()
+
+
+class LazyConnection(object):
+    """
+    Proxy of the database connection which connects at the first use
+
+    >>> db = LazyConnection(lambda: sqlite3.connect(':memory:'))
+    >>> db.connected
+    False
+    >>> db.execute('select 1').fetchone()
+    (1,)
+    >>> db.connected
+    True
+    >>> db.release()
+    >>> db.connected
+    False
+
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._db = None
+
+    def __getattr__(self, name):
+        if self._db is None:
+            self._db = self._connect()
+        return getattr(self._db, name)
+
+    @property
+    def connected(self):
+        return self._db is not None
+
+    def release(self):
+        """
+        Discard the uncommitted changes and forget the connection
+        """
+        if self._db is not None:
+            self._db.rollback()
+            self._db = None
 
 
 def init_db():
     """Creates the database tables."""
     from neorg.verutils import current_version
+    from neorg.migration import mark_applied
     curver = current_version()
     with closing(connect_db()) as db:
         with app.open_resource('schema.sql') as f:
             db.cursor().executescript(f.read())
+        mark_applied(db)  # the schema is up to date
         db.execute(
             'insert into system_info (version) values (?)',
             [str(curver)])
@@ -197,12 +496,25 @@ def system_info():
             sysinfo_current[:-1]))  # ignore the tailing max(update)
 
 
-def update_system_info():
+def upgrade_db(db, stream=sys.stdout, offline=False):
+    """
+    Apply the migration steps which are not applied to `db` yet
+
+    See `neorg.migration.migrate` for `offline`.
+
+    """
+    from neorg.migration import migrate
+    return migrate(db, app.config, stream=stream, offline=offline)
+
+
+def update_system_info(offline=False):
     """
     Check and update current system info if the stored one is old
 
     This function **fail** with RuntimeError if the version in the
     stored system info is newer than the current running one.
+    The offline migration steps are run only if `offline` is true
+    (see `neorg.migration`).
 
     .. warning::
 
@@ -210,59 +522,390 @@ def update_system_info():
 
     """
     from neorg.verutils import NEOrgVersion, current_version
+    from neorg.migration import pending_steps, migrate
     sysinfo = system_info()
     oldver = NEOrgVersion(sysinfo['version'])
     curver = current_version()
     if oldver == curver:
-        pass
+        with closing(connect_db()) as db:
+            if pending_steps(db, oldver, offline):
+                print "Migrating database..."
+                migrate(db, app.config, oldver, offline=offline)
+                print "Finished."
+            remaining = pending_steps(db, oldver)
     elif oldver < curver:
         print "You updated NEOrg. Updating database..."
         with closing(connect_db()) as db:
+            migrate(db, app.config, oldver, offline=offline)
             db.execute(
                 'insert into system_info (version) values (?)',
                 [str(curver)])
             db.commit()
+            remaining = pending_steps(db, oldver)
         print "Finished."
     else:
         raise RuntimeError(
             'The old version ({0}) is newer than the version of the '
             'running version ({1}). Please install newer version'
             .format(oldver, curver))
+    if remaining:
+        print "Run `neorg migrate` to finish the migration:"
+        for step in remaining:
+            print "  " + step.description
+
+
+_whoosh_indices = {}
+
+
+def get_whoosh_index():
+    """
+    Get the process-wide `search.WhooshIndex` of SEARCHINDEX
+    """
+    indexdir = app.config['SEARCHINDEX']
+    ix = _whoosh_indices.get(indexdir)
+    if ix is None:
+        ix = _whoosh_indices.setdefault(indexdir, search.get_index(indexdir))
+    return ix
+
+
+def close_whoosh_index():
+    ix = _whoosh_indices.pop(app.config['SEARCHINDEX'], None)
+    if ix is not None:
+        ix.close()
+
+
+def get_search_index(db=None):
+    """
+    Get the search index of the SEARCH_BACKEND
+
+    The 'fts5' backend uses `db` (default: `g.db`).
+
+    """
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'whoosh':
+        return _search_writer or get_whoosh_index()
+    return search.get_index(backend=backend, db=g.db if db is None else db)
+
+
+_search_writer = None
+
+
+def start_search_writer():
+    """
+    Start writing the search index in background (`search.QueuedIndex`)
+
+    This is done only for the 'whoosh' backend because the 'fts5'
+    backend is updated in the transaction of the request.  Returns
+    the `QueuedIndex` or None.
+
+    .. warning::
 
+       Do NOT use this in app.
+       Call this function once just before `app.run`.
 
-def get_search_index():
-    return search.get_index(app.config['SEARCHINDEX'])
+    """
+    global _search_writer
+    if not (app.config['SEARCH_BACKEND'] == 'whoosh' and
+            app.config['SEARCH_WRITE_LATENCY']):
+        return None
+    _search_writer = search.QueuedIndex(
+        get_whoosh_index(),
+        latency=app.config['SEARCH_WRITE_LATENCY'],
+        optimize_interval=app.config['SEARCH_OPTIMIZE_INTERVAL'])
+    _search_writer.start()
+    return _search_writer
 
 
-def update_search_index():
+def stop_search_writer():
+    """
+    Stop the background writer after writing the queued changes
+    """
+    global _search_writer
+    if _search_writer is not None:
+        _search_writer.stop()
+        _search_writer = None
+
+
+def search_index_marker(db):
+    """
+    Get the change counter of the pages
+
+    Saving or deleting a page adds a row to ``page_history``, so the
+    newest ``history_id`` changes whenever any page is changed.
+
+    """
+    return str(db.execute(
+        'select max(history_id) from page_history').fetchone()[0])
+
+
+def iter_page_batches(db, batch_size=500):
+    """
+    Yield lists of dicts with 'page_path' and 'page_text' of all pages
+
+    Pages are read by `batch_size` rows, so the caller can commit
+    between the batches.
+
+    """
+    last_rowid = 0
+    while True:
+        rows = db.execute(
+            'select rowid, page_path, page_text from pages '
+            'where rowid > ? order by rowid limit ?',
+            [last_rowid, batch_size]).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        yield [dict(page_path=page_path, page_text=page_text)
+               for (_, page_path, page_text) in rows]
+
+
+def update_search_index(batch_size=500, force=False):
     """
     Update all search index or create new index.
 
+    Pages are read and indexed in batches of `batch_size`.  Unless
+    `force` is true, nothing is done if no page was changed after the
+    index was synchronized last time (see `search_index_marker`).
+    Returns the number of the updated pages or None if skipped.
+
+    .. warning::
+
+       Do NOT use this in app.
+       Call this function once just before `app.run` or use
+       `start_search_indexer`.
+
+    """
+    with closing(connect_db()) as db:
+        ix = get_search_index(db)  # make new index if it does not exist
+        marker = search_index_marker(db)
+        if not force and search.get_marker(ix) == marker:
+            return None
+        (last_id,) = db.execute(
+            'select coalesce(max(history_id), 0) from page_history'
+            ).fetchone()
+        num_updated = 0
+        for doc_list in iter_page_batches(db, batch_size):
+            num_updated += search.update_all(ix, doc_list)
+            refresh_search_index(
+                db, ix, [doc['page_path'] for doc in doc_list], last_id)
+            db.commit()
+        search.set_marker(ix, marker)
+        db.commit()
+    return num_updated
+
+
+def refresh_search_index(db, ix, page_paths, history_id):
+    """
+    Index the current text of `page_paths` changed after `history_id`
+
+    A page saved (and indexed by the request) while a batch of pages
+    is read and indexed can be overwritten by the old text of the
+    batch.  Calling this after writing the batch indexes the text
+    committed by then; the saves committed later are indexed after
+    this by their requests.
+
+    """
+    changed = set(row[0] for row in db.execute(
+        'select distinct page_path from page_history where history_id > ?',
+        [history_id]))
+    for page_path in sorted(changed.intersection(page_paths)):
+        row = db.execute('select page_text from pages where page_path = ?',
+                         [page_path]).fetchone()
+        if row is None:
+            search.delete(ix, page_path)
+        else:
+            search.update(ix, page_path, row[0])
+
+
+def rebuild_search_index(procs=1, batch_size=500, progress=None):
+    """
+    Rebuild the search index from scratch and return the number of pages
+
+    See `search.rebuild` for `procs`.  Pages are read in batches of
+    `batch_size` and ``progress(done, total)`` is called after each
+    batch is read.
+
+    .. warning::
+
+       Do NOT use this in app.  Stop the server before calling this.
+
+    """
+    with closing(connect_db()) as db:
+        (total,) = db.execute('select count(*) from pages').fetchone()
+
+        def docs():
+            done = 0
+            for doc_list in iter_page_batches(db, batch_size):
+                for doc in doc_list:
+                    yield doc
+                done += len(doc_list)
+                if progress:
+                    progress(done, total)
+
+        ix = get_search_index(db)
+        marker = search_index_marker(db)
+        num_indexed = search.rebuild(ix, docs(), procs)
+        search.set_marker(ix, marker)
+        db.commit()
+    return num_indexed
+
+
+class SearchIndexer(object):
+    """
+    Background thread to run `update_search_index`
+
+    The pages saved while it is running are indexed by the request, so
+    only the search results of the other pages may be incomplete.
+
+    """
+
+    def __init__(self):
+        self.updated = None
+        self.finished = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='neorg-search-indexer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    @property
+    def catching_up(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        try:
+            self.updated = update_search_index()
+            self.finished = True
+        except Exception:
+            app.logger.exception('Failed to update the search index')
+
+
+_search_indexer = None
+
+
+def start_search_indexer():
+    """
+    Start `SearchIndexer`
+
     .. warning::
 
        Do NOT use this in app.
        Call this function once just before `app.run`.
 
     """
+    global _search_indexer
+    _search_indexer = SearchIndexer()
+    _search_indexer.start()
+    return _search_indexer
+
+
+def search_index_catching_up():
+    return _search_indexer is not None and _search_indexer.catching_up
+
+
+def mark_search_index_synced():
+    """
+    Record that the search index has all the changes of the pages
+
+    The pages saved by the requests are indexed (or queued) before
+    committed, so the index is synchronized after `SearchIndexer`
+    finished and the queued changes are written.  Call this function
+    at shutdown to skip `update_search_index` at the next start.  The
+    background writer is stopped.
+
+    """
+    stop_search_writer()
+    if _search_indexer is None or not _search_indexer.finished:
+        return
     with closing(connect_db()) as db:
-        pages = db.execute('select * from pages').fetchall()
-    doc_list = [dict(
-        zip(('page_path', 'page_text'), doc)) for doc in pages]
-    ix = get_search_index()  # make new index if it does not exist
-    search.update_all(ix, doc_list)
+        ix = get_search_index(db)
+        search.set_marker(ix, search_index_marker(db))
+        db.commit()
+
+
+class RequestCounter(object):
+    """
+    Count the requests being processed
+
+    >>> counter = RequestCounter()
+    >>> counter.increment()
+    >>> counter.count
+    1
+    >>> counter.decrement()
+    >>> counter.wait_zero(timeout=0)
+    True
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def increment(self):
+        with self._cond:
+            self.count += 1
+
+    def decrement(self):
+        with self._cond:
+            self.count -= 1
+            if self.count == 0:
+                self._cond.notify_all()
+
+    def wait_zero(self, timeout=None):
+        """
+        Wait until no request is processed.  Return False if timed out.
+        """
+        with self._cond:
+            if self.count > 0:
+                self._cond.wait(timeout)
+            return self.count == 0
+
+
+_live_requests = RequestCounter()
 
 
 @app.before_request
 def before_request():
-    """Make sure we are connected to the database each request."""
-    g.db = connect_db()
+    """
+    Make `g.db` available; it connects when a view uses it first
+    """
+    g.db = LazyConnection(get_pooled_db)
+    _live_requests.increment()
+    g.live_request = True
 
 
-@app.after_request
-def after_request(response):
-    """Closes the database again at the end of the request."""
-    g.db.close()
-    return response
+@app.teardown_request
+def teardown_request(exception):
+    """Return the database connection to the pool."""
+    db = getattr(g, 'db', None)
+    if isinstance(db, LazyConnection):
+        db.release()
+    if getattr(g, 'live_request', False):
+        _live_requests.decrement()
+
+
+def summarize_change(old_text, new_text, diff=None):
+    """
+    Short summary of the change to be shown in the history
+
+    `diff` is the `neorg.revisions.LineDiff` of the texts if already
+    computed.
+
+    >>> summarize_change(None, u'a')
+    u'created'
+    >>> summarize_change(u'a\\nb\\nc', u'a\\nB\\nc\\nd')
+    u'+2 -1 lines'
+
+    """
+    if old_text is None:
+        return u'created'
+    if diff is None:
+        diff = revisions.LineDiff(old_text, new_text)
+    return u'+{0} -{1} lines'.format(*diff.counts())
 
 
 def get_page_text(page_path):
@@ -275,11 +918,417 @@ def get_page_text(page_path):
         return None
 
 
+_render_cache = {}
+
+
+def get_render_cache():
+    """
+    Get `neorg.cache.RenderCache` or None if it is disabled
+    """
+    dbpath = app.config.get('RENDERCACHE')
+    if not dbpath:
+        return None
+    if dbpath not in _render_cache:
+        _render_cache[dbpath] = RenderCache(
+            dbpath, app.config['RENDERCACHE_SIZE'])
+    return _render_cache[dbpath]
+
+
+_block_cache = {}
+
+
+def get_block_cache():
+    """
+    Get `neorg.cache.LRUCache` for the preview or None if it is disabled
+    """
+    size = app.config.get('BLOCKCACHE_SIZE')
+    if not size:
+        return None
+    if size not in _block_cache:
+        _block_cache[size] = LRUCache(size)
+    return _block_cache[size]
+
+
+def invalidate_render_cache(page_path, deleted=False):
+    """
+    Remove cached HTML which can be changed by saving `page_path`
+    """
+    rcache = get_render_cache()
+    if rcache is not None:
+        rcache.invalidate(page_path)
+        rcache.invalidate_volatile()
+        # recorded for the old text; recorded again when rendered
+        rcache.remove_dependency(page_path)
+        if _prerender_worker is not None:
+            _prerender_worker.schedule(
+                ([] if deleted else [page_path]) + rcache.list_volatile())
+
+
+def flush_render_cache():
+    """
+    Write the access counts kept in memory by the render cache
+    """
+    rcache = get_render_cache()
+    if rcache is not None:
+        rcache.flush()
+
+
+_fresh_dependency = LRUCache(10000)  # hash of dependency -> checked time
+
+
+def is_fresh_dependency(dependency):
+    """
+    Check if the data files in the dependency JSON are not changed
+
+    A dependency found to be fresh is not checked again for
+    RENDERCACHE_CHECK_TTL seconds.
+
+    """
+    ttl = app.config['RENDERCACHE_CHECK_TTL']
+    key = md5(dependency.encode('utf-8')).hexdigest()
+    checked = _fresh_dependency.get(key)
+    if checked is not None and time.time() - checked < ttl:
+        return True
+    if not DataDependency.from_json(dependency).is_fresh():
+        return False
+    if ttl:
+        _fresh_dependency.set(key, time.time())
+    return True
+
+
+def page_cache_key(page_text, page_path, **kwds):
+    return cache_key(page_text,
+                     page_path=page_path,
+                     debug=app.config['DEBUG'],
+                     datadirpath=app.config['DATADIRPATH'],
+                     datadirurl=app.config['DATADIRURL'],
+                     **kwds)
+
+
+def render_budget():
+    """
+    Make a new `neorg.wiki.RenderBudget` for rendering a page
+    """
+    return RenderBudget(max_time=app.config['RENDER_MAX_TIME'],
+                        max_globbed=app.config['RENDER_MAX_GLOBBED'],
+                        max_loaded=app.config['RENDER_MAX_LOADED'])
+
+
+def _gene_html_cached(rcache, key, text, page_path, deferred=False,
+                      part=''):
+    page_html = rcache.get(page_path, key, validate=is_fresh_dependency)
+    if page_html is None:
+        dependency = DataDependency()
+        budget = render_budget()
+        (page_html, tb_text,
+         ) = gene_html(text, page_path, dependency=dependency,
+                       budget=budget, deferred=deferred, _mix=False,
+                       _debug=app.config['DEBUG'])
+        if page_html is None:
+            return tb_text
+        if budget.exhausted:
+            return page_html
+        dependency_json = dependency.to_json()
+        rcache.set(page_path, key, page_html,
+                   volatile=dependency.pages, dependency=dependency_json)
+        rcache.set_dependency(
+            page_path, dependency_json, volatile=dependency.pages,
+            entries=[d.to_json() for d in dependency.split()], part=part)
+    return page_html
+
+
+def gene_html_cached(page_text, page_path, deferred=False):
+    """
+    Call `gene_html` if the HTML is not found in the render cache
+
+    The cached HTML is discarded if the data files used by the page
+    are changed (see `neorg.wiki.DataDependency`).  The HTML is not
+    cached if the render budget ran out.
+
+    If `deferred` is True and the fully rendered HTML is not cached,
+    the data directives are replaced by placeholders which are loaded
+    from the `fragment` view.
+
+    """
+    rcache = get_render_cache()
+    if rcache is None:
+        return gene_html(page_text, page_path, budget=render_budget(),
+                         deferred=deferred, _debug=app.config['DEBUG'])
+    key = page_cache_key(page_text, page_path)
+    if deferred:
+        page_html = rcache.get(page_path, key, validate=is_fresh_dependency)
+        if page_html is not None:
+            return page_html
+        return _gene_html_cached(
+            rcache, page_cache_key(page_text, page_path, deferred=True),
+            page_text, page_path, deferred=True, part='deferred')
+    return _gene_html_cached(rcache, key, page_text, page_path)
+
+
+def gene_fragment_cached(page_text, page_path, index):
+    """
+    Render the `index`-th data directive in the page
+
+    Returns None if the page does not have such directive.
+
+    """
+    rcache = get_render_cache()
+    if rcache is not None:
+        key = page_cache_key(page_text, page_path, fragment=index)
+        page_html = rcache.get(page_path, key, validate=is_fresh_dependency)
+        if page_html is not None:
+            return page_html
+    fragments = find_deferred_fragments(page_text, page_path)
+    if not 0 <= index < len(fragments):
+        return None
+    if rcache is None:
+        return gene_html(fragments[index], page_path, budget=render_budget(),
+                         _debug=app.config['DEBUG'])
+    return _gene_html_cached(rcache, key, fragments[index], page_path,
+                             part='fragment/{0}'.format(index))
+
+
+def render_all_pages():
+    """
+    Render all pages and store them in the render cache
+
+    .. warning::
+
+       Do NOT use this in app.
+
+    """
+    with app.test_request_context():
+        g.db = connect_db()
+        try:
+            for (page_path, page_text) in g.db.execute(
+                    'select page_path, page_text from pages'):
+                gene_html_cached(page_text, page_path)
+        finally:
+            g.db.close()
+
+
+def find_affected_pages(syspath):
+    """
+    Find pages which depend on the data file at `syspath`
+
+    Only the pages rendered (and recorded in the render cache) are
+    checked.
+
+    .. warning::
+
+       Do NOT use this in app.
+
+    """
+    rcache = get_render_cache()
+    if rcache is None:
+        raise RuntimeError('RENDERCACHE is disabled.')
+    return rcache.pages_with_entries(
+        entry for entry in rcache.list_entries()
+        if DataDependency.from_json(entry).depends_on(syspath))
+
+
+def stale_pages():
+    """
+    Find pages whose data files were changed after the last rendering
+
+    Each file and glob pattern is checked once even if it is used by
+    many pages.
+
+    """
+    rcache = get_render_cache()
+    return rcache.pages_with_entries(
+        entry for entry in rcache.list_entries()
+        if not is_fresh_dependency(entry))
+
+
+def volatile_pages():
+    """
+    Find pages which depend on the other pages (e.g., ``list-pages``)
+    """
+    return get_render_cache().list_volatile()
+
+
+def prerender_order():
+    """
+    List all pages in the order to be pre-rendered
+
+    Frequently accessed pages come first.  Pages with the same access
+    count are ordered by the last update time (newest first).
+
+    """
+    rows = g.db.execute(
+        'select page_path, updated from pages '
+        'order by updated desc').fetchall()
+    counts = get_render_cache().access_counts()
+    rows.sort(key=lambda row: counts.get(row[0], 0), reverse=True)
+    return [page_path for (page_path, updated) in rows]
+
+
+def prerender_page(page_path):
+    page_text = get_page_text(page_path)
+    if page_text:
+        gene_html_cached(page_text, page_path)
+        return
+    (temp_path, match) = find_temp_path(page_path)
+    if match:  # page generated from a template page
+        gene_html_from_temp(page_path, temp_path, match)
+
+
+class PreRenderWorker(object):
+    """
+    Background thread which renders pages into the render cache
+
+    When started, it renders all pages in the order of
+    `prerender_order`.  After that, it renders pages given to
+    `schedule` (`invalidate_render_cache` does this for the saved
+    pages) and, every `interval` seconds, pages whose data files were
+    changed (see `stale_pages`).
+
+    Not to slow down the live requests, it waits while any request is
+    processed and, after rendering a page, it sleeps `throttle` times
+    as long as the rendering took.  Likewise, the next check of the
+    data files is delayed by `throttle` times as long as the check
+    took if it is longer than `interval`.
+
+    """
+
+    def __init__(self, throttle=1.0, interval=60.0):
+        self.throttle = throttle
+        self.interval = interval
+        self.rendered = 0
+        self._queue = OrderedDict()  # used as an ordered set
+        self._next_scan = 0
+        self._busy = True  # until the initial schedule is done
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='neorg-prerender')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def schedule(self, page_path_list):
+        """
+        Add pages to the end of the queue unless they are queued
+        """
+        with self._cond:
+            for page_path in page_path_list:
+                self._queue.setdefault(page_path)
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the queue becomes empty.  Return False if timed out.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                if deadline is None:
+                    self._cond.wait()
+                elif time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                else:
+                    return False
+            return True
+
+    def _pop(self):
+        """
+        Get the next page path or None if the queue is empty
+        """
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+            if not self._queue and not self._stopped:
+                self._cond.wait(self.interval)
+            if self._queue and not self._stopped:
+                self._busy = True
+                return self._queue.popitem(last=False)[0]
+
+    def _sleep(self, seconds):
+        with self._cond:
+            if not self._stopped:
+                self._cond.wait(seconds)
+
+    def _wait_requests(self):
+        while not (self._stopped or _live_requests.wait_zero(1)):
+            pass
+
+    def _call_with_db(self, func, *args):
+        g.db = connect_db()
+        try:
+            return func(*args)
+        finally:
+            g.db.close()
+
+    def _run(self):
+        with app.test_request_context():
+            self.schedule(self._call_with_db(prerender_order))
+            while not self._stopped:
+                page_path = self._pop()
+                if self._stopped:
+                    break
+                elif page_path is None:
+                    if time.time() >= self._next_scan:
+                        self._wait_requests()
+                        start = time.time()
+                        self.schedule(stale_pages())
+                        self._next_scan = time.time() + max(
+                            self.interval,
+                            self.throttle * (time.time() - start))
+                    continue
+                self._wait_requests()
+                start = time.time()
+                try:
+                    self._call_with_db(prerender_page, page_path)
+                    self.rendered += 1
+                except Exception:
+                    app.logger.exception(
+                        'Failed to pre-render page "%s"' % page_path)
+                self._sleep(self.throttle * (time.time() - start))
+
+
+_prerender_worker = None
+
+
+def start_prerender_worker():
+    """
+    Start `PreRenderWorker` if the render cache is enabled
+
+    .. warning::
+
+       Do NOT use this in app.
+       Call this function once just before `app.run`.
+
+    """
+    global _prerender_worker
+    if get_render_cache() is None:
+        return None
+    _prerender_worker = PreRenderWorker(
+        throttle=app.config['PRERENDER_THROTTLE'],
+        interval=app.config['PRERENDER_INTERVAL'])
+    _prerender_worker.start()
+    return _prerender_worker
+
+
+def stop_prerender_worker():
+    global _prerender_worker
+    if _prerender_worker is not None:
+        _prerender_worker.stop()
+        _prerender_worker = None
+
+
 def get_page_text_and_html(page_path):
     page_text = get_page_text(page_path)
     if page_text:
-        page_html = gene_html(page_text, page_path,
-                              _debug=app.config['DEBUG'])
+        page_html = gene_html_cached(
+            page_text, page_path, deferred=app.config['DEFERRED_RENDERING'])
     else:
         page_html = ''
     return (page_text, page_html)
@@ -289,15 +1338,22 @@ def get_page_text_and_html(page_path):
 @app.route('/<path:page_path>/_delete', methods=['POST'])
 def delete(page_path):
     if request.form.get('yes') == 'Yes':
+        ix = get_search_index()
         g.db.execute(
             'delete from pages where page_path = ?',
             [page_path])
-        g.db.execute(
-            'insert into page_history (page_path, page_text, page_exists) '
-            'values (?, ?, 0)',
-            [page_path, ''])
+        revisions.add_revision(
+            g.db, page_path, u'', app.config['HISTORY_SNAPSHOT_INTERVAL'],
+            page_exists=0, text_size=0, summary=u'deleted')
+        transactional = search.is_transactional(ix)
+        if transactional:
+            search.delete(ix, page_path)
         g.db.commit()
-        search.delete(get_search_index(), page_path)
+        if not transactional:
+            search.delete(ix, page_path)
+        invalidate_render_cache(page_path, deleted=True)
+        get_temp_path_index().remove(page_path)
+        get_page_path_index().remove(page_path)
         flash('Page "%s" was deleted.' % page_path)
         return redirect(url_for('page', page_path=''))
     elif request.form.get('no') == 'No':
@@ -320,24 +1376,40 @@ def confirm_delete(page_path):
 def save(page_path):
     if request.form.get('save') == 'Save':
         page_text = request.form['page_text']
-        if get_page_text(page_path) == page_text:
+        old_text = get_page_text(page_path)
+        if old_text == page_text:
             flash('No change was found.')
             return redirect(url_for("page", page_path=page_path))
+        ix = get_search_index()
+        diff = (None if old_text is None else
+                revisions.LineDiff(old_text, page_text))
+        history_id = revisions.add_revision(
+            g.db, page_path, page_text,
+            app.config['HISTORY_SNAPSHOT_INTERVAL'],
+            base_text=old_text, diff=diff,
+            text_size=len(page_text),
+            summary=summarize_change(old_text, page_text, diff))
         g.db.execute(
-            'insert or replace into pages (page_path, page_text)'
-            ' values (?, ?)',
-            [page_path, page_text])
-        g.db.execute(
-            'insert into page_history (page_path, page_text) values (?, ?)',
-            [page_path, page_text])
+            'insert or replace into pages (page_path, page_text, updated)'
+            ' values (?, ?, (select updated from page_history'
+            ' where history_id = ?))',
+            [page_path, page_text, history_id])
+        transactional = search.is_transactional(ix)
+        if transactional:
+            search.update(ix, page_path, page_text)
         g.db.commit()
-        search.update(get_search_index(), page_path, page_text)
+        if not transactional:
+            search.update(ix, page_path, page_text)
+        invalidate_render_cache(page_path)
+        get_temp_path_index().add(page_path)
+        get_page_path_index().add(page_path)
         flash('Saved!')
         return redirect(url_for("page", page_path=page_path))
     elif request.form.get('preview') == 'Preview':
         page_text = request.form['page_text']
-        page_html = gene_html(page_text, page_path,
-                              _debug=app.config['DEBUG'])
+        page_html = gene_html_incremental(
+            page_text, page_path, cache=get_block_cache(),
+            budget=render_budget(), _debug=app.config['DEBUG'])
         if get_page_text(page_path) == page_text:
             flash('Previewing... No change was found.')
         else:
@@ -380,6 +1452,9 @@ def edit_form(page_path):
 def page(page_path):
     (page_text, page_html) = get_page_text_and_html(page_path)
     if page_text:
+        rcache = get_render_cache()
+        if rcache is not None:
+            rcache.count_access(page_path)
         return render_template("page.html",
                                title=path_as_title(page_path),
                                page_path=page_path,
@@ -401,6 +1476,17 @@ def page(page_path):
                 return redirect(url_for('edit', page_path=page_path))
 
 
+@app.route('/_fragment/<int:index>', defaults={'page_path': ''})
+@app.route('/<path:page_path>/_fragment/<int:index>')
+def fragment(page_path, index):
+    page_text = get_page_text(page_path)
+    if page_text:
+        page_html = gene_fragment_cached(page_text, page_path, index)
+        if page_html is not None:
+            return page_html
+    abort(404)
+
+
 _HTML_TEMP_GENE_TEXT_FAIL = """
 <h1>Failed to generate from the template</h1>
 <p>
@@ -412,10 +1498,44 @@ See the help page for the valid variables.
 """
 
 
+_template_cache = {}
+
+
+def get_template_cache():
+    """
+    Get `neorg.cache.LRUCache` for the compiled templates or None
+    """
+    size = app.config.get('TEMPLATECACHE_SIZE')
+    if not size:
+        return None
+    if size not in _template_cache:
+        _template_cache[size] = LRUCache(size)
+    return _template_cache[size]
+
+
+_jinja_env = jinja2.Environment()
+
+
+def compile_template(temp_path, temp_text):
+    """
+    Compile the text of the template page or get it from the cache
+    """
+    tcache = get_template_cache()
+    if tcache is None:
+        return _jinja_env.from_string(temp_text)
+    key = (temp_path, md5(temp_text.encode('utf-8')).hexdigest())
+    template = tcache.get(key)
+    if template is None:
+        template = _jinja_env.from_string(temp_text)
+        tcache.set(key, template)
+    return template
+
+
 @safecall(_HTML_TEMP_GENE_TEXT_FAIL)
-def gene_text_from_temp(page_path, temp_path, match):
-    temp_text = get_page_text(temp_path)
-    template = jinja2.Environment().from_string(temp_text)
+def gene_text_from_temp(page_path, temp_path, match, temp_text=None):
+    if temp_text is None:
+        temp_text = get_page_text(temp_path)
+    template = compile_template(temp_path, temp_text)
     page_text = template.render({
         'path': page_path,
         'relpath': relpath_from_temp(page_path, temp_path),
@@ -424,17 +1544,40 @@ def gene_text_from_temp(page_path, temp_path, match):
     return page_text
 
 
+def gene_html_from_temp(page_path, temp_path, match):
+    """
+    Generate HTML of the page generated from the template page
+
+    The HTML is cached in the render cache with the key computed from
+    the template text and the arguments, so that the template is not
+    rendered again unless it or the data files used are changed.
+
+    """
+    temp_text = get_page_text(temp_path)
+    rcache = get_render_cache()
+    if rcache is not None:
+        key = page_cache_key(
+            temp_text, page_path, temp_path=temp_path,
+            args=match.groups(),
+            relpath=relpath_from_temp(page_path, temp_path))
+        page_html = rcache.get(page_path, key, validate=is_fresh_dependency)
+        if page_html is not None:
+            return page_html
+    (page_text, tb_text,
+     ) = gene_text_from_temp(page_path, temp_path, match, temp_text,
+                             _mix=False, _debug=app.config['DEBUG'])
+    if page_text is None:
+        return tb_text
+    if rcache is None:
+        return gene_html(page_text, page_path, budget=render_budget(),
+                         _debug=app.config['DEBUG'])
+    return _gene_html_cached(rcache, key, page_text, page_path)
+
+
 def gene_from_template(page_path):
     (temp_path, match) = find_temp_path(page_path)
     if match:
-        (page_text, tb_text,
-         ) = gene_text_from_temp(page_path, temp_path, match,
-                                 _mix=False, _debug=app.config['DEBUG'])
-        if page_text is None:
-            page_html = tb_text
-        else:
-            page_html = gene_html(page_text, page_path,
-                                  _debug=app.config['DEBUG'])
+        page_html = gene_html_from_temp(page_path, temp_path, match)
         return render_template("page.html",
                                title=path_as_title(page_path),
                                temp_path=temp_path,
@@ -456,29 +1599,63 @@ def descendants(page_path):
                            page_path=page_path)
 
 
+_HISTORY_MAX_NUM = 500  # max number of revisions in a history page
+
+
 @app.route('/_history', defaults={'page_path': ''})
 @app.route('/<path:page_path>/_history')
 def history(page_path):
-    page_history_list = g.db.execute(
-        'select history_id, page_text, updated '
-        'from page_history where page_path = ?',
-        [page_path]).fetchall()
-    page_history_keys = ('history_id', 'page_text', 'updated')
-    page_history = [dict(zip(page_history_keys, row))
-                    for row in reversed(page_history_list)]
+    """
+    List the revisions of the page, newest first
+
+    The revisions are paginated by `history_id` (``before`` query
+    parameter) and only their metadata is loaded.
+
+    """
+    num = min(max(request.args.get('num', 50, type=int), 1),
+              _HISTORY_MAX_NUM)
+    before = request.args.get('before', type=int)
+    if before is None:
+        rows = g.db.execute(
+            'select history_id, updated, page_exists, text_size, summary '
+            'from page_history where page_path = ? '
+            'order by history_id desc limit ?',
+            [page_path, num + 1]).fetchall()
+    else:
+        rows = g.db.execute(
+            'select history_id, updated, page_exists, text_size, summary '
+            'from page_history where page_path = ? and history_id < ? '
+            'order by history_id desc limit ?',
+            [page_path, before, num + 1]).fetchall()
+    page_history_keys = ('history_id', 'updated', 'page_exists',
+                         'text_size', 'summary')
+    page_history = [dict(zip(page_history_keys, row)) for row in rows[:num]]
+    older = page_history[-1]['history_id'] if len(rows) > num else None
     return render_template("history.html",
                            title=path_as_title(page_path),
                            page_path=page_path,
-                           page_history=page_history)
+                           page_history=page_history,
+                           older=older,
+                           num=num)
+
+
+@app.route('/_recent_changes')
+def recent_changes_view():
+    num = min(max(request.args.get('num', 100, type=int), 1),
+              _HISTORY_MAX_NUM)
+    return render_template("recent_changes.html",
+                           title='Recent Changes',
+                           page_path='',
+                           changes=recent_changes(num))
 
 
 @app.route('/_old/<int:history_id>', defaults={'page_path': ''})
 @app.route('/<path:page_path>/_old/<int:history_id>')
 def old(page_path, history_id):
-    page_text = g.db.execute(
-        'select page_text from page_history where history_id = ?',
-        [history_id]).fetchone()
-    page_html = gene_html(page_text[0], page_path,
+    page_text = revisions.load_revision(g.db, history_id)
+    if page_text is None:
+        abort(404)
+    page_html = gene_html(page_text, page_path, budget=render_budget(),
                           _debug=app.config['DEBUG'])
     return render_template("page.html",
                            title=path_as_title(page_path),
@@ -513,14 +1690,65 @@ def help(filename):
                                 filename=os.path.join('help', filename)))
 
 
+_search_cache = {}
+
+
+def get_search_cache():
+    """
+    Get `neorg.cache.LRUCache` for the search results or None
+    """
+    size = app.config.get('SEARCHCACHE_SIZE')
+    if not size:
+        return None
+    if size not in _search_cache:
+        _search_cache[size] = LRUCache(size)
+    return _search_cache[size]
+
+
+def search_cached(query, page):
+    """
+    Call `search.search` or get its result from the search cache
+
+    The key includes the generation of the index, so the results
+    cached before any change of the index are not used (and evicted
+    eventually).
+
+    """
+    ix = get_search_index()
+    pagelen = app.config['SEARCH_PAGELEN']
+    cache = get_search_cache()
+    if cache is None:
+        return search.search(ix, query, page, pagelen)
+    key = (search.normalize_query(query), page, pagelen,
+           search.get_generation(ix))
+    results = cache.get(key)
+    if results is None:
+        results = search.search(ix, query, page, pagelen)
+        cache.set(key, results)
+    return results
+
+
 @app.route('/_search')
 def search_results():
     query = request.args.get('q')
     if query:
-        results = search.search(get_search_index(), query, get_page_text)
+        results = search_cached(query, request.args.get('page', 1, type=int))
         return render_template("search.html",
                                title=query,
                                search_query=query,
-                               results=list(results))
+                               results=results,
+                               catching_up=search_index_catching_up())
     else:
         return redirect(url_for('page', page_path=''))
+
+
+@app.route('/_cache_stats')
+def cache_stats():
+    """
+    Statistics (hits, misses, evictions, etc.) of the in-memory caches
+    """
+    caches = [('block', get_block_cache()),
+              ('template', get_template_cache()),
+              ('search', get_search_cache())]
+    return jsonify(dict((name, cache.stats()) for (name, cache) in caches
+                        if cache is not None))
@@ -23,18 +23,25 @@ class for ease of the registration.
 Definition and the usage of the `Writer` and the `Reader` (and
 `Transform` classes in th Reader class) are pretty straightforward.
 These are written in the docstring of `publish_programmatically` in
-`docutils.core` which is referenced from `publish_parts` (the function
-used here).
+`docutils.core` which is referenced from `publish_parts`.
+`RenderEngine` (used here) does the same thing as `publish_parts`,
+but the docutils settings, `Reader` and `Writer` are reused.
 
 To pass the information from `neorg.web` to `neorg.wiki`, the
-`settings_overrides` argument of the `publish_parts` is used.
+`settings_overrides` argument of `RenderEngine.publish` is used.
 This is usually command line options to the docutils tools.
 Any object can be passed to `settings_overrides`.  This settings can
 be accessed by `self.document.settings` from the `Transform` classes.
 
 """
 
+import os
 import re
+import json
+import time
+import threading
+from hashlib import md5
+from fnmatch import fnmatch
 from docutils.parsers.rst import directives, Directive
 from docutils.parsers.rst.directives.images import Image
 from docutils.readers import standalone
@@ -43,7 +50,7 @@ from docutils.writers import html4css1
 from docutils import nodes, writers
 
 from os import path
-from glob import glob
+from glob import glob, iglob
 
 
 # disable docutils security hazards:
@@ -84,22 +91,38 @@ class SafeMagic(object):
 
 
 def convert_page_path_to_nodes(text, node_list=[]):
-    split = _RE_PAGE_PATH.split(text, maxsplit=1)
-    if len(split) == 8:
-        pre = ''.join(split[:2])
-        page_path = split[2]
-        rest = ''.join(split[-2:])
-        new_node_list = (
-            node_list + [nodes.Text(pre)] + list(gene_link(page_path)))
-        return convert_page_path_to_nodes(rest, new_node_list)
-    elif len(split) == 1:
-        return node_list + [nodes.Text(text)]
+    """
+    Convert page paths in `text` to links and return the list of nodes
+
+    The text is scanned once, so it takes linear time in the length
+    of `text` and the number of the page paths.
+
+    >>> node_list = convert_page_path_to_nodes('see /a/ and /b/.')
+    >>> [n.tagname for n in node_list]  # doctest: +NORMALIZE_WHITESPACE
+    ['#text', 'reference', 'target', '#text', 'reference', 'target',
+     '#text']
+
+    """
+    new_node_list = list(node_list)
+    last = 0
+    for match in _RE_PAGE_PATH.finditer(text):
+        (start, end) = match.span('page_path')
+        if start > last:
+            new_node_list.append(nodes.Text(text[last:start]))
+        new_node_list.extend(gene_link(match.group('page_path')))
+        last = end
+    if last < len(text) or not new_node_list:
+        new_node_list.append(nodes.Text(text[last:]))
+    return new_node_list
 
 _PAGE_PATH_SE_SYMBOLS = ',!?;:(){}[]<>@#$%^&-+|\\~\'\"='
+# `head` and `tail` are not consumed, so that the character between
+# two page paths can be used as the tail of the first one and the
+# head of the second one.
 _RE_PAGE_PATH = re.compile(
-    r'(?P<head>^|[\s%s])'
+    r'(?:^|(?<=[\s%s]))'
     r'(?P<page_path>(/|(\.{1,2}/)+)([a-zA-Z0-9][a-zA-Z0-9_\-\.\+]*/)*)'
-    r'(?P<tail>$|[\s%s])'
+    r'(?=$|[\s%s])'
     % ('/' + re.escape(_PAGE_PATH_SE_SYMBOLS),  # can be starts with this
        '.' + re.escape(_PAGE_PATH_SE_SYMBOLS),  # can be ends with this
        ))
@@ -123,6 +146,11 @@ class AdHocInlineMarkup(Transform):
     the conversion is needed for the given Text node. The convert
     function converts the given text to the list of nodes.
 
+    The document is traversed only once.  The rules are applied in
+    order to each Text node and then to the Text nodes generated by
+    the preceding rules (but not to the ones in the generated
+    elements, such as the text of the links).
+
     """
     default_priority = 0
 
@@ -131,12 +159,21 @@ class AdHocInlineMarkup(Transform):
         ]
 
     def apply(self):
-
-        for (cond, conv) in self.cond_conv_list:
-            _cond = lambda nd: isinstance(nd, nodes.Text) and cond(nd)
-            for node in self.document.traverse(_cond):
-                new_node_list = conv(node.astext())
-                node.parent.replace(node, new_node_list)
+        for node in list(self.document.traverse(nodes.Text)):
+            parent = node.parent
+            new_node_list = [node]
+            for (cond, conv) in self.cond_conv_list:
+                converted = []
+                for nd in new_node_list:
+                    if isinstance(nd, nodes.Text):
+                        nd.parent = parent  # `cond` may need this
+                        if cond(nd):
+                            converted.extend(conv(nd.astext()))
+                            continue
+                    converted.append(nd)
+                new_node_list = converted
+            if new_node_list != [node]:
+                parent.replace(node, new_node_list)
 
 
 class list_pages(nodes.Admonition, nodes.Element):
@@ -151,6 +188,15 @@ class dictdiff(nodes.General, nodes.Element):
     pass
 
 
+class data_pending(nodes.General, nodes.Element):
+    """
+    Placeholder of a data directive (see `ProcessDataPending`)
+
+    The directive instance is stored in the `directive` attribute.
+
+    """
+
+
 def _path_tree(path_list):
     """
     Convert list of path to tree
@@ -203,6 +249,7 @@ class ProcessListPages(Transform):
     def apply(self):
         nodes_list_pages = list(self.document.traverse(list_pages))
         if nodes_list_pages:
+            self.document.settings.neorg_dependency.pages = True
             page_path = self.document.settings.neorg_page_path
             page_list = self._web.list_descendants(page_path)
             for node in nodes_list_pages:
@@ -220,6 +267,7 @@ class ProcessRecentPages(Transform):
     def apply(self):
         nodes_list_pages = list(self.document.traverse(recent_pages))
         if nodes_list_pages:
+            self.document.settings.neorg_dependency.pages = True
             page_path = self.document.settings.neorg_page_path
             for node in nodes_list_pages:
                 date_page = self._web.recent_pages(page_path,
@@ -241,34 +289,80 @@ class ProcessRecentPages(Transform):
                 node.replace_self(admonition)
 
 
+class ProcessDataPending(Transform):
+    """
+    Load the data of the all data directives in a page concurrently
+
+    When `_thread_pool` is given, `DataDirective` returns a
+    `data_pending` node instead of the generated nodes.  This transform
+    calls the loading step of these nodes (and of the `dictdiff` nodes)
+    in the thread pool, then generates the nodes in the document order.
+    This transform must be applied before the other NEOrg transforms,
+    so that the output is the same as the serial one.
+
+    """
+    _thread_pool = None  # None means serial
+    default_priority = 0
+
+    def apply(self):
+        if self._thread_pool is None:
+            return
+        from functools import partial
+        pending_list = list(self.document.traverse(data_pending))
+        dictdiff_list = list(self.document.traverse(dictdiff))
+        process_dictdiff = ProcessDictDiff(self.document)
+        fragment_list = call_in_pool(
+            self._thread_pool,
+            [node.directive.load for node in pending_list] +
+            [partial(process_dictdiff.load, node) for node in dictdiff_list])
+        for node in pending_list:
+            node.replace_self(node.directive.build(fragment_list.pop(0)))
+        for node in dictdiff_list:
+            # will be used by `ProcessDictDiff`
+            node.neorg_fragment = fragment_list.pop(0)
+
+
 class ProcessDictDiff(Transform):
     _web = None  # needs override
     _DictTable = None  # needs override
     _glob_list = None  # needs override
+    _fragment_cache = None  # None means no cache
     default_priority = 0
 
     def apply(self):
         for node in self.document.traverse(dictdiff):
-            self._replace_node(node)
-
-    def _replace_node(self, node):
+            fragment = getattr(node, 'neorg_fragment', None)
+            if fragment is None:
+                fragment = self.load(node)
+            node.replace_self(build_fragment(
+                self._fragment_cache, fragment,
+                self.document.settings.neorg_dependency,
+                lambda fragment: [self._gene_table(node, fragment)],
+                self.document.reporter.warning))
+
+    def load(self, node):
+        """
+        Search and load the data files (see `DataDirective.load`)
+        """
+        fragment = search_data(
+            'dictdiff', node.get('arguments'), node.attributes,
+            self._web.app.config, self._glob_list, self._fragment_cache,
+            get_path_order_sort(node.attributes),
+            self.document.settings.neorg_budget)
+        if fragment.cached is None and not fragment.skipped:
+            fragment.data_table = self._DictTable.from_path_list(
+                fragment.syspath_list, ftypes=get_ftypes(node),
+                budget=fragment.budget)
+            fragment.check_empty()
+        return fragment
+
+    def _gene_table(self, node, fragment):
+        datadir = fragment.datadir
+        base_syspath = fragment.base_syspath
         arguments = node.get('arguments')
-        path_order = node.get('path-order', 'sorted')
-        if path_order == 'sort_r':
-            glob_list_sorted = lambda x: sorted(x, reverse=True)
-        else:
-            glob_list_sorted = sorted
-        datadir = self._web.app.config['DATADIRPATH']
-        base_syspath = path.join(datadir, node.get('base', ''))
-        data_syspath_list = self._glob_list(
-            get_syspath_list(
-                arguments, base_syspath, node.get('file')),
-            glob_list_sorted)
         link = node.get('link', [])
 
-        ftypes = get_ftypes(node)
-        data_table = self._DictTable.from_path_list(data_syspath_list,
-                                                    ftypes=ftypes)
+        data_table = fragment.data_table
         if node.hasattr('sort'):
             data_table.sort_names_by_values(node.get('sort'))
 
@@ -306,7 +400,7 @@ class ProcessDictDiff(Transform):
         if node.hasattr('trans'):
             table_data = zip(*table_data)
 
-        table_node = gene_table(
+        return gene_table(
             table_data,
             title=title_from_path(
                 arguments,
@@ -315,11 +409,10 @@ class ProcessDictDiff(Transform):
                 'Diff of data found in: %s',
                 ),
             classes=['neorg-dictdiff'])
-        node.replace_self(table_node)
 
 
 NEORG_TRANSFORMS = [
-    AdHocInlineMarkup, ProcessListPages, ProcessDictDiff,
+    ProcessDataPending, AdHocInlineMarkup, ProcessListPages, ProcessDictDiff,
     ProcessRecentPages,
     ]
 
@@ -576,13 +669,267 @@ def get_suboptions(options, prefix):
     return transpose_dict(suboptions)
 
 
-def glob_list(pathlist, sorted=sorted):
+def glob_list(pathlist, sorted=sorted, budget=None):
+    """
+    Expand glob patterns in `pathlist`
+
+    If `budget` (see `RenderBudget`) is given, stop globbing when it
+    runs out.
+
+    """
     globed = []
     for pathname in pathlist:
-        globed += sorted(glob(pathname))
+        if budget is None:
+            globed += sorted(glob(pathname))
+        else:
+            matched = []
+            for matched_path in iglob(pathname):
+                if not budget.spend_glob():
+                    break
+                matched.append(matched_path)
+            globed += sorted(matched)
     return globed
 
 
+class RenderBudget(object):
+    """
+    Limit of the resources used by the data directives in a page
+
+    max_time : float or None
+        Wall time (in seconds) from the creation of the budget.
+    max_globbed : int or None
+        Number of paths matched by the glob patterns.
+    max_loaded : int or None
+        Number of data files loaded.
+
+    None means no limit.  `spend_glob` and `spend_load` return False
+    when the budget runs out, and then the caller must stop.
+    The reasons are recorded in `exhausted`.  This object is shared by
+    the threads loading data (see `ProcessDataPending`).
+
+    >>> budget = RenderBudget(max_globbed=2)
+    >>> [budget.spend_glob() for _ in range(3)]
+    [True, True, False]
+    >>> budget.exhausted
+    ['files globbed']
+    >>> budget.spend_load()  # only globbing is limited
+    True
+
+    """
+
+    def __init__(self, max_time=None, max_globbed=None, max_loaded=None):
+        self.max_time = max_time
+        self.max_globbed = max_globbed
+        self.max_loaded = max_loaded
+        self.started = time.time()
+        self.globbed = 0
+        self.loaded = 0
+        self.exhausted = []
+        self._lock = threading.Lock()
+
+    def _exhaust(self, reason):
+        if reason not in self.exhausted:
+            self.exhausted.append(reason)
+        return False
+
+    def _spend(self, counter, limit, reason):
+        with self._lock:
+            if (self.max_time is not None and
+                time.time() - self.started > self.max_time):
+                return self._exhaust('wall time')
+            count = getattr(self, counter)
+            if limit is not None and count >= limit:
+                return self._exhaust(reason)
+            setattr(self, counter, count + 1)
+            return True
+
+    def spend_glob(self):
+        return self._spend('globbed', self.max_globbed, 'files globbed')
+
+    def spend_load(self):
+        return self._spend('loaded', self.max_loaded, 'files loaded')
+
+    def for_directive(self):
+        return DirectiveBudget(self)
+
+
+class DirectiveBudget(object):
+    """
+    View of `RenderBudget` used by one directive
+
+    It remembers if the data of the directive is truncated.
+
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.truncated = False
+
+    def spend_glob(self):
+        if self.budget.spend_glob():
+            return True
+        self.truncated = True
+        return False
+
+    def spend_load(self):
+        if self.budget.spend_load():
+            return True
+        self.truncated = True
+        return False
+
+
+def match_path(syspath, pattern):
+    """
+    Check if `syspath` matches to the glob `pattern` as `glob` does
+
+    Unlike `fnmatch`, the wildcards do not match the path separator
+    and do not match the leading dot of the names.
+
+    >>> match_path('data/x.csv', 'data/*.csv')
+    True
+    >>> match_path('data/sub/x.csv', 'data/*.csv')
+    False
+    >>> match_path('data/sub/x.csv', 'data/*/*.csv')
+    True
+    >>> match_path('data/.x.csv', 'data/*.csv')
+    False
+
+    """
+    names = syspath.split(path.sep)
+    patterns = pattern.split(path.sep)
+    if len(names) != len(patterns):
+        return False
+    for (name, pat) in zip(names, patterns):
+        if name.startswith('.') and not pat.startswith('.'):
+            return False
+        if not fnmatch(name, pat):
+            return False
+    return True
+
+
+def _stat(syspath):
+    try:
+        st = os.stat(syspath)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+class DataDependency(object):
+    """
+    Record of the data files used to render a page
+
+    An instance is passed to the directives and transforms via
+    ``settings.neorg_dependency`` (see `gene_html`).
+
+    globs : list of (list of str, list of str)
+        Pairs of the glob patterns and the matched paths.
+    files : dict
+        Map from the path of the loaded file to its (mtime, size).
+        (mtime, size) is None if the file does not exist.
+    pages : bool
+        True if the page depends on the other pages
+        (e.g., the ``list-pages`` directive).
+
+    >>> dep = DataDependency()
+    >>> dep.add_files(['non-existing-file'])
+    >>> dep.files
+    {'non-existing-file': None}
+    >>> dep.is_fresh()
+    True
+    >>> dep.fingerprint() == DataDependency.from_json(
+    ...     dep.to_json()).fingerprint()
+    True
+
+    """
+
+    def __init__(self, globs=(), files=(), pages=False):
+        self.globs = [(list(p), list(m)) for (p, m) in globs]
+        self.files = dict((f, None if st is None else tuple(st))
+                          for (f, st) in files)
+        self.pages = pages
+
+    def glob(self, globber, pathlist, *args, **kwds):
+        """
+        Call ``globber(pathlist, *args, **kwds)`` and record the result
+        """
+        matched = globber(pathlist, *args, **kwds)
+        self.globs.append((list(pathlist), list(matched)))
+        return matched
+
+    def update(self, other):
+        """
+        Merge the record of another `DataDependency`
+        """
+        self.globs.extend(other.globs)
+        self.files.update(other.files)
+        self.pages = self.pages or other.pages
+
+    def add_files(self, syspath_list):
+        for syspath in syspath_list:
+            self.files[syspath] = _stat(syspath)
+
+    def _state(self):
+        return (sorted((p, sorted(m)) for (p, m) in self.globs),
+                sorted(self.files.iteritems()),
+                self.pages)
+
+    def fingerprint(self):
+        """
+        Hash of the recorded patterns, paths and (mtime, size)
+        """
+        return md5(json.dumps(self._state())).hexdigest()
+
+    def is_fresh(self):
+        """
+        Check if the recorded files are not changed
+
+        The glob patterns are expanded again to detect new files.
+
+        """
+        for (syspath, st) in self.files.iteritems():
+            if _stat(syspath) != st:
+                return False
+        for (pathlist, matched) in self.globs:
+            if set(glob_list(pathlist)) != set(matched):
+                return False
+        return True
+
+    def depends_on(self, syspath):
+        """
+        Check if the rendered page may depend on the given file
+        """
+        syspath = path.abspath(syspath)
+        if syspath in (path.abspath(f) for f in self.files):
+            return True
+        return any(match_path(syspath, path.abspath(p))
+                   for (pathlist, dummy) in self.globs for p in pathlist)
+
+    def split(self):
+        """
+        Split into the `DataDependency` of each glob pattern and file
+
+        >>> dep = DataDependency(globs=[(['a/*'], ['a/b'])], pages=True)
+        >>> dep.add_files(['non-existing-file'])
+        >>> [(d.globs, d.files) for d in dep.split()]
+        [([(['a/*'], ['a/b'])], {}), ([], {'non-existing-file': None})]
+
+        """
+        return ([DataDependency(globs=[g]) for g in self.globs] +
+                [DataDependency(files=[f]) for f in
+                 sorted(self.files.iteritems())])
+
+    def to_json(self):
+        return json.dumps({'globs': self.globs,
+                           'files': sorted(self.files.iteritems()),
+                           'pages': self.pages}, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**dict((str(k), v) for (k, v) in
+                          json.loads(text).iteritems()))
+
+
 def get_syspath_list(path_list, base_syspath, filename=None):
     syspath_list = [path.join(base_syspath, p) for p in path_list]
     if filename is not None:
@@ -664,15 +1011,267 @@ def get_ftypes(options):
     return fts
 
 
-class TableData(Directive):
+def fragment_key(name, arguments, options, config, syspath_list, dependency):
     """
-    Search data and show matched data and corresponding image(s)
+    Key of the nodes generated by a data directive
+
+    The key depends on the (mtime, size) of the files in
+    `syspath_list`.  These are recorded in `dependency` here.
+
+    """
+    dependency.add_files(syspath_list)
+    return md5(repr((
+        name, arguments, sorted(options.iteritems()),
+        config['DATADIRPATH'], config['DATADIRURL'],
+        [(p, dependency.files[p]) for p in syspath_list],
+        ))).hexdigest()
+
+
+def get_path_order_sort(options):
+    if options.get('path-order', 'sort') == 'sort_r':
+        return lambda x: sorted(x, reverse=True)
+    else:
+        return sorted
+
+
+class DataFragment(object):
+    """
+    Data files searched (and loaded) for a data directive
+
+    dependency : DataDependency
+        Files used by the directive.  This is merged into the
+        dependency of the page by `build_fragment`.
+    datadir : str
+    base_syspath : str
+    syspath_list : list of str
+        The matched data files.
+    key : str
+        Key for the fragment cache (see `fragment_key`).
+    cached : list of nodes or None
+        Nodes found in the fragment cache.
+    data_table : neorg.data.DictTable or None
+        Loaded data.  This is not loaded if `cached` is found.
+    budget : DirectiveBudget or None
+        Budget for searching and loading the data.
+    skipped : bool
+        True if the budget ran out before any data is found.
+
+    """
+
+    def __init__(self, dependency, datadir, base_syspath, syspath_list,
+                 key, cached=None, data_table=None, budget=None,
+                 skipped=False):
+        self.dependency = dependency
+        self.datadir = datadir
+        self.base_syspath = base_syspath
+        self.syspath_list = syspath_list
+        self.key = key
+        self.cached = cached
+        self.data_table = data_table
+        self.budget = budget
+        self.skipped = skipped
+
+    @property
+    def truncated(self):
+        return self.budget is not None and self.budget.truncated
+
+    def check_empty(self):
+        """
+        Mark as skipped if the budget ran out before any data is loaded
+        """
+        if self.data_table is None:
+            found = self.syspath_list
+        else:
+            found = self.data_table.names
+        if self.truncated and not found:
+            self.skipped = True
+
+    def budget_message(self):
+        reasons = ', '.join(self.budget.budget.exhausted)
+        if self.skipped:
+            return 'Render budget ran out ({0}).  Data is not loaded.' \
+                   .format(reasons)
+        else:
+            return 'Render budget ran out ({0}).  Data is truncated.' \
+                   .format(reasons)
+
+
+def search_data(name, arguments, options, config, globber, cache,
+                sort=None, budget=None):
+    """
+    Search the data files and look up the fragment cache
+
+    This function does not touch the document, so that it can be
+    called in a worker thread.  Returns a `DataFragment`.
+
+    If `budget` (a `RenderBudget`) is given, globbing stops when it
+    runs out.  Nothing is searched if it already ran out.
+
+    """
+    # naming note:
+    #     - *_syspath is system path
+    #     - *_relpath is relative path from `datadir`
+    #     - *_absurl is url with leading slash
+    dependency = DataDependency()
+    datadir = config['DATADIRPATH']
+    base_syspath = path.join(datadir, options.get('base', ''))
+    if budget is None:
+        kwds = {}
+    elif budget.exhausted:
+        return DataFragment(dependency, datadir, base_syspath, [], None,
+                            budget=budget.for_directive(), skipped=True)
+    else:
+        kwds = {'budget': budget.for_directive()}
+    pathlist = get_syspath_list(arguments, base_syspath, options.get('file'))
+    args = () if sort is None else (sort,)
+    syspath_list = dependency.glob(globber, pathlist, *args, **kwds)
+    key = fragment_key(name, arguments, options, config, syspath_list,
+                       dependency)
+    fragment = DataFragment(dependency, datadir, base_syspath, syspath_list,
+                            key, budget=kwds.get('budget'))
+    if cache is not None and not fragment.truncated:
+        fragment.cached = cache.get(key)
+    return fragment
+
+
+def build_fragment(cache, fragment, dependency, gene_nodes, warning):
+    """
+    Get list of nodes from `fragment` or generate it by `gene_nodes`
+
+    The dependency of `fragment` is merged to `dependency`.
+    The size of the cached entry is the number of the nodes.
+    Nodes with system messages are not cached, so that the messages
+    are reported every time.  If the data is truncated because of the
+    render budget, a warning made by `warning` is appended.
+
+    """
+    dependency.update(fragment.dependency)
+    if fragment.skipped:
+        return [warning(fragment.budget_message())]
+    if fragment.cached is not None:
+        return [n.deepcopy() for n in fragment.cached]
+    node_list = gene_nodes(fragment)
+    if fragment.truncated:
+        node_list.append(warning(fragment.budget_message()))
+    if (cache is not None and
+        not any(isinstance(n, nodes.system_message) for n in node_list)):
+        cache.set(fragment.key, [n.deepcopy() for n in node_list],
+                  size=sum(len(n.traverse()) for n in node_list))
+    return node_list
+
+
+def _call(func):
+    return func()
+
+
+def call_in_pool(pool, funcs):
+    """
+    Call each function in `funcs` using `pool` and return the results
+
+    The results are in the same order as `funcs`.  If `pool` is None,
+    the functions are called serially.
+
+    >>> call_in_pool(None, [lambda: 1, lambda: 2])
+    [1, 2]
+    >>> from multiprocessing.pool import ThreadPool
+    >>> call_in_pool(ThreadPool(2), [lambda: 1, lambda: 2])
+    [1, 2]
+
+    """
+    if pool is None or len(funcs) < 2:
+        return [func() for func in funcs]
+    return pool.map(_call, funcs)
+
+
+def deferred_placeholder(fragments, block_text):
+    """
+    Make a placeholder of a data directive rendered later
+
+    `block_text` is appended to `fragments`.  The placeholder is
+    replaced with the HTML loaded from ``_fragment/<n>`` (relative to
+    the page) by JavaScript, where ``<n>`` is the index in
+    `fragments` (see `gene_html` and `find_deferred_fragments`).
+
+    """
+    fragments.append(block_text)
+    html = ('<div class="neorg-deferred" data-neorg-fragment="_fragment/%d">'
+            '<p>Loading...</p></div>' % (len(fragments) - 1))
+    return nodes.raw('', html, format='html')
+
+
+class DataDirective(Directive):
+    """
+    Base class of the directives which load data files
+
+    The generation of nodes is split into two steps.  `load` searches
+    and loads the data files and returns a `DataFragment`.  It does not
+    touch the document, so that it can be called in a worker thread.
+    `build` generates the list of nodes from the fragment.
+
+    When `_thread_pool` is given, `run` returns a `data_pending` node
+    and these steps are done by the `ProcessDataPending` transform.
+    In the deferred mode (see `gene_html`), `run` returns a placeholder
+    without doing these steps.
+
+    Subclass must define `_gene_nodes` and may override `_load_data`.
+
     """
 
-    _dirc_name = 'table-data'
     _web = None  # needs override
     _DictTable = None  # needs override
     _glob_list = None  # needs override
+    _fragment_cache = None  # None means no cache
+    _thread_pool = None  # None means serial
+    _sort_paths = True  # pass the sort function to `_glob_list`
+
+    def run(self):
+        deferred = self.state.document.settings.neorg_deferred
+        if deferred is not None:
+            return [deferred_placeholder(deferred, self.block_text)]
+        # `build` may be called after the parsing (see `_report_warning`)
+        self._source_and_line = self.state_machine.get_source_and_line()
+        if self._thread_pool is None:
+            return self.build(self.load())
+        node = data_pending(self.block_text)
+        node.directive = self
+        return [node]
+
+    def load(self):
+        settings = self.state.document.settings
+        fragment = search_data(
+            self._dirc_name, self.arguments, self.options,
+            self._web.app.config, self._glob_list, self._fragment_cache,
+            get_path_order_sort(self.options) if self._sort_paths else None,
+            settings.neorg_budget)
+        if fragment.cached is None and not fragment.skipped:
+            fragment.data_table = self._load_data(fragment)
+            fragment.check_empty()
+        return fragment
+
+    def _load_data(self, fragment):
+        return self._DictTable.from_path_list(
+            fragment.syspath_list, ftypes=get_ftypes(self.options),
+            budget=fragment.budget)
+
+    def build(self, fragment):
+        return build_fragment(self._fragment_cache, fragment,
+                              self.state.document.settings.neorg_dependency,
+                              self._gene_nodes, self._report_warning)
+
+    def _report_warning(self, message):
+        """
+        Report a warning at the line of this directive
+        """
+        (source, line) = self._source_and_line
+        return self.state.reporter.warning(message, source=source, line=line)
+
+
+class TableData(DataDirective):
+    """
+    Search data and show matched data and corresponding image(s)
+    """
+
+    _dirc_name = 'table-data'
 
     required_arguments = 1
     optional_arguments = OPTIONAL_ARGUMENTS_INF
@@ -687,38 +1286,27 @@ class TableData(Directive):
     option_spec.update(_FTYPE_OPTIONS)
     has_content = False
 
-    def run(self):
-        # naming note:
-        #     - *_syspath is system path
-        #     - *_relpath is relative path from `datadir`
-        #     - *_absurl is url with leading slash
-        datadir = self._web.app.config['DATADIRPATH']
-        path_order = self.options.get('path-order', 'sorted')
-        if path_order == 'sort_r':
-            glob_list_sorted = lambda x: sorted(x, reverse=True)
-        else:
-            glob_list_sorted = sorted
-
-        base_syspath = path.join(datadir,
-                                 self.options.get('base', ''))
-        data_syspath_list = self._glob_list(
-            get_syspath_list(
-                self.arguments, base_syspath, self.options.get('file')),
-            glob_list_sorted)
-        from_base_list = [
-            path.relpath(x, base_syspath) for x in data_syspath_list]
+    def _from_base_list(self, fragment):
+        from_base_list = [path.relpath(x, fragment.base_syspath)
+                          for x in fragment.syspath_list]
         if 'file' in self.options:
             from_base_list = map(path.dirname, from_base_list)
+        return from_base_list
+
+    def _load_data(self, fragment):
+        return self._DictTable.from_path_list(
+            fragment.syspath_list, self._from_base_list(fragment),
+            ftypes=get_ftypes(self.options), budget=fragment.budget)
 
+    def _gene_nodes(self, fragment):
+        datadir = fragment.datadir
+        base_syspath = fragment.base_syspath
+        data_syspath_list = fragment.syspath_list
         data_keys = self.options.get('data', [])
         colwidths = self.options.get('widths')
         link = self.options.get('link')
 
-        ftypes = get_ftypes(self.options)
-        data_table = self._DictTable.from_path_list(data_syspath_list,
-                                                    from_base_list,
-                                                    ftypes=ftypes)
-        data_table = data_table.filter_by_fnmatch(data_keys)
+        data_table = fragment.data_table.filter_by_fnmatch(data_keys)
         rowdata = data_table.as_list()
         if link is not None:
             rowdata[0].append('link(s)')
@@ -741,7 +1329,7 @@ class TableData(Directive):
         (messages, colwidths) = check_rowdata_and_widths(
             rowdata,
             colwidths,
-            self.state.reporter.warning,
+            self._report_warning,
             )
         return [gene_table(rowdata,
                            title=title_from_path(
@@ -752,15 +1340,12 @@ class TableData(Directive):
                            colwidths=colwidths)] + messages
 
 
-class TableDataAndImage(Directive):
+class TableDataAndImage(DataDirective):
     """
     Search data and show matched data and corresponding image(s)
     """
 
     _dirc_name = 'table-data-and-image'
-    _web = None  # needs override
-    _DictTable = None  # needs override
-    _glob_list = None  # needs override
 
     required_arguments = 1
     optional_arguments = OPTIONAL_ARGUMENTS_INF
@@ -777,35 +1362,17 @@ class TableDataAndImage(Directive):
     option_spec.update(_FTYPE_OPTIONS)
     has_content = False
 
-    def run(self):
-        # naming note:
-        #     - *_syspath is system path
-        #     - *_relpath is relative path from `datadir`
-        #     - *_absurl is url with leading slash
-        datadir = self._web.app.config['DATADIRPATH']
+    def _gene_nodes(self, fragment):
+        datadir = fragment.datadir
+        base_syspath = fragment.base_syspath
         datadirurl = self._web.app.config['DATADIRURL']
-        path_order = self.options.get('path-order', 'sort')
-        if path_order == 'sort_r':
-            glob_list_sorted = lambda x: sorted(x, reverse=True)
-        else:
-            glob_list_sorted = sorted
-
-        base_syspath = path.join(datadir,
-                                 self.options.get('base', ''))
-        data_syspath_list = self._glob_list(
-            get_syspath_list(
-                self.arguments, base_syspath, self.options.get('file')),
-            glob_list_sorted)
-
         data_keys = self.options.get('data', [])
         image_names = self.options.get('image', [])
         image_options = get_suboptions(self.options, 'image-')
         colwidths = self.options.get('widths')
         link = self.options.get('link')
 
-        ftypes = get_ftypes(self.options)
-        data_table = self._DictTable.from_path_list(data_syspath_list,
-                                                    ftypes=ftypes)
+        data_table = fragment.data_table
         if 'sort' in self.options:
             data_table.sort_names_by_values(self.options['sort'])
         diffkeys = set(data_table.diff())
@@ -849,7 +1416,7 @@ class TableDataAndImage(Directive):
         (messages, colwidths) = check_rowdata_and_widths(
             rowdata,
             colwidths,
-            self.state.reporter.warning,
+            self._report_warning,
             )
         return [gene_table(rowdata,
                            title=title_from_path(
@@ -878,17 +1445,18 @@ class DictDiff(Directive):
     has_content = False
 
     def run(self):
+        deferred = self.state.document.settings.neorg_deferred
+        if deferred is not None:
+            return [deferred_placeholder(deferred, self.block_text)]
         return [dictdiff(rawsource=self.block_text,
                          arguments=self.arguments,
                          **self.options)]
 
 
-class FindImages(Directive):
+class FindImages(DataDirective):
 
     _dirc_name = 'find-images'
-    _web = None  # needs override
-    _DictTable = None  # needs override
-    _glob_list = None  # needs override
+    _sort_paths = False
 
     required_arguments = 1
     optional_arguments = OPTIONAL_ARGUMENTS_INF
@@ -897,19 +1465,12 @@ class FindImages(Directive):
                    'file': directives.path}
     has_content = False
 
-    def run(self):
-        # naming note:
-        #     - *_syspath is system path
-        #     - *_relpath is relative path from `datadir`
-        #     - *_absurl is url with leading slash
-        datadir = self._web.app.config['DATADIRPATH']
-        datadirurl = self._web.app.config['DATADIRURL']
+    def _load_data(self, fragment):
+        return None
 
-        base_syspath = path.join(datadir,
-                                 self.options.get('base', ''))
-        image_syspath_list = self._glob_list(
-            get_syspath_list(
-                self.arguments, base_syspath, self.options.get('file')))
+    def _gene_nodes(self, fragment):
+        datadir = fragment.datadir
+        datadirurl = self._web.app.config['DATADIRURL']
 
         def gene_image(relpath):
             image_node = gene_aimage(
@@ -918,7 +1479,7 @@ class FindImages(Directive):
             return image_node
 
         node_list = []
-        for image_syspath in image_syspath_list:
+        for image_syspath in fragment.syspath_list:
             image_relpath = path.relpath(image_syspath, datadir)
             node_list += [gene_paragraph(image_relpath),
                           gene_image(image_relpath)]
@@ -987,11 +1548,9 @@ def gene_table_from_grid_dict(grid_dict, param, conv, title=None, **kwds):
     return gene_table(list2d, title=title, colwidths=colwidths, **kwds)
 
 
-class GridImages(Directive):
+class GridImages(DataDirective):
     _dirc_name = 'grid-images'
-    _web = None  # needs override
-    _DictTable = None  # needs override
-    _glob_list = None  # needs override
+    _sort_paths = False
 
     required_arguments = 1
     optional_arguments = OPTIONAL_ARGUMENTS_INF
@@ -1004,26 +1563,23 @@ class GridImages(Directive):
     has_content = False
 
     def run(self):
-        # naming note:
-        #     - *_syspath is system path
-        #     - *_relpath is relative path from `datadir`
-        #     - *_absurl is url with leading slash
         if 'param' not in self.options:
             return []
-        param = self.options['param']
         if 'image' not in self.options:
             return []
+        return DataDirective.run(self)
+
+    def _load_data(self, fragment):
+        return self._DictTable.from_path_list(fragment.syspath_list,
+                                              budget=fragment.budget)
+
+    def _gene_nodes(self, fragment):
+        datadir = fragment.datadir
+        base_syspath = fragment.base_syspath
+        param = self.options['param']
         image_names = self.options['image']
-        datadir = self._web.app.config['DATADIRPATH']
         datadirurl = self._web.app.config['DATADIRURL']
-
-        base_syspath = path.join(datadir,
-                                 self.options.get('base', ''))
-        data_syspath_list = self._glob_list(
-            get_syspath_list(
-                self.arguments, base_syspath, self.options.get('file')))
-        data_table = self._DictTable.from_path_list(data_syspath_list)
-        grid_dict = data_table.grid_dict(param)
+        grid_dict = fragment.data_table.grid_dict(param)
 
         def cellname(data_syspath):
             from_base = path.relpath(data_syspath, base_syspath)
@@ -1103,8 +1659,20 @@ NEORG_DIRECTIVES = [
     GridImages, RecentPages,
     ]
 
+def setup_wiki(web=None, DictTable=None, glob_list=None, fragment_cache=None,
+               thread_pool=None):
+    """
+    Register directives and inject the dependencies
+
+    `fragment_cache` is an object which has the same interface as
+    `neorg.cache.LRUCache`.  If it is given, the nodes generated by
+    the data directives are cached (see `build_fragment`).
+
+    `thread_pool` is a ``multiprocessing.pool.ThreadPool``.  If it is
+    given, the data files of the data directives in a page are loaded
+    concurrently (see `ProcessDataPending`).
 
-def setup_wiki(web=None, DictTable=None, glob_list=None):
+    """
     if web is None:
         from neorg import web
     if DictTable is None:
@@ -1116,10 +1684,14 @@ def setup_wiki(web=None, DictTable=None, glob_list=None):
         cls._web = web
         cls._DictTable = DictTable
         cls._glob_list = glob_list
+        cls._fragment_cache = fragment_cache
+        cls._thread_pool = thread_pool
     for cls in NEORG_DIRECTIVES:
         cls._web = web
         cls._DictTable = DictTable
         cls._glob_list = glob_list
+        cls._fragment_cache = fragment_cache
+        cls._thread_pool = thread_pool
         directives.register_directive(cls._dirc_name, cls)
 
 
@@ -1186,18 +1758,314 @@ def safecall(tb_temp='%s'):
     return decorator
 
 
-@safecall('<h1>Failed to generate HTML</h1><pre>%s</pre>')
-def gene_html(text, page_path=None, settings_overrides={}):
-    from docutils.core import publish_parts
+class RenderEngine(object):
+    """
+    Long-lived docutils setup for `gene_html`
+
+    ``docutils.core.publish_parts`` builds an `OptionParser` (which
+    reads the docutils configuration files) and the `Reader` and the
+    `Writer` on every call.  This class builds the default settings
+    only once and reuses the `Reader` and the `Writer` in each thread.
+    Only the per-page overrides are applied for each call.
+
+    >>> engine = RenderEngine()
+    >>> print engine.publish('*text*', SAFE_DOCUTILS),
+    <div class="document">
+    <p><em>text</em></p>
+    </div>
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._defaults = None
+
+    def _components(self):
+        local = self._local
+        if not hasattr(local, 'reader'):
+            local.reader = Reader(parser_name='restructuredtext')
+            local.writer = Writer()
+        return (local.reader, local.writer)
+
+    def _get_defaults(self, reader, writer):
+        with self._lock:
+            if self._defaults is None:
+                from docutils.frontend import OptionParser
+                option_parser = OptionParser(
+                    components=(reader.parser, reader, writer))
+                defaults = option_parser.defaults.copy()
+                # Propagate exceptions as `publish_parts` does:
+                defaults['traceback'] = 1
+                if defaults['_disable_config']:
+                    config = {}
+                else:
+                    config = option_parser.get_standard_config_settings(
+                        ).__dict__.copy()
+                # this must be created for each call (see `publish`)
+                config.pop('record_dependencies', None)
+                defaults.pop('record_dependencies', None)
+                self._defaults = (defaults, config,
+                                  option_parser.config_files)
+        return self._defaults
+
+    def get_settings(self, settings_overrides):
+        """
+        Make new settings object given the overrides
+
+        As ``publish_parts``, the settings from the configuration
+        files have the precedence over `settings_overrides`.
+
+        """
+        from docutils.frontend import Values
+        (reader, writer) = self._components()
+        (defaults, config, config_files) = self._get_defaults(reader, writer)
+        settings_dict = defaults.copy()
+        settings_dict.update(settings_overrides)
+        settings_dict.update(config)
+        settings = Values(settings_dict)  # new `record_dependencies`
+        settings._config_files = config_files
+        return settings
+
+    def publish_parts(self, text, settings_overrides):
+        """
+        Convert `text` and return the parts and the document tree
+        """
+        from docutils.core import Publisher
+        from docutils import io
+        (reader, writer) = self._components()
+        pub = Publisher(reader, reader.parser, writer,
+                        source_class=io.StringInput,
+                        destination_class=io.StringOutput,
+                        settings=self.get_settings(settings_overrides))
+        pub.set_source(text, None)
+        pub.set_destination(None, None)
+        pub.publish()
+        return (pub.writer.parts, pub.document)
+
+    def publish(self, text, settings_overrides):
+        """
+        Convert `text` and return the 'html_body' part
+        """
+        return self.publish_parts(text, settings_overrides)[0]['html_body']
+
+_ENGINE = RenderEngine()
+
+
+def _settings_overrides(page_path, settings_overrides, dependency=None,
+                        budget=None, deferred=None):
+    if dependency is None:
+        dependency = DataDependency()
     new_settings_overrides = SAFE_DOCUTILS.copy()
     new_settings_overrides.update(
         # these data can be accessed from `self.document.settings`
         # of the Transform classes
         neorg_page_path=page_path,
+        neorg_dependency=dependency,
+        neorg_budget=budget,
+        neorg_deferred=deferred,
         **settings_overrides
         )
-    return publish_parts(
-        text,
-        writer=Writer(),
-        reader=Reader(),
-        settings_overrides=new_settings_overrides)['html_body']
+    return new_settings_overrides
+
+
+@safecall('<h1>Failed to generate HTML</h1><pre>%s</pre>')
+def gene_html(text, page_path=None, settings_overrides={}, dependency=None,
+              budget=None, deferred=False):
+    """
+    Generate HTML from the reST `text`
+
+    If an instance of `DataDependency` is given as `dependency`, the
+    data files used by the directives are recorded in it.
+    If an instance of `RenderBudget` is given as `budget`, the data
+    directives stop searching and loading data when it runs out.
+    If `deferred` is True, the data directives are not rendered but
+    replaced with placeholders (see `deferred_placeholder`).
+
+    """
+    return _ENGINE.publish(text, _settings_overrides(
+        page_path, settings_overrides, dependency, budget,
+        [] if deferred else None))
+
+
+def find_deferred_fragments(text, page_path=None):
+    """
+    Get the list of the reST texts of the data directives in `text`
+
+    The n-th element corresponds to the n-th placeholder generated
+    by ``gene_html(text, deferred=True)``.
+
+    """
+    fragments = []
+    _ENGINE.publish(text, _settings_overrides(page_path, {},
+                                              deferred=fragments))
+    return fragments
+
+
+_RE_LIST_LIKE = re.compile(
+    ur'([-*+\u2022\u2023\u2043]|\(?[0-9a-zA-Z#]+[.)]|:[^:\s][^:]*:|'
+    ur'--?\w\S*|/\w\S*)(\s|$)', re.UNICODE)
+_RE_TABLE_BORDER = re.compile(r'=+(\s+=+)*\s*$')
+
+
+def _is_list_like(lines):
+    return bool(_RE_LIST_LIKE.match(lines[0]) or
+                (len(lines) > 1 and lines[1].strip() and
+                 lines[1][:1].isspace()))  # definition list
+
+
+def _continues(previous, lines):
+    """
+    Check if `lines` may be a part of the construct in `previous`
+    """
+    last = [l for l in previous if l.strip()][-1:]
+    if last and last[0].rstrip().endswith('::'):
+        return True  # quoted literal block
+    if _is_list_like(previous) and _is_list_like(lines):
+        return True  # list items separated by blank lines
+    if (_RE_TABLE_BORDER.match(previous[0]) and
+        any(_RE_TABLE_BORDER.match(l) for l in lines)):
+        return True  # simple table with blank lines
+    return False
+
+
+def split_blocks(text):
+    """
+    Split reST `text` into top-level blocks
+
+    A block starts at a non-indented line after a blank line.  To be
+    safe, consecutive blocks which may be parts of one construct (list
+    items, simple table rows, etc.) are merged.  Joining the blocks
+    gives the original text.
+
+    >>> split_blocks(u'a\\n\\n  b\\n\\nc\\n')
+    [u'a\\n\\n  b\\n\\n', u'c\\n']
+    >>> split_blocks(u'* a\\n\\n* b\\n\\nc')
+    [u'* a\\n\\n* b\\n\\n', u'c']
+
+    """
+    blocks = []
+    previous_blank = True
+    for line in text.splitlines(True):
+        blank = not line.strip()
+        if blocks and not (previous_blank and not blank and
+                           not line[:1].isspace()):
+            blocks[-1].append(line)
+        else:
+            blocks.append([line])
+        previous_blank = blank
+    merged = []
+    for lines in blocks:
+        if merged and _continues(merged[-1], lines):
+            merged[-1] += lines
+        else:
+            merged.append(lines)
+    return [''.join(lines) for lines in merged]
+
+
+def _is_self_contained(document):
+    """
+    Check if the rendered block does not interact with other blocks
+    """
+    for node in document.traverse():
+        if isinstance(node, (nodes.section, nodes.docinfo, nodes.field_list,
+                             nodes.transition, nodes.pending, nodes.target,
+                             nodes.system_message, nodes.problematic,
+                             nodes.footnote, nodes.citation, nodes.comment,
+                             nodes.substitution_definition)):
+            return False
+        if type(node).__module__ == __name__:
+            return False  # list-pages, dictdiff, etc.
+        if (isinstance(node, (nodes.title, nodes.subtitle)) and
+            isinstance(node.parent, (nodes.document, nodes.section))):
+            return False
+        if isinstance(node, nodes.Element) and any(
+                node.get(a) for a in ('ids', 'names', 'refname', 'refid')):
+            return False
+    return True
+
+
+class IncrementalRenderer(object):
+    """
+    Render reST text reusing the HTML of unchanged top-level blocks
+
+    The text is split by `split_blocks`.  Each block (except the
+    first one) is rendered alone and its HTML is stored in `cache`
+    (an object which has the same interface as
+    `neorg.cache.LRUCache`) if it does not interact with the other
+    blocks: it must not have sections, targets, references by name,
+    footnotes, system messages, data directives (they are rendered
+    in the deferred mode here), ``list-pages``, etc.  Then the text
+    in which such blocks are replaced by placeholder paragraphs is
+    rendered and the placeholders are replaced by the cached HTML.
+    Therefore, the cross-block features (e.g., section structure
+    and ``list-pages``) are handled as usual.
+
+    """
+
+    def __init__(self, cache, engine=None):
+        self.cache = cache
+        self.engine = _ENGINE if engine is None else engine
+
+    def _block_html(self, block, page_path):
+        from neorg import __version__
+        key = md5(repr((__version__, page_path, block))).hexdigest()
+        block_html = self.cache.get(key)
+        if block_html is None:
+            dependency = DataDependency()
+            deferred = []
+            (parts, document) = self.engine.publish_parts(
+                block, _settings_overrides(
+                    page_path, dict(warning_stream=False), dependency,
+                    deferred=deferred))
+            if (deferred or dependency.pages or dependency.globs or
+                dependency.files or not _is_self_contained(document)):
+                block_html = False
+            else:
+                block_html = parts['body']
+            self.cache.set(key, block_html)
+        return block_html or None
+
+    def render(self, text, page_path=None, settings_overrides={},
+               dependency=None, budget=None):
+        """
+        Generate HTML from the reST `text` (see `gene_html`)
+        """
+        overrides = _settings_overrides(page_path, settings_overrides,
+                                        dependency, budget)
+        blocks = split_blocks(text)
+        salt = md5(text.encode('utf-8')).hexdigest()[:12]
+        skeleton = blocks[:1]
+        cached = []
+        for (i, block) in enumerate(blocks[1:], 1):
+            block_html = self._block_html(block, page_path)
+            if block_html is None:
+                skeleton.append(block)
+            else:
+                token = 'neorgblock%dx%s' % (i, salt)
+                # keep line numbers (used in system messages) unchanged
+                skeleton.append(token + '\n' * max(block.count('\n'), 2))
+                cached.append((token, block_html))
+        if not cached:
+            return self.engine.publish(text, overrides)
+        page_html = self.engine.publish(''.join(skeleton), overrides)
+        for (token, block_html) in cached:
+            placeholder = '<p>%s</p>\n' % token
+            if page_html.count(placeholder) != 1:
+                # unexpected structure; give up incremental rendering
+                return self.engine.publish(text, overrides)
+            page_html = page_html.replace(placeholder, block_html)
+        return page_html
+
+
+@safecall('<h1>Failed to generate HTML</h1><pre>%s</pre>')
+def gene_html_incremental(text, page_path=None, cache=None, **kwds):
+    """
+    Generate HTML using `IncrementalRenderer` if `cache` is given
+
+    Other arguments are the same as `gene_html`.
+
+    """
+    if cache is None:
+        return gene_html(text, page_path, _debug=True, **kwds)
+    return IncrementalRenderer(cache).render(text, page_path, **kwds)
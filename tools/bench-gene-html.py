@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Benchmark per-call overhead of `neorg.wiki.gene_html`
+
+Compare ``docutils.core.publish_parts`` (which builds the settings,
+`Reader` and `Writer` for each call) and `neorg.wiki.RenderEngine`.
+
+Usage::
+
+    python tools/bench-gene-html.py [-n NUMBER]
+
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from neorg.wiki import (setup_wiki, RenderEngine, DataDependency,
+                        Reader, Writer, SAFE_DOCUTILS)
+
+TEXTS = {
+    'small': 'Hello, *world*!',
+    'preview': '\n\n'.join(
+        'Section %d\n----------\n\nSee /some/page/%d/ and **more**.' % (i, i)
+        for i in range(10)),
+    }
+
+
+def overrides():
+    return dict(SAFE_DOCUTILS,
+                neorg_page_path='bench',
+                neorg_dependency=DataDependency())
+
+
+def publish_parts(text):
+    from docutils.core import publish_parts
+    return publish_parts(text, writer=Writer(), reader=Reader(),
+                         settings_overrides=overrides())['html_body']
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--number', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_wiki(web=object(), DictTable=object())
+    engine = RenderEngine()
+    for (name, text) in sorted(TEXTS.items()):
+        assert publish_parts(text) == engine.publish(text, overrides())
+        before = timeit.timeit(lambda: publish_parts(text),
+                               number=args.number)
+        after = timeit.timeit(lambda: engine.publish(text, overrides()),
+                              number=args.number)
+        print '%-8s publish_parts: %.3f ms/call  RenderEngine: %.3f ms/call' \
+              % (name, before / args.number * 1000,
+                 after / args.number * 1000)
+
+
+if __name__ == '__main__':
+    main()
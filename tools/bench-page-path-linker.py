@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark `neorg.wiki.convert_page_path_to_nodes` on link-heavy texts
+
+Compare the previous recursive implementation (which rebuilds the
+node list for each page path) and the current single-pass one on
+paragraphs with many page paths.
+
+Usage::
+
+    python tools/bench-page-path-linker.py [-n NUMBER] [LINKS ...]
+
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from docutils import nodes
+from neorg.wiki import (convert_page_path_to_nodes, gene_link,
+                        _PAGE_PATH_SE_SYMBOLS)
+
+_RE_PAGE_PATH_RECURSIVE = re.compile(
+    r'(?P<head>^|[\s%s])'
+    r'(?P<page_path>(/|(\.{1,2}/)+)([a-zA-Z0-9][a-zA-Z0-9_\-\.\+]*/)*)'
+    r'(?P<tail>$|[\s%s])'
+    % ('/' + re.escape(_PAGE_PATH_SE_SYMBOLS),
+       '.' + re.escape(_PAGE_PATH_SE_SYMBOLS),
+       ))
+
+
+def convert_recursive(text, node_list=[]):
+    split = _RE_PAGE_PATH_RECURSIVE.split(text, maxsplit=1)
+    if len(split) == 8:
+        pre = ''.join(split[:2])
+        page_path = split[2]
+        rest = ''.join(split[-2:])
+        new_node_list = (
+            node_list + [nodes.Text(pre)] + list(gene_link(page_path)))
+        return convert_recursive(rest, new_node_list)
+    elif len(split) == 1:
+        return node_list + [nodes.Text(text)]
+
+
+def gene_text(links):
+    return ' '.join('see /page/%d/, ./sub/%d/ and' % (i, i)
+                    for i in range(links // 2))
+
+
+def astexts(node_list):
+    return ''.join(n.astext() for n in node_list)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--number', type=int, default=10)
+    parser.add_argument('links', type=int, nargs='*',
+                        default=[10, 100, 500, 2000, 10000])
+    args = parser.parse_args()
+
+    for links in args.links:
+        text = gene_text(links)
+        after = timeit.timeit(lambda: convert_page_path_to_nodes(text),
+                              number=args.number)
+        try:
+            assert (astexts(convert_recursive(text)) ==
+                    astexts(convert_page_path_to_nodes(text)))
+            before = timeit.timeit(lambda: convert_recursive(text),
+                                   number=args.number)
+            before = '%9.3f ms' % (before / args.number * 1000)
+        except RuntimeError:  # maximum recursion depth exceeded
+            before = '    failed'
+        print '%6d links  recursive: %s  single-pass: %9.3f ms' \
+              % (links, before, after / args.number * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark the search backends of `neorg.search`
+
+For each backend, index generated pages and report the indexing
+time, the mean latency of the queries and the disk size of the index
+(the Whoosh index directory or the growth of the sqlite file).
+
+Usage::
+
+    python tools/bench-search.py [-n NUMBER] [-w WORDS] [PAGES ...]
+
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+from contextlib import closing
+from sqlite3 import dbapi2 as sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from neorg import search
+
+QUERIES = [u'word1', u'word2 word3', u'word4 OR word5', u'word6 NOT word7',
+           u'wor*', u'"word8 word9"']
+
+
+def gene_docs(pages, words, vocabulary=5000, seed=0):
+    rand = random.Random(seed)
+    vocab = [u'word%d' % i for i in range(vocabulary)]
+    for i in range(pages):
+        yield dict(page_path=u'Page/%d' % i,
+                   page_text=u' '.join(rand.choice(vocab)
+                                       for _ in range(words)))
+
+
+def dirsize(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for (root, _, files) in os.walk(path) for name in files)
+
+
+def bench(backend, docs, number):
+    tmpdir = tempfile.mkdtemp(prefix='neorg-bench-')
+    try:
+        dbpath = os.path.join(tmpdir, 'neorg.db')
+        indexdir = os.path.join(tmpdir, 'searchindex')
+        with closing(sqlite3.connect(dbpath)) as db:
+            db.execute('create table pages '
+                       '(page_path string primary key, page_text string)')
+            db.executemany('insert into pages values (?, ?)',
+                           [(d['page_path'], d['page_text']) for d in docs])
+            db.commit()
+            before = os.path.getsize(dbpath)
+
+            start = time.time()
+            ix = search.get_index(indexdir, backend, db)
+            search.update_all(ix, docs)
+            db.commit()
+            index_time = time.time() - start
+
+            start = time.time()
+            for _ in range(number):
+                for query in QUERIES:
+                    list(search.search(ix, query))
+            query_time = (time.time() - start) / number / len(QUERIES)
+            db.execute('vacuum')
+        size = os.path.getsize(dbpath) - before + dirsize(indexdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    return (index_time, query_time, size)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help='number of repetition of the queries')
+    parser.add_argument('-w', '--words', type=int, default=300,
+                        help='number of words in a page')
+    parser.add_argument('-b', '--backend', action='append',
+                        choices=sorted(search.BACKENDS),
+                        help='backend to test (default: all)')
+    parser.add_argument('pages', type=int, nargs='*',
+                        default=[100, 1000, 5000])
+    args = parser.parse_args()
+
+    for pages in args.pages:
+        docs = list(gene_docs(pages, args.words))
+        for backend in args.backend or sorted(search.BACKENDS):
+            (index_time, query_time, size) = bench(backend, docs,
+                                                   args.number)
+            print ('%6d pages  %-6s  index: %8.3f s  query: %8.3f ms  '
+                   'size: %7.1f MB' % (pages, backend, index_time,
+                                       query_time * 1000, size / 1e6))
+
+
+if __name__ == '__main__':
+    main()